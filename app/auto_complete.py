@@ -1,20 +1,23 @@
-from datetime import datetime, timedelta
-import asyncio
+from datetime import datetime
 import logging
-from app.repo import set_booking_status, get_booking, get_service
 from app.notify import notify_admins
-from app.repo import get_user_by_id, create_review
+from app.repo import complete_bookings_ended_by, get_bookings
+from app import jobs
+from app.scheduler import now_ts, to_ts
 
 # Grace period: delay before auto-completion (in minutes)
 GRACE_PERIOD_MINUTES = 15
 
+# Booking ids listed in one admin digest
+DIGEST_LIMIT = 50
+
 # Configure logging
 logger = logging.getLogger(__name__)
 
-_scheduled_tasks = {}
+JOB_KIND = 'auto_complete'
 
 
-def schedule_auto_complete(booking_id, date_s, time_s, duration_min):
+async def schedule_auto_complete(booking_id, date_s, time_s, duration_min):
     """Schedule auto-completion with grace period.
     
     Args:
@@ -23,77 +26,53 @@ def schedule_auto_complete(booking_id, date_s, time_s, duration_min):
         time_s: Booking time (HH:MM format)
         duration_min: Service duration in minutes
     """
-    # Calculate when to complete: booking_time + duration + grace_period
-    dt = datetime.fromisoformat(f"{date_s}T{time_s}") + timedelta(
-        minutes=duration_min + GRACE_PERIOD_MINUTES
-    )
-    delay = (dt - datetime.now()).total_seconds()
-    if delay < 0:
-        delay = 0
-    # NOTE: schedule_auto_complete creates a background task using
-    # `asyncio.create_task`. Ensure the bot runs inside an asyncio
-    # event loop (as in `app/main.py`). If called outside a running
-    # loop, tasks may not be scheduled and you may see
-    # "coroutine was never awaited" warnings. This is a potential
-    # runtime observation during testing; logic kept as-is for MVP.
-    task = asyncio.create_task(_auto_complete(booking_id, delay))
-    _scheduled_tasks[booking_id] = task
-
-
-def cancel_auto_complete(booking_id):
+    # Complete at booking_time + duration + grace_period
+    run_at = to_ts(date_s, time_s) + (duration_min + GRACE_PERIOD_MINUTES) * 60
+    await jobs.enqueue(JOB_KIND, booking_id, run_at)
+
+
+async def cancel_auto_complete(booking_id):
     """Cancel scheduled auto-completion for a booking."""
-    task = _scheduled_tasks.pop(booking_id, None)
-    if task:
-        task.cancel()
+    await jobs.cancel(booking_id, (JOB_KIND,))
 
 
-async def _auto_complete(booking_id, delay):
-    """Auto-complete a booking after delay.
-    
-    Checks current status before completion to avoid double-processing.
-    Logs all auto-completions and skips.
+async def complete_overdue(now=None, booking_ids=None):
+    """Auto-complete scheduled bookings whose end + grace period has passed.
+
+    One set-based pass: a single UPDATE ... RETURNING completes them all and
+    their auto-reviews are written in the same transaction, then admins get
+    one digest instead of a message per booking. Bookings completed or
+    cancelled in the meantime are not touched. Uses the (status, end_ts) index,
+    or only the given booking_ids. Returns the ids that were completed.
     """
-    await asyncio.sleep(delay)
-    
-    # Get fresh booking status from DB
-    booking = await get_booking(booking_id)
-    if not booking:
-        logger.info(f"auto_complete: booking {booking_id} not found (already deleted?)")
-        return
-    
-    # Check if already completed or cancelled
-    if booking['status'] == 'completed':
-        logger.info(
-            f"auto_complete_skip: booking_id={booking_id}, "
-            f"reason=already_completed, timestamp={datetime.now().isoformat()}"
-        )
-        return
-    
-    if booking['status'] == 'cancelled':
-        logger.info(
-            f"auto_complete_skip: booking_id={booking_id}, "
-            f"reason=cancelled, timestamp={datetime.now().isoformat()}"
-        )
-        return
-    
-    # Auto-complete the booking
-    old_status = booking['status']
-    await set_booking_status(booking_id, 'completed')
-    
-    # Log successful completion
+    until = (now_ts() if now is None else now) - GRACE_PERIOD_MINUTES * 60
+    done = await complete_bookings_ended_by(until, booking_ids=booking_ids)
+    if not done:
+        return []
+    ids = [b['id'] for b in done]
     logger.info(
-        f"auto_complete: booking_id={booking_id}, "
+        f"auto_complete: booking_ids={ids}, "
         f"timestamp={datetime.now().isoformat()}, "
-        f"status_change={old_status}->completed"
+        f"status_change=scheduled->completed"
     )
-    
-    # Auto-request review
-    user = await get_user_by_id(booking['user_id'])
-    if user:
-        await create_review(
-            user['id'], booking['service_id'], booking['master_id'], 
-            rating=5, text=None
-        )
-        await notify_admins(
-            f"Авто-завершение и авто-отзыв: booking_id={booking_id}"
-        )
+    listed = ', '.join(str(i) for i in ids[:DIGEST_LIMIT])
+    if len(ids) > DIGEST_LIMIT:
+        listed += f" и ещё {len(ids) - DIGEST_LIMIT}"
+    await notify_admins(f"Авто-завершение и авто-отзыв ({len(ids)}): booking_id={listed}")
+    return ids
+
+
+async def _complete_due(booking_ids):
+    """Batch handler of auto_complete jobs.
+
+    Runs the complete_overdue() pass over the claimed bookings only; those
+    still scheduled afterwards end later than planned (their service got
+    longer) and are re-armed for their new end.
+    """
+    done = set(await complete_overdue(booking_ids=booking_ids))
+    for b in await get_bookings([i for i in booking_ids if i not in done]):
+        if b['status'] == 'scheduled' and b['end_ts'] is not None:
+            await jobs.enqueue(JOB_KIND, b['id'], b['end_ts'] + GRACE_PERIOD_MINUTES * 60)
+
+
+jobs.register(JOB_KIND, _complete_due, batch=True)
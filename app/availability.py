@@ -0,0 +1,445 @@
+"""Compiled availability engine behind scheduler.generate_slots.
+
+master_schedule, master_exceptions and master_settings are compiled once into
+an in-memory template per master. A day's bookings are kept as an occupancy
+bitmap (bit ``m`` set = minute ``m`` after midnight is booked), so checking
+all candidate slots of a day takes a few big-int operations instead of
+comparing every slot against every booking.
+
+Finished slot lists are cached per (master, date) and (duration, buffer).
+
+Writers must call the invalidation functions when their change commits
+(``app.db.on_commit`` inside the write operation):
+``invalidate_schedule`` for schedule/exception/settings changes and
+``invalidate_bookings`` / ``invalidate_span`` for anything that adds, removes
+or moves a booking. Results computed while an invalidation happened are not
+cached, so no slot list that predates a commit is served after it. Commits of
+other bot processes drop the whole engine (app.db.check_external_writes).
+"""
+import asyncio
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+
+from app import metrics
+from app.db import get_db, _get_pool, check_external_writes, external_write_listeners
+from app.scheduler import (
+    hhmm_to_minutes, minutes_to_hhmm, to_ts,
+    DEFAULT_WORK_DAYS, DEFAULT_START_TIME, DEFAULT_END_TIME,
+)
+
+# cached (master_id, date) occupancy bitmaps
+MAX_CACHED_DAYS = 4096
+# cached (master_id, date) entries of finished slot lists
+MAX_CACHED_SLOT_DAYS = 4096
+# master ids per IN (...) query, well below SQLite's bound-parameter limit
+IN_CHUNK = 500
+
+
+class MasterTemplate:
+    """Working hours of one master as compiled from the schedule tables."""
+    __slots__ = ('weekdays', 'work_days', 'fallback', 'buffer', 'exceptions', 'work_info')
+
+    def __init__(self, rows, buffer_minutes=0, exceptions=None):
+        # rows: this master's master_schedule rows ordered by weekday, id
+        self.weekdays = {}
+        for r in rows:
+            if r['weekday'] in self.weekdays:
+                continue
+            if r['start_time'] and r['end_time']:
+                self.weekdays[r['weekday']] = (hhmm_to_minutes(r['start_time']), hhmm_to_minutes(r['end_time']), r['slot_interval_minutes'] or None)
+            else:
+                # present but incomplete: generate_slots falls back to work info
+                self.weekdays[r['weekday']] = None
+        if rows:
+            self.work_days = frozenset(r['weekday'] for r in rows)
+            starts = [r['start_time'] for r in rows if r['start_time']]
+            ends = [r['end_time'] for r in rows if r['end_time']]
+            ints = [r['slot_interval_minutes'] for r in rows if r['slot_interval_minutes']]
+            start_time = min(starts) if starts else DEFAULT_START_TIME
+            end_time = max(ends) if ends else DEFAULT_END_TIME
+            interval = ints[0] if ints else None
+        else:
+            self.work_days = frozenset(DEFAULT_WORK_DAYS)
+            start_time, end_time, interval = DEFAULT_START_TIME, DEFAULT_END_TIME, None
+        self.fallback = (hhmm_to_minutes(start_time), hhmm_to_minutes(end_time), interval)
+        # what scheduler.get_master_work_info reports (days, start, end, interval)
+        self.work_info = (tuple(sorted(self.work_days)), start_time, end_time, interval)
+        self.buffer = buffer_minutes or 0
+        # date -> (available, start_min|None, end_min|None)
+        self.exceptions = exceptions or {}
+
+    def window(self, date_s: str, service_duration: int, buffer_min: int):
+        """Return (start_min, end_min, step) for the day, or None if not working."""
+        default_step = service_duration + buffer_min
+        exc = self.exceptions.get(date_s)
+        if exc is not None:
+            available, start, end = exc
+            if available == 0:
+                return None
+            if start is not None and end is not None:
+                return start, end, default_step
+        wd = datetime.fromisoformat(date_s).weekday()
+        day = self.weekdays.get(wd)
+        if day is not None:
+            start, end, interval = day
+            return start, end, interval or default_step
+        if wd not in self.work_days:
+            return None
+        start, end, interval = self.fallback
+        return start, end, interval or default_step
+
+
+def blocked_starts(occupancy: int, duration: int) -> int:
+    """Bitmap of start minutes whose [start, start+duration) hits a booked minute."""
+    blocked = occupancy
+    width = 1
+    while width < duration:
+        shift = min(width, duration - width)
+        blocked |= blocked >> shift
+        width += shift
+    return blocked
+
+
+def free_slots(occupancy: int, start_min: int, end_min: int, step: int, duration: int):
+    """Slot start minutes in [start_min, end_min - duration] on a ``step`` grid that are free."""
+    if step <= 0:
+        return []
+    blocked = blocked_starts(occupancy, duration)
+    return [m for m in range(start_min, end_min - duration + 1, step) if not (blocked >> m) & 1]
+
+
+class _Engine:
+    def __init__(self, pool):
+        self.pool = pool
+        self.templates = None
+        self.template_version = 0
+        self.booking_version = 0
+        self.days = OrderedDict()
+        # (master_id, date) -> {(duration, buffer): slots}
+        self.slots = OrderedDict()
+        self._compile_lock = asyncio.Lock()
+
+    async def template(self, master_id: int) -> MasterTemplate:
+        templates = self.templates
+        if templates is None:
+            async with self._compile_lock:
+                templates = self.templates
+                if templates is None:
+                    templates = await self._compile()
+        return templates.get(master_id) or _EMPTY_TEMPLATE
+
+    async def _compile(self):
+        version = self.template_version
+        async with get_db() as db:
+            cur = await db.execute('SELECT master_id, weekday, start_time, end_time, slot_interval_minutes FROM master_schedule ORDER BY master_id, weekday, id')
+            schedules = {}
+            for r in await cur.fetchall():
+                schedules.setdefault(r['master_id'], []).append(r)
+            cur = await db.execute('SELECT master_id, date, available, start_time, end_time FROM master_exceptions')
+            exceptions = {}
+            for r in await cur.fetchall():
+                both = r['start_time'] and r['end_time']
+                exceptions.setdefault(r['master_id'], {})[r['date']] = (
+                    r['available'],
+                    hhmm_to_minutes(r['start_time']) if both else None,
+                    hhmm_to_minutes(r['end_time']) if both else None,
+                )
+            cur = await db.execute('SELECT master_id, buffer_minutes FROM master_settings ORDER BY id')
+            buffers = {}
+            for r in await cur.fetchall():
+                buffers.setdefault(r['master_id'], r['buffer_minutes'])
+        templates = {
+            mid: MasterTemplate(schedules.get(mid, ()), buffers.get(mid), exceptions.get(mid))
+            for mid in set(schedules) | set(exceptions) | set(buffers)
+        }
+        metrics.incr('availability.compiles')
+        # a schedule write that committed meanwhile invalidated this result
+        if version == self.template_version:
+            self.templates = templates
+        return templates
+
+    async def occupancy(self, master_id: int, date_s: str) -> int:
+        return (await self.occupancy_days([(master_id, date_s)]))[(master_id, date_s)]
+
+    async def occupancy_many(self, master_ids, date_s: str) -> dict:
+        """{master_id: bitmap} for one day; uncached masters share one query per chunk."""
+        days = await self.occupancy_days([(mid, date_s) for mid in master_ids])
+        return {mid: days[(mid, date_s)] for mid in master_ids}
+
+    async def occupancy_days(self, keys) -> dict:
+        """{(master_id, date): bitmap} for any set of master days.
+
+        Uncached days are loaded with one range query per chunk of masters
+        spanning the earliest to the latest requested date.
+        """
+        result = {}
+        missing = []
+        for key in keys:
+            bits = self.days.get(key)
+            if bits is None:
+                missing.append(key)
+            else:
+                self.days.move_to_end(key)
+                result[key] = bits
+        metrics.incr('availability.day_hits', len(result))
+        if not missing:
+            return result
+        metrics.incr('availability.day_misses', len(missing))
+        version = self.booking_version
+        loaded = dict.fromkeys(missing, 0)
+        dates = {to_ts(date_s): date_s for date_s in {date_s for _, date_s in missing}}
+        span_start = min(dates)
+        span_end = max(dates) + 86400
+        masters = list(dict.fromkeys(mid for mid, _ in missing))
+        async with get_db() as db:
+            for i in range(0, len(masters), IN_CHUNK):
+                chunk = masters[i:i + IN_CHUNK]
+                marks = ','.join('?' * len(chunk))
+                cur = await db.execute(
+                    f"SELECT master_id, start_ts, end_ts FROM bookings WHERE master_id IN ({marks}) "
+                    f"AND status='scheduled' AND start_ts<? AND end_ts>?", (*chunk, span_end, span_start))
+                for mid, start_ts, end_ts in await cur.fetchall():
+                    # a booking may touch more than one requested day
+                    day_start = start_ts - start_ts % 86400
+                    while day_start < end_ts:
+                        key = (mid, dates.get(day_start))
+                        if key in loaded:
+                            start = max(0, (start_ts - day_start) // 60)
+                            end = min(1440, (end_ts - day_start) // 60)
+                            if end > start:
+                                loaded[key] |= ((1 << (end - start)) - 1) << start
+                        day_start += 86400
+        if version == self.booking_version:
+            for key, bits in loaded.items():
+                self.days[key] = bits
+            while len(self.days) > MAX_CACHED_DAYS:
+                self.days.popitem(last=False)
+        result.update(loaded)
+        return result
+
+
+_EMPTY_TEMPLATE = MasterTemplate(())
+_EPOCH = date(1970, 1, 1)
+_engine = None
+
+
+async def _get_engine() -> _Engine:
+    global _engine
+    # bookings and schedules may have been changed by another bot process
+    await check_external_writes()
+    pool = await _get_pool()
+    if _engine is None or _engine.pool is not pool:
+        _engine = _Engine(pool)
+    return _engine
+
+
+def _cached_slots(engine: _Engine, master_id: int, date_s: str, variant):
+    lists = engine.slots.get((master_id, date_s))
+    slots = lists.get(variant) if lists is not None else None
+    if slots is None:
+        metrics.incr('availability.slot_misses')
+        return None
+    engine.slots.move_to_end((master_id, date_s))
+    metrics.incr('availability.slot_hits')
+    return list(slots)
+
+
+def _store_slots(engine: _Engine, versions, master_id: int, date_s: str, variant, slots):
+    # a write that committed while these were computed invalidated them
+    if versions != (engine.template_version, engine.booking_version):
+        return
+    engine.slots.setdefault((master_id, date_s), {})[variant] = tuple(slots)
+    engine.slots.move_to_end((master_id, date_s))
+    while len(engine.slots) > MAX_CACHED_SLOT_DAYS:
+        engine.slots.popitem(last=False)
+
+
+async def get_slots(master_id: int, date_s: str, service_duration: int, buffer_min: int = None):
+    """Free slot start times ('HH:MM') for a service of ``service_duration`` minutes.
+
+    ``buffer_min`` defaults to the master's buffer_minutes from master_settings.
+    """
+    engine = await _get_engine()
+    versions = (engine.template_version, engine.booking_version)
+    template = await engine.template(master_id)
+    if buffer_min is None:
+        buffer_min = template.buffer
+    variant = (service_duration, buffer_min)
+    slots = _cached_slots(engine, master_id, date_s, variant)
+    if slots is not None:
+        return slots
+    window = template.window(date_s, service_duration, buffer_min)
+    if window is None:
+        slots = []
+    else:
+        start_min, end_min, step = window
+        occupancy = await engine.occupancy(master_id, date_s)
+        slots = [minutes_to_hhmm(m) for m in free_slots(occupancy, start_min, end_min, step, service_duration)]
+    _store_slots(engine, versions, master_id, date_s, variant, slots)
+    return slots
+
+
+async def get_slots_for_masters(master_ids, date_s: str, service_duration: int, buffer_min: int = None):
+    """{master_id: slots} for several masters on one date with a fixed number of queries."""
+    engine = await _get_engine()
+    versions = (engine.template_version, engine.booking_version)
+    master_ids = list(dict.fromkeys(master_ids))
+    result = {}
+    windows = {}
+    for mid in master_ids:
+        template = await engine.template(mid)
+        variant = (service_duration, template.buffer if buffer_min is None else buffer_min)
+        slots = _cached_slots(engine, mid, date_s, variant)
+        if slots is not None:
+            result[mid] = slots
+            continue
+        window = template.window(date_s, service_duration, variant[1])
+        if window is None:
+            result[mid] = []
+            _store_slots(engine, versions, mid, date_s, variant, [])
+        else:
+            windows[mid] = (window, variant)
+    occupancy = await engine.occupancy_many(list(windows), date_s) if windows else {}
+    for mid, ((start_min, end_min, step), variant) in windows.items():
+        result[mid] = [minutes_to_hhmm(m) for m in free_slots(occupancy[mid], start_min, end_min, step, service_duration)]
+        _store_slots(engine, versions, mid, date_s, variant, result[mid])
+    return {mid: result[mid] for mid in master_ids}
+
+
+async def _horizon_windows(engine: _Engine, master_ids, date_from: str, days: int, service_duration: int, buffer_min: int = None):
+    """({(master_id, date): window} grouped by date, {date: day start ts}) for a range of days."""
+    templates = [(mid, await engine.template(mid)) for mid in dict.fromkeys(master_ids)]
+    first = date.fromisoformat(date_from)
+    day_starts = {}
+    windows = {}
+    for i in range(days):
+        date_s = (first + timedelta(days=i)).isoformat()
+        day_starts[date_s] = to_ts(date_s)
+        for mid, template in templates:
+            window = template.window(date_s, service_duration, template.buffer if buffer_min is None else buffer_min)
+            if window is not None:
+                windows[(mid, date_s)] = window
+    return windows, day_starts
+
+
+def _free_minutes(occupancy: int, window, service_duration: int, day_start: int, not_before: int = None):
+    start_min, end_min, step = window
+    slots = free_slots(occupancy, start_min, end_min, step, service_duration)
+    if not_before is not None and not_before > day_start:
+        cutoff = -((day_start - not_before) // 60)
+        slots = [m for m in slots if m >= cutoff]
+    return slots
+
+
+async def next_free_slots(master_ids, date_from: str, days: int, service_duration: int, limit: int,
+                          buffer_min: int = None, not_before: int = None):
+    """Earliest ``limit`` free slots of any of ``master_ids`` within ``days`` days from ``date_from``.
+
+    Returns [(date, 'HH:MM', master_id)] ordered by date, time and the order of
+    ``master_ids``. Working windows come from the compiled templates and the
+    bookings of the whole horizon from one range query. Slots starting before
+    ``not_before`` (to_ts scale) are skipped.
+    """
+    engine = await _get_engine()
+    windows, day_starts = await _horizon_windows(engine, master_ids, date_from, days, service_duration, buffer_min)
+    if not windows or limit <= 0:
+        return []
+    occupancy = await engine.occupancy_days(windows)
+    found = []
+    day = []
+    for (mid, date_s), window in windows.items():
+        if day and day[0][0] != date_s:
+            # windows are grouped by date, so an earlier day is complete
+            found.extend(sorted(day, key=lambda s: s[1]))
+            day = []
+            if len(found) >= limit:
+                break
+        slots = _free_minutes(occupancy[(mid, date_s)], window, service_duration, day_starts[date_s], not_before)
+        day.extend((date_s, m, mid) for m in slots)
+    found.extend(sorted(day, key=lambda s: s[1]))
+    return [(date_s, minutes_to_hhmm(m), mid) for date_s, m, mid in found[:limit]]
+
+
+async def free_slot_counts(master_ids, date_from: str, days: int, service_duration: int,
+                           buffer_min: int = None, not_before: int = None) -> dict:
+    """{date: number of free slots over all ``master_ids``} for ``days`` days from ``date_from``.
+
+    Same single-pass inputs as next_free_slots; every day of the range is a key.
+    """
+    engine = await _get_engine()
+    windows, day_starts = await _horizon_windows(engine, master_ids, date_from, days, service_duration, buffer_min)
+    counts = dict.fromkeys(day_starts, 0)
+    if not windows:
+        return counts
+    occupancy = await engine.occupancy_days(windows)
+    for (mid, date_s), window in windows.items():
+        counts[date_s] += len(_free_minutes(occupancy[(mid, date_s)], window, service_duration, day_starts[date_s], not_before))
+    return counts
+
+
+async def work_info(master_id: int):
+    """(work_days, start_time, end_time, slot_interval) from the compiled template."""
+    engine = await _get_engine()
+    days, start_time, end_time, interval = (await engine.template(master_id)).work_info
+    return list(days), start_time, end_time, interval
+
+
+def _drop(cache: OrderedDict, master_id: int = None, date_s: str = None):
+    if master_id is None:
+        cache.clear()
+    elif date_s is not None:
+        cache.pop((master_id, date_s), None)
+    else:
+        for key in [k for k in cache if k[0] == master_id]:
+            del cache[key]
+
+
+def invalidate_schedule(master_id: int = None, date_s: str = None):
+    """Recompile templates after master_schedule/master_exceptions/master_settings change.
+
+    Cached slot lists are dropped for ``master_id`` (only ``date_s`` if given),
+    or for everyone when called without arguments.
+    """
+    engine = _engine
+    if engine is not None:
+        engine.templates = None
+        engine.template_version += 1
+        _drop(engine.slots, master_id, date_s)
+        metrics.incr('availability.invalidations')
+
+
+def invalidate_bookings(master_id: int = None, date_s: str = None):
+    """Drop cached occupancy for a master's day, a master, or (no args) everything."""
+    engine = _engine
+    if engine is None:
+        return
+    engine.booking_version += 1
+    _drop(engine.days, master_id, date_s)
+    _drop(engine.slots, master_id, date_s)
+    metrics.incr('availability.invalidations')
+
+
+def invalidate_span(master_id: int, start_ts: int, end_ts: int):
+    """invalidate_bookings for every day that [start_ts, end_ts) touches."""
+    day_start = start_ts - start_ts % 86400
+    while True:
+        invalidate_bookings(master_id, (_EPOCH + timedelta(days=day_start // 86400)).isoformat())
+        day_start += 86400
+        if day_start >= end_ts:
+            break
+
+
+def _external_write():
+    # anything may have changed: templates and occupancy alike
+    engine = _engine
+    if engine is None:
+        return
+    engine.templates = None
+    engine.template_version += 1
+    engine.booking_version += 1
+    engine.days.clear()
+    engine.slots.clear()
+    metrics.incr('availability.invalidations')
+
+
+external_write_listeners.append(_external_write)
@@ -6,7 +6,7 @@ from app.handlers.client import router as client_router
 from app.handlers.admin import router as admin_router
 from app.handlers.booking import router as booking_router
 from app.handlers.services import router as services_router
-from app.db import init_db
+from app.db import init_db, close_db
 
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 
@@ -16,6 +16,15 @@ async def start_bot():
 
     # init db
     await init_db()
+    # complete bookings that finished while the bot was down (one set-based
+    # pass), then re-arm reminders and auto-completions of the rest
+    from app.auto_complete import complete_overdue
+    from app.jobs import rehydrate, start_runner, stop_runner
+    await complete_overdue()
+    await rehydrate()
+    # reminders and auto-completion run from the durable jobs table
+    # (handlers are registered by app.reminders / app.auto_complete)
+    start_runner()
 
     # Debug helper: log every incoming message (kept for future use but not globally registered)
     # This function is NOT registered globally to avoid intercepting button handlers
@@ -37,3 +46,5 @@ async def start_bot():
         await dp.start_polling(bot)
     finally:
         await bot.session.close()
+        await stop_runner()
+        await close_db()
@@ -1,23 +1,523 @@
 import aiosqlite
+import asyncio
+import logging
 import os
 import glob
+import random
+import sqlite3
+import time
 from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from pathlib import Path
+from app import metrics
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 MIGRATIONS_DIR = BASE_DIR / "migrations"
 
+# Upper bound on simultaneously open connections per database
+DEFAULT_POOL_SIZE = 5
+# Max queued write operations folded into one transaction by the writer
+DEFAULT_WRITE_BATCH = 64
+# The writer gives up acquiring the write lock after this long (DB_LOCK_DEADLINE_MS)
+DEFAULT_LOCK_DEADLINE_MS = 5000
+# SQLite's own busy wait on the writer connection is kept short (it blocks the
+# connection thread); longer waits are async backoff retries (DB_WRITER_BUSY_TIMEOUT_MS)
+DEFAULT_WRITER_BUSY_TIMEOUT_MS = 50
+# In-memory caches look for commits made by other processes at most this often (DB_EXTERNAL_CHECK_MS)
+DEFAULT_EXTERNAL_CHECK_MS = 1000
+LOCK_BACKOFF_MIN = 0.005
+LOCK_BACKOFF_MAX = 0.2
+
+
+class DatabaseBusy(sqlite3.OperationalError):
+    """The write lock could not be acquired before the deadline."""
+
 def _db_path():
     # Read DATABASE_URL via getenv so .env.local can override in demo setups
     return os.getenv('DATABASE_URL', 'sqlite:///./bot.db').replace('sqlite:///', '')
 
-async def init_db():
+def _int_setting(env: str, default: int, minimum: int = 1) -> int:
+    try:
+        return max(minimum, int(os.getenv(env, default)))
+    except ValueError:
+        return default
+
+def _pool_size(path: str) -> int:
+    # every connection to ':memory:' is a separate database, so share just one
+    if path == ':memory:':
+        return 1
+    return _int_setting('DB_POOL_SIZE', DEFAULT_POOL_SIZE)
+
+
+# Per-connection PRAGMA defaults; each can be overridden with the env var
+# named in the second column (e.g. DB_BUSY_TIMEOUT_MS=10000).
+PRAGMA_DEFAULTS = (
+    ('journal_mode', 'DB_JOURNAL_MODE', 'WAL'),
+    ('synchronous', 'DB_SYNCHRONOUS', 'NORMAL'),
+    ('busy_timeout', 'DB_BUSY_TIMEOUT_MS', '5000'),
+    ('cache_size', 'DB_CACHE_SIZE', '-16000'),
+    ('mmap_size', 'DB_MMAP_SIZE', '134217728'),
+    ('temp_store', 'DB_TEMP_STORE', 'MEMORY'),
+    # off by default: existing rows may reference users that were never
+    # created, and bookings have no ON DELETE action for masters/services
+    ('foreign_keys', 'DB_FOREIGN_KEYS', 'OFF'),
+)
+
+# PRAGMA values cannot be bound as parameters, so only accept known keywords
+_PRAGMA_KEYWORDS = {
+    'journal_mode': {'DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'},
+    'synchronous': {'OFF', 'NORMAL', 'FULL', 'EXTRA', '0', '1', '2', '3'},
+    'temp_store': {'DEFAULT', 'FILE', 'MEMORY', '0', '1', '2'},
+    'foreign_keys': {'ON', 'OFF', '1', '0', 'TRUE', 'FALSE'},
+}
+
+
+def _pragma_settings():
+    """Return [(pragma, value)] from env, skipping invalid values."""
+    settings = []
+    for name, env, default in PRAGMA_DEFAULTS:
+        value = str(os.getenv(env, default)).strip().upper()
+        allowed = _PRAGMA_KEYWORDS.get(name)
+        if allowed is not None:
+            if value not in allowed:
+                continue
+        else:
+            try:
+                value = str(int(value))
+            except ValueError:
+                continue
+        settings.append((name, value))
+    return settings
+
+
+async def _init_connection(conn):
+    """One-time setup for a freshly opened pooled connection."""
+    conn.row_factory = aiosqlite.Row
+    for name, value in _pragma_settings():
+        await conn.execute(f'PRAGMA {name}={value}')
+
+
+class ConnectionPool:
+    """Bounded pool of long-lived aiosqlite connections to one database.
+
+    Connections are opened lazily up to ``max_size`` and handed out LIFO so
+    the warmest connection is reused first. A pool belongs to the event loop
+    that created it; ``get_db`` swaps it out when the loop or path changes.
+    """
+
+    def __init__(self, path: str, max_size: int):
+        self.path = path
+        self.max_size = max_size
+        self.loop = asyncio.get_running_loop()
+        self._idle = []
+        self._size = 0
+        self._slots = asyncio.Semaphore(max_size)
+        self._closed = False
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def idle(self) -> int:
+        return len(self._idle)
+
+    async def _open(self):
+        conn = aiosqlite.connect(self.path)
+        # pooled connections outlive a single request; don't block interpreter exit
+        conn.daemon = True
+        await conn
+        try:
+            await _init_connection(conn)
+        except Exception:
+            await conn.close()
+            raise
+        return conn
+
+    async def acquire(self):
+        if self._closed:
+            raise RuntimeError('connection pool is closed')
+        await self._slots.acquire()
+        try:
+            if self._idle:
+                return self._idle.pop()
+            conn = await self._open()
+            self._size += 1
+            return conn
+        except BaseException:
+            self._slots.release()
+            raise
+
+    async def release(self, conn, discard: bool = False):
+        try:
+            if not discard and not self._closed:
+                try:
+                    # never hand out a connection with a dangling transaction
+                    if conn.in_transaction:
+                        await conn.rollback()
+                    self._idle.append(conn)
+                    return
+                except Exception:
+                    pass
+            self._size -= 1
+            try:
+                await conn.close()
+            except Exception:
+                pass
+        finally:
+            self._slots.release()
+
+    async def close(self):
+        self._closed = True
+        idle, self._idle = self._idle, []
+        for conn in idle:
+            self._size -= 1
+            try:
+                await conn.close()
+            except Exception:
+                pass
+
+
+class WriteQueue:
+    """Single writer task that applies queued write operations with group commit.
+
+    SQLite allows one writer at a time, so instead of every mutation opening
+    its own transaction, operations are queued and the writer folds whatever
+    is waiting (up to ``max_batch``) into one ``BEGIN IMMEDIATE ... COMMIT``.
+    Each operation runs under its own savepoint, so a failing operation is
+    rolled back alone and its exception is delivered to its caller only.
+    Results are delivered after the commit succeeds.
+    """
+
+    def __init__(self, pool: ConnectionPool, max_batch: int):
+        self.pool = pool
+        self.path = pool.path
+        self.loop = pool.loop
+        self.max_batch = max_batch
+        self.batches = 0
+        self.operations = 0
+        self._queue = asyncio.Queue()
+        self._task = None
+        self._conn = None
+        self._open_lock = asyncio.Lock()
+        self._closed = False
+
+    async def submit(self, op):
+        if self._closed:
+            raise RuntimeError('write queue is closed')
+        fut = self.loop.create_future()
+        self._queue.put_nowait((op, fut))
+        if self._task is None:
+            self._task = self.loop.create_task(self._run())
+        return await fut
+
+    async def _connection(self):
+        if self.path == ':memory:':
+            # a second ':memory:' connection would be a different database
+            return await self.pool.acquire()
+        async with self._open_lock:
+            if self._conn is None:
+                conn = await self.pool._open()
+                busy = _int_setting('DB_WRITER_BUSY_TIMEOUT_MS', DEFAULT_WRITER_BUSY_TIMEOUT_MS, minimum=0)
+                await conn.execute(f'PRAGMA busy_timeout={busy}')
+                self._conn = conn
+        return self._conn
+
+    async def data_version(self):
+        """PRAGMA data_version of the writer connection (None for ':memory:').
+
+        SQLite changes it only when another connection commits, so the
+        writer's own commits never move it.
+        """
+        if self.path == ':memory:':
+            return None
+        conn = await self._connection()
+        cur = await conn.execute('PRAGMA data_version')
+        return (await cur.fetchone())[0]
+
+    async def _begin(self, conn):
+        """BEGIN IMMEDIATE, retrying with jittered exponential backoff while locked."""
+        deadline_s = _int_setting('DB_LOCK_DEADLINE_MS', DEFAULT_LOCK_DEADLINE_MS, minimum=0) / 1000
+        started = time.monotonic()
+        delay = LOCK_BACKOFF_MIN
+        retries = 0
+        try:
+            while True:
+                try:
+                    await conn.execute('BEGIN IMMEDIATE')
+                    return
+                except sqlite3.OperationalError as e:
+                    msg = str(e).lower()
+                    if 'locked' not in msg and 'busy' not in msg:
+                        raise
+                    waited = time.monotonic() - started
+                    if waited >= deadline_s:
+                        metrics.incr('db.write.lock_timeouts')
+                        raise DatabaseBusy(f'database is locked: gave up after {waited * 1000:.0f} ms') from e
+                    retries += 1
+                    metrics.incr('db.write.lock_retries')
+                    # sleeping on the loop keeps other updates flowing meanwhile
+                    await asyncio.sleep(min(delay / 2 + random.uniform(0, delay / 2), deadline_s - waited))
+                    delay = min(delay * 2, LOCK_BACKOFF_MAX)
+        finally:
+            if retries:
+                metrics.observe('db.write.lock_wait_ms', (time.monotonic() - started) * 1000)
+
+    async def _run(self):
+        # drains the queue and exits; submit() starts a new run when idle
+        try:
+            while not self._queue.empty():
+                batch = [self._queue.get_nowait()]
+                while len(batch) < self.max_batch and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                try:
+                    await self._commit_batch(batch)
+                except asyncio.CancelledError:
+                    for _, fut in batch:
+                        if not fut.done():
+                            fut.cancel()
+                    raise
+        finally:
+            self._task = None
+
+    async def _commit_batch(self, batch):
+        batch = [(op, fut) for op, fut in batch if not fut.done()]
+        if not batch:
+            return
+        try:
+            conn = await self._connection()
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        token = _held.set((self.pool, conn, asyncio.current_task()))
+        outcomes = []
+        after_commit = []
+        try:
+            await self._begin(conn)
+            for op, fut in batch:
+                if fut.done():
+                    outcomes.append(None)
+                    continue
+                await conn.execute('SAVEPOINT write_op')
+                hooks = []
+                hooks_token = _commit_hooks.set(hooks)
+                try:
+                    result = await op(conn)
+                except Exception as e:
+                    await conn.execute('ROLLBACK TO write_op')
+                    await conn.execute('RELEASE write_op')
+                    outcomes.append((False, e))
+                else:
+                    await conn.execute('RELEASE write_op')
+                    outcomes.append((True, result))
+                    after_commit.extend(hooks)
+                finally:
+                    _commit_hooks.reset(hooks_token)
+            await conn.commit()
+            # before any caller resumes, so nobody can observe the commit without them
+            for callback in after_commit:
+                try:
+                    callback()
+                except Exception:
+                    logger.exception('after-commit callback failed')
+        except BaseException as e:
+            # BEGIN or COMMIT failed, or an op was cancelled or interrupted:
+            # nothing in this batch was persisted, and the (persistent) writer
+            # connection must not be left inside the transaction
+            try:
+                if conn.in_transaction:
+                    await conn.rollback()
+            except Exception:
+                pass
+            if not isinstance(e, Exception):
+                raise
+            outcomes = [(False, e)] * len(batch)
+        finally:
+            _held.reset(token)
+            if conn is not self._conn:
+                await self.pool.release(conn)
+        self.batches += 1
+        self.operations += len(batch)
+        for (_, fut), outcome in zip(batch, outcomes):
+            if outcome is None or fut.done():
+                continue
+            ok, value = outcome
+            if ok:
+                fut.set_result(value)
+            else:
+                fut.set_exception(value)
+
+    async def close(self):
+        self._closed = True
+        # a writer from a finished event loop was already cancelled with it
+        same_loop = self.loop is asyncio.get_running_loop()
+        task = self._task
+        if task is not None and same_loop:
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        while same_loop and not self._queue.empty():
+            _, fut = self._queue.get_nowait()
+            if not fut.done():
+                fut.cancel()
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            try:
+                await conn.close()
+            except Exception:
+                pass
+
+
+_pool = None
+_writer = None
+# (pool, connection, task) currently checked out by the running task, so
+# nested get_db() calls reuse it instead of taking a second pool slot
+_held = ContextVar('app_db_held', default=None)
+# after-commit callbacks of the write operation the writer is running
+_commit_hooks = ContextVar('app_db_commit_hooks', default=None)
+# callables run by check_external_writes when another process committed
+external_write_listeners = []
+_external_check = None  # (writer, last data_version, monotonic time of that check)
+
+logger = logging.getLogger(__name__)
+
+
+async def _get_pool() -> ConnectionPool:
+    global _pool
+    path = _db_path()
+    loop = asyncio.get_running_loop()
+    if _pool is not None and (_pool.path != path or _pool.loop is not loop):
+        stale, _pool = _pool, None
+        await stale.close()
+        if _writer is not None and _writer.pool is stale:
+            await _close_writer()
+    if _pool is None:
+        _pool = ConnectionPool(path, _pool_size(path))
+    return _pool
+
+
+async def _close_writer():
+    global _writer
+    writer, _writer = _writer, None
+    if writer is not None:
+        await writer.close()
+
+
+async def _get_writer() -> WriteQueue:
+    global _writer
+    pool = await _get_pool()
+    if _writer is not None and _writer.pool is not pool:
+        await _close_writer()
+    if _writer is None:
+        _writer = WriteQueue(pool, _int_setting('DB_WRITE_BATCH', DEFAULT_WRITE_BATCH))
+    return _writer
+
+
+async def run_write(op):
+    """Run ``await op(db)`` on the single writer connection and return its result.
+
+    ``op`` must not commit or roll back; the writer commits it together with
+    other queued operations. Exceptions raised by ``op`` propagate to the
+    caller and only that operation's changes are discarded.
+    """
+    writer = await _get_writer()
+    return await writer.submit(op)
+
+
+def on_commit(callback):
+    """Run ``callback()`` once the current write operation has committed.
+
+    Call it from inside an operation passed to ``run_write``: the writer runs
+    the callbacks of the committed operations right after COMMIT and before
+    their callers resume, and drops them if the operation is rolled back.
+    Outside a write operation the callback runs immediately.
+    """
+    hooks = _commit_hooks.get()
+    if hooks is None:
+        callback()
+    else:
+        hooks.append(callback)
+
+
+async def check_external_writes() -> bool:
+    """Run external_write_listeners if another process committed since the last check.
+
+    In-memory caches call this before serving a hit. Commits of this process
+    go through the writer and invalidate precisely via on_commit; those of
+    other bot processes only show up as a new PRAGMA data_version on the
+    writer connection. The pragma is read at most once per
+    DB_EXTERNAL_CHECK_MS, which bounds how long another process's change can
+    be missed. Returns True if the listeners ran.
+    """
+    global _external_check
+    writer = await _get_writer()
+    now = time.monotonic()
+    seen = _external_check
+    previous = seen[1] if seen is not None and seen[0] is writer else None
+    interval = _int_setting('DB_EXTERNAL_CHECK_MS', DEFAULT_EXTERNAL_CHECK_MS, minimum=0) / 1000
+    if previous is not None and now - seen[2] < interval:
+        return False
+    # concurrent callers skip the check while this one reads the pragma
+    _external_check = (writer, previous, now)
+    version = await writer.data_version()
+    _external_check = (writer, version, now)
+    if previous is None or version == previous:
+        return False
+    metrics.incr('db.external_writes')
+    for listener in external_write_listeners:
+        try:
+            listener()
+        except Exception:
+            logger.exception('external-write listener failed')
+    return True
+
+
+async def close_db():
+    """Stop the writer and close all pooled connections. Called on bot shutdown."""
+    global _pool
+    await _close_writer()
+    pool, _pool = _pool, None
+    if pool is not None:
+        await pool.close()
+
+
+async def _dry_run(path: str):
+    """List pending migrations through a read-only connection.
+
+    Not a pooled connection: _init_connection would set the journal mode
+    (and so create or modify the file). A missing file is left missing.
+    """
+    from app.migrations import migrate, discover
+
+    if not os.path.exists(path):
+        return discover(MIGRATIONS_DIR)
+    conn = await aiosqlite.connect(f'{Path(path).resolve().as_uri()}?mode=ro', uri=True)
+    try:
+        conn.row_factory = aiosqlite.Row
+        return await migrate(conn, MIGRATIONS_DIR, dry_run=True)
+    finally:
+        await conn.close()
+
+
+async def init_db(dry_run: bool = False):
+    """Bring the schema up to date; returns the migrations applied (or pending on dry run)."""
+    from app.migrations import migrate
+
     files = sorted(MIGRATIONS_DIR.glob("*.sql"))
+    path = _db_path()
+    if dry_run and files and path != ':memory:':
+        return await _dry_run(path)
 
-    async with aiosqlite.connect(_db_path()) as db:
+    async with get_db() as db:
 
         if not files:
             # fallback for CI/tests
+            if dry_run:
+                return []
             await db.executescript("""
             CREATE TABLE IF NOT EXISTS bookings (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -31,24 +531,24 @@ async def init_db():
                 status TEXT DEFAULT 'active'
             );
             """)
-        else:
-            for p in files:
-                sql = p.read_text(encoding="utf-8")
-                try:
-                    await db.executescript(sql)
-                except Exception as e:
-                    msg = str(e).lower()
-                    if 'duplicate column' in msg or 'already exists' in msg:
-                        continue
-                    raise
+            await db.commit()
+            return []
 
-        await db.commit()
+        return await migrate(db, MIGRATIONS_DIR, dry_run=dry_run)
 
 @asynccontextmanager
 async def get_db():
-    conn = await aiosqlite.connect(_db_path())
-    conn.row_factory = aiosqlite.Row
+    """Check out a pooled connection for the duration of the block."""
+    task = asyncio.current_task()
+    held = _held.get()
+    if held is not None and held[2] is task and not held[0]._closed and held[0].path == _db_path():
+        yield held[1]
+        return
+    pool = await _get_pool()
+    conn = await pool.acquire()
+    token = _held.set((pool, conn, task))
     try:
         yield conn
     finally:
-        await conn.close()
+        _held.reset(token)
+        await pool.release(conn)
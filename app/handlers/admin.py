@@ -332,6 +332,26 @@ async def cmd_export_reviews(message: Message):
     except Exception as e:
         await message.answer('Ошибка экспорта: ' + str(e))
 
+@router.message(Command('stats'))
+async def cmd_stats(message: Message):
+    if not is_admin(message.from_user.id):
+        await message.answer('Доступ запрещён')
+        return
+    from app import metrics
+    await message.answer('Статистика:\n' + metrics.format_snapshot())
+
+@router.message(Command('rebuild_ratings'))
+async def cmd_rebuild_ratings(message: Message):
+    if not is_admin(message.from_user.id):
+        await message.answer('Доступ запрещён')
+        return
+    from app.repo import rebuild_rating_stats
+    try:
+        rows = await rebuild_rating_stats()
+        await message.answer(f'Рейтинги пересчитаны: {rows} записей')
+    except Exception as e:
+        await message.answer('Ошибка пересчёта рейтингов: ' + str(e))
+
 @router.message(Command('delete_master'))
 async def cmd_delete_master(message: Message):
     if not is_admin(message.from_user.id):
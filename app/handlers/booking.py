@@ -1,16 +1,19 @@
+import logging
 from aiogram import Router
 from aiogram.types import CallbackQuery, Message
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.filters import StateFilter
-from app.repo import get_or_create_user, create_booking, list_masters, SlotTaken, DoubleBooking, get_service, average_rating_for_master
+from app.repo import get_or_create_user, create_booking, list_masters, SlotTaken, DoubleBooking, get_service, average_ratings_for_masters
 from app.utils import valid_phone, format_rating
+from app.locks import booking_locks
 
 # Для автозавершения
 from app.auto_complete import schedule_auto_complete
 from app.reminders import schedule_reminders
 
 router = Router()
+logger = logging.getLogger(__name__)
 
 class BookingStates(StatesGroup):
     SERVICE = State()
@@ -102,6 +105,35 @@ async def _get_state(ctx: FSMContext):
             pass
         return s
 
+
+async def _next_slots_kb(service_id, master_id=None, date_from=None):
+    """Inline keyboard with the earliest free slots (book:slot:<master>:<date>:<time>), or None."""
+    from app.scheduler import find_next_slots
+    from app.repo import get_master
+    from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+    found = await find_next_slots(service_id, master_id, date_from=date_from)
+    if not found:
+        return None
+    rows = []
+    for date_s, time_s, mid in found:
+        label = f'{date_s} {time_s}'
+        if not master_id:
+            m = await get_master(mid)
+            if m:
+                label = f"{label} — {m['name']}"
+        rows.append([InlineKeyboardButton(text=label, callback_data=f'book:slot:{mid}:{date_s}:{time_s}')])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+async def _calendar_kb(service_id, master_id=None, year=None, month=None):
+    """Month calendar for the booking flow; the current month by default."""
+    from datetime import date
+    from app.scheduler import month_free_slot_counts
+    from app.keyboards import booking_calendar_kb
+    today = date.today()
+    year, month = year or today.year, month or today.month
+    counts = await month_free_slot_counts(service_id, year, month, master_id)
+    return booking_calendar_kb(year, month, counts, today)
+
 @router.callback_query(lambda q: q.data and q.data.startswith('book:service:'))
 async def cb_select_service(query: CallbackQuery, state: FSMContext):
     service_id = int(query.data.split(':')[-1])
@@ -127,8 +159,9 @@ async def cb_select_service(query: CallbackQuery, state: FSMContext):
     text = 'Выберите мастера или без выбора:'
     from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
     buttons = []
+    ratings = await average_ratings_for_masters(m['id'] for m in masters)
     for m in masters:
-        avg, cnt = await average_rating_for_master(m['id'])
+        avg, cnt = ratings[m['id']]
         rating = format_rating(avg, cnt)
         label = m['name']
         if rating:
@@ -182,7 +215,26 @@ async def cb_select_master(query: CallbackQuery, state: FSMContext):
         await query.message.answer(f'Мастер работает: {days_str}, {start_time}–{end_time}')
     except Exception:
         pass
-    await query.message.answer('📅 Введите дату визита в формате ГГГГ-ММ-ДД. Пример: 2026-01-15')
+    # offer the nearest free slots so the user does not have to guess a date
+    try:
+        kb = await _next_slots_kb((await state.get_data()).get('service_id'), master_id)
+        if kb:
+            await query.message.answer('⏱ Ближайшее свободное время:', reply_markup=kb)
+    except Exception as e:
+        try:
+            print('find_next_slots error:', e)
+        except Exception:
+            pass
+    # calendar with per-day free slot counts; typing a date still works
+    calendar_kb = None
+    try:
+        calendar_kb = await _calendar_kb((await state.get_data()).get('service_id'), master_id)
+    except Exception as e:
+        try:
+            print('calendar error:', e)
+        except Exception:
+            pass
+    await query.message.answer('📅 Выберите день в календаре (в скобках — число свободных окон).\nВведите дату визита вручную в формате ГГГГ-ММ-ДД, если так удобнее. Пример: 2026-01-15', reply_markup=calendar_kb)
     await _set_state(state, BookingStates.DATE)
     # dump state after setting for diagnostic
     try:
@@ -350,7 +402,15 @@ async def process_date(message: Message, state: FSMContext):
             pass
         await message.answer('Неверный формат даты. Попробуйте YYYY-MM-DD')
         return
+    await _offer_date(message, state, date_s, message.from_user.id)
+
+
+async def _offer_date(message: Message, state: FSMContext, date_s: str, user_id: int):
+    """Show free times (or masters with free times) for a chosen date.
 
+    Shared by the typed date (process_date) and the calendar (cb_pick_date);
+    ``message`` is where replies go, ``user_id`` who picked the date.
+    """
     # Check that the message author is the same user who initiated booking flow
     data = await state.get_data()
     try:
@@ -359,9 +419,9 @@ async def process_date(message: Message, state: FSMContext):
         pass
 
     initiator = data.get('booking_user_id')
-    if initiator and initiator != message.from_user.id:
+    if initiator and initiator != user_id:
         try:
-            print('process_date returning: user mismatch, initiator:', initiator, 'message user:', message.from_user.id)
+            print('process_date returning: user mismatch, initiator:', initiator, 'message user:', user_id)
         except Exception:
             pass
         await message.answer('Похоже, вы используете другой аккаунт, чем тот, что начинал бронирование. Пожалуйста, нажмите "Записаться" ещё раз в своём аккаунте.')
@@ -389,7 +449,7 @@ async def process_date(message: Message, state: FSMContext):
     master_id = data.get('master_id')
     svc_id = data.get('service_id')
     from app.repo import list_masters, get_service
-    from app.scheduler import generate_slots
+    from app.scheduler import generate_slots, generate_slots_for_masters
 
     svc = await get_service(svc_id)
     if not svc:
@@ -403,19 +463,15 @@ async def process_date(message: Message, state: FSMContext):
     if master_id == 0 or master_id is None:
         # show masters who have slots on that date
         masters = await list_masters()
-        masters_with = []
-        for m in masters:
+        try:
+            slots_by_master = await generate_slots_for_masters([m['id'] for m in masters], date_s, svc['duration_minutes'])
+        except Exception as e:
             try:
-                slots = await generate_slots(m['id'], date_s, svc['duration_minutes'])
-            except Exception as e:
-                try:
-                    print('generate_slots error:', e)
-                except Exception:
-                    pass
-                # skip this master on error
-                continue
-            if slots:
-                masters_with.append((m, slots))
+                print('generate_slots error:', e)
+            except Exception:
+                pass
+            slots_by_master = {}
+        masters_with = [(m, slots_by_master[m['id']]) for m in masters if slots_by_master.get(m['id'])]
         if not masters_with:
             try:
                 print('process_date returning: no masters_with slots')
@@ -430,19 +486,20 @@ async def process_date(message: Message, state: FSMContext):
             return
         from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
         rows = []
+        # Also show masters with zero slots as option for manual request
+        all_masters = masters
+        ratings = await average_ratings_for_masters(m['id'] for m in all_masters)
         for m, slots in masters_with:
-            avg, cnt = await average_rating_for_master(m['id'])
+            avg, cnt = ratings.get(m['id'], (0.0, 0))
             rating = format_rating(avg, cnt)
             label = f"{m['name']} ({len(slots)}), выбрать"
             if rating:
                 label = f"{m['name']} {rating} ({len(slots)}), выбрать"
             # fixed callback_data quoting to avoid nested single-quote syntax error
             rows.append([InlineKeyboardButton(text=label, callback_data=f"book:master_choose:{m['id']}")])
-        # Also show masters with zero slots as option for manual request
-        all_masters = await list_masters()
         for m in all_masters:
             if not any(m2['id'] == m['id'] for m2, _ in masters_with):
-                avg, cnt = await average_rating_for_master(m['id'])
+                avg, cnt = ratings.get(m['id'], (0.0, 0))
                 rating = format_rating(avg, cnt)
                 label = f"{m['name']} (❌ занято) — запросить"
                 if rating:
@@ -515,6 +572,14 @@ async def process_date(message: Message, state: FSMContext):
             print('process_date returning: no slots for specific master', master_id)
         except Exception:
             pass
+        kb = None
+        try:
+            kb = await _next_slots_kb(svc_id, master_id, date_from=date_s)
+        except Exception:
+            pass
+        if kb:
+            await message.answer('К сожалению, у выбранного мастера нет слотов на этот день. Ближайшее свободное время:', reply_markup=kb)
+            return
         await message.answer('К сожалению, у выбранного мастера нет слотов на этот день. Попробуйте другую дату или мастера.')
         return
     from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
@@ -533,6 +598,42 @@ async def cb_select_time(query: CallbackQuery, state: FSMContext):
     await _set_state(state, BookingStates.NAME)
     await query.answer("")
 
+@router.callback_query(lambda q: q.data and q.data.startswith('book:date:'))
+async def cb_pick_date(query: CallbackQuery, state: FSMContext):
+    date_s = query.data.split(':')[-1]
+    await _offer_date(query.message, state, date_s, query.from_user.id)
+    await query.answer("")
+
+@router.callback_query(lambda q: q.data and q.data.startswith('book:cal:'))
+async def cb_calendar_page(query: CallbackQuery, state: FSMContext):
+    value = query.data.split(':')[-1]
+    if value == 'none':
+        await query.answer("")
+        return
+    year, month = (int(p) for p in value.split('-'))
+    data = await state.get_data()
+    kb = await _calendar_kb(data.get('service_id'), data.get('master_id'), year, month)
+    try:
+        await query.message.edit_reply_markup(reply_markup=kb)
+    except Exception:
+        await query.message.answer('📅 Выберите день:', reply_markup=kb)
+    await query.answer("")
+
+@router.callback_query(lambda q: q.data and q.data.startswith('book:slot:'))
+async def cb_select_slot(query: CallbackQuery, state: FSMContext):
+    # book:slot:<master_id>:<date>:<HH:MM> offered by _next_slots_kb
+    _, _, mid, date_s, time_s = query.data.split(':', 4)
+    # same initiator check as _offer_date: the button may be pressed from another account
+    initiator = (await state.get_data()).get('booking_user_id')
+    if initiator and initiator != query.from_user.id:
+        await query.message.answer('Похоже, вы используете другой аккаунт, чем тот, что начинал бронирование. Пожалуйста, нажмите "Записаться" ещё раз в своём аккаунте.')
+        await query.answer("")
+        return
+    await state.update_data(master_id=int(mid), date=date_s, time=time_s)
+    await query.message.answer('👤 Введите ваше имя:')
+    await _set_state(state, BookingStates.NAME)
+    await query.answer("")
+
 @router.message(StateFilter(BookingStates.TIME))
 async def process_time(message: Message, state: FSMContext):
     time_s = message.text.strip()
@@ -574,25 +675,23 @@ async def cb_confirm(query: CallbackQuery, state: FSMContext):
         return
     data = await state.get_data()
     user = await get_or_create_user(query.from_user.id, name=data.get('name'), phone=data.get('phone'))
+    master_id = data['master_id'] if data['master_id'] != 0 else None
     try:
-        await create_booking(user['id'], data['service_id'], data['master_id'] if data['master_id'] != 0 else None, data['date'], data['time'], data['name'], data['phone'])
-        # Получаем длительность услуги и id бронирования (поиск по данным)
+        # one confirmation per master/day at a time; create_booking re-enters the lock
+        async with booking_locks.hold((master_id, data['date'])):
+            booking_id = await create_booking(user['id'], data['service_id'], master_id, data['date'], data['time'], data['name'], data['phone'])
+        # Получаем длительность услуги (из кэша каталога)
         service = await get_service(data['service_id'])
         duration = service['duration_minutes'] if service and 'duration_minutes' in service else 30
-        # Получаем id только что созданной записи (по уникальным данным)
-        from app.repo import list_bookings
-        bookings = await list_bookings()
-        booking_id = None
-        for b in bookings:
-            if b['user_id'] == user['id'] and b['service_id'] == data['service_id'] and b['date'] == data['date'] and b['time'] == data['time']:
-                booking_id = b['id']
-                break
-        if booking_id:
-            schedule_auto_complete(booking_id, data['date'], data['time'], duration)
-            try:
-                schedule_reminders(booking_id, data['date'], data['time'])
-            except Exception:
-                pass
+        # the booking is committed; a missing job is recreated by rehydrate on the next start
+        try:
+            await schedule_auto_complete(booking_id, data['date'], data['time'], duration)
+        except Exception:
+            logger.exception('scheduling auto-completion of booking %s failed', booking_id)
+        try:
+            await schedule_reminders(booking_id, data['date'], data['time'])
+        except Exception:
+            logger.exception('scheduling reminders of booking %s failed', booking_id)
     except SlotTaken:
         await query.message.answer('😔 Извините, это время уже занято. Попробуйте выбрать другое.')
         await state.clear()
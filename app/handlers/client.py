@@ -1,7 +1,7 @@
 from aiogram import Router
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.filters import Command
-from app.repo import list_services, average_rating_for_service, list_bookings, get_or_create_user, get_service, get_master
+from app.repo import list_services, average_ratings_for_services, list_bookings, get_or_create_user, get_service, get_master
 from app.utils import format_rating
 from aiogram.types import CallbackQuery
 from app.keyboards import main_menu_kb
@@ -22,8 +22,9 @@ async def show_services(message: Message):
         await message.answer('😔 Пока нет доступных услуг. Администратор скоро добавит. Попробуйте позже!')
         return
     rows = []
+    ratings = await average_ratings_for_services(s['id'] for s in services)
     for s in services:
-        avg, cnt = await average_rating_for_service(s['id'])
+        avg, cnt = ratings[s['id']]
         rating_str = format_rating(avg, cnt)
         btn_text = f"{s['name']} — {s['price']}"
         rows.append([InlineKeyboardButton(text=btn_text, callback_data=f"book:service:{s['id']}")])
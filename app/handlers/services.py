@@ -2,7 +2,7 @@ from aiogram import Router
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from aiogram.filters import Command
 from app.repo import list_services
-from app.repo import average_rating_for_service
+from app.repo import average_ratings_for_services
 from app.utils import format_rating
 
 router = Router()
@@ -16,8 +16,9 @@ async def _build_services_page(services, page: int):
     from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
     kb_rows = []
     text_lines = []
+    ratings = await average_ratings_for_services(s['id'] for s in page_items)
     for s in page_items:
-        avg, cnt = await average_rating_for_service(s['id'])
+        avg, cnt = ratings[s['id']]
         rating_str = format_rating(avg, cnt)
         text = f"{s['name']} — {s['price']}\n"
         if rating_str:
@@ -0,0 +1,444 @@
+"""Durable job scheduler backed by the ``jobs`` table.
+
+A job is a (kind, booking_id, run_at) row; ``run_at`` uses the to_ts() scale.
+One in-process runner keeps only the jobs due within ``WINDOW`` seconds in a
+min-heap and sleeps until the earliest of them. A due job is claimed
+(pending -> running, attempts + 1) and later completed (done), retried with
+backoff (pending again) or given up (failed), each step in its own write
+transaction. Later jobs stay in the database until the window reaches them,
+so memory grows with near-term jobs only, and nothing is lost on restart.
+
+Several bot processes can share the table. A claim records the worker's
+``WORKER_ID`` and a lease of ``LEASE_SECONDS`` in the same UPDATE, so only one
+worker runs a job; the lease is renewed from the claim until the job
+finishes, also while it waits for a free handler slot, and the jobs of a
+worker that died are reclaimed by the others once its lease expires.
+Every ``POLL_INTERVAL`` seconds the runner reclaims expired leases and reloads
+the window, which also picks up jobs enqueued by other processes.
+
+Handlers are registered per kind with ``register``; app.reminders and
+app.auto_complete register theirs on import. A batch handler receives the
+booking ids of up to ``BATCH_SIZE`` jobs of its kind that fall due together,
+so it can read and write them with one query each.
+"""
+import asyncio
+import heapq
+import logging
+import os
+import socket
+import time
+import uuid
+
+from app import metrics
+from app.db import get_db, run_write, on_commit
+from app.scheduler import now_ts
+
+# how far ahead the runner keeps jobs in memory (seconds)
+WINDOW = 3600
+# max jobs loaded per window; the window shrinks to what fits
+LOAD_LIMIT = 1000
+MAX_ATTEMPTS = 3
+# first retry delay in seconds, doubled per attempt
+RETRY_DELAY = 60
+# handlers running at the same time
+CONCURRENCY = 8
+# done/cancelled/failed jobs are deleted this long after their run_at
+KEEP_FINISHED = 7 * 86400
+# jobs inserted per write transaction by rehydrate()
+REHYDRATE_BATCH = 500
+# jobs handed to one call of a batch handler
+BATCH_SIZE = 100
+# max ids per IN (...) list
+_IN_CHUNK = 500
+# a claimed job belongs to its worker this long; renewed every third of it.
+# lease_until is Unix time (time.time()): unlike the wall-clock to_ts() scale
+# of run_at it does not jump at DST changes, and workers compare it directly
+LEASE_SECONDS = 120
+# how often the runner reclaims expired leases and reloads the window
+POLL_INTERVAL = 60
+# first pause after a failed runner iteration (seconds), doubled up to POLL_INTERVAL
+ERROR_BACKOFF = 1
+
+# identifies this process in jobs.owner
+WORKER_ID = os.getenv('JOBS_WORKER_ID') or f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+logger = logging.getLogger(__name__)
+
+_handlers = {}
+_batch_kinds = set()
+
+
+class BatchPartlyFailed(Exception):
+    """Raised by a batch handler when only some bookings failed.
+
+    The jobs of ``booking_ids`` are retried (or failed); the rest of the
+    batch counts as done.
+    """
+
+    def __init__(self, booking_ids):
+        super().__init__(sorted(booking_ids))
+        self.booking_ids = frozenset(booking_ids)
+
+
+def register(kind: str, handler, batch: bool = False):
+    """Run ``await handler(booking_id)`` for due jobs of ``kind``.
+
+    With ``batch`` the handler is called as ``await handler(booking_ids)``
+    with the jobs of ``kind`` that are due at the same time; it raises
+    BatchPartlyFailed to retry only some of them.
+    """
+    _handlers[kind] = handler
+    if batch:
+        _batch_kinds.add(kind)
+    else:
+        _batch_kinds.discard(kind)
+
+
+async def enqueue(kind: str, booking_id: int, run_at: int) -> int:
+    """Schedule the ``kind`` job of a booking (rescheduling an existing one); returns its id."""
+    async def _op(db):
+        cur = await db.execute(
+            "INSERT INTO jobs (kind, booking_id, run_at, status, attempts) VALUES (?,?,?,'pending',0) "
+            "ON CONFLICT(booking_id, kind) DO UPDATE SET run_at=excluded.run_at, status='pending', attempts=0, last_error=NULL, "
+            "owner=NULL, lease_until=NULL "
+            "RETURNING id", (kind, booking_id, run_at))
+        job_id = (await cur.fetchone())['id']
+        on_commit(lambda: _notify(job_id, run_at))
+        return job_id
+    return await run_write(_op)
+
+
+async def cancel(booking_id: int, kinds) -> int:
+    """Cancel the pending jobs of ``kinds`` for a booking; returns how many."""
+    kinds = tuple(kinds)
+
+    async def _op(db):
+        marks = ','.join('?' * len(kinds))
+        cur = await db.execute(
+            f"UPDATE jobs SET status='cancelled' WHERE kind IN ({marks}) AND booking_id=? AND status='pending'",
+            (*kinds, booking_id))
+        return cur.rowcount
+    return await run_write(_op)
+
+
+async def get_jobs(booking_id: int):
+    async with get_db() as db:
+        cur = await db.execute('SELECT * FROM jobs WHERE booking_id=? ORDER BY run_at, id', (booking_id,))
+        return await cur.fetchall()
+
+
+async def claim(job_id: int, now: int = None):
+    """Lease a due pending job to this worker; returns the row, or None if it is not claimable."""
+    claimed = await claim_many([job_id], now)
+    return claimed[0] if claimed else None
+
+
+async def claim_many(job_ids, now: int = None):
+    """claim() for several jobs in one transaction; returns the claimed rows.
+
+    Status, attempts, owner and lease are set by one conditional UPDATE per
+    chunk, so of several workers claiming the same job exactly one gets it.
+    """
+    now = now_ts() if now is None else now
+    lease_until = time.time() + LEASE_SECONDS
+    job_ids = list(job_ids)
+
+    async def _op(db):
+        claimed = []
+        for i in range(0, len(job_ids), _IN_CHUNK):
+            chunk = job_ids[i:i + _IN_CHUNK]
+            cur = await db.execute(
+                f"UPDATE jobs SET status='running', attempts=attempts+1, owner=?, lease_until=? "
+                f"WHERE id IN ({','.join('?' * len(chunk))}) AND status='pending' AND run_at<=? "
+                "RETURNING id, kind, booking_id, run_at, attempts", (WORKER_ID, lease_until, *chunk, now))
+            claimed += await cur.fetchall()
+        return claimed
+    return await run_write(_op) if job_ids else []
+
+
+async def renew(job_ids) -> int:
+    """Extend this worker's leases on running jobs; returns how many are still held."""
+    lease_until = time.time() + LEASE_SECONDS
+
+    async def _op(db):
+        cur = await db.executemany(
+            "UPDATE jobs SET lease_until=? WHERE id=? AND status='running' AND owner=?",
+            [(lease_until, i, WORKER_ID) for i in job_ids])
+        return cur.rowcount
+    return await run_write(_op)
+
+
+async def complete(*job_ids: int):
+    async def _op(db):
+        await db.executemany("UPDATE jobs SET status='done', lease_until=NULL WHERE id=? AND status='running' AND owner=?",
+                             [(i, WORKER_ID) for i in job_ids])
+    await run_write(_op)
+
+
+async def fail(job, error: Exception):
+    """Put a failed job back with backoff, or mark it failed after MAX_ATTEMPTS."""
+    attempts = job['attempts']
+    give_up = attempts >= MAX_ATTEMPTS
+    retry_at = now_ts() + RETRY_DELAY * 2 ** (attempts - 1)
+
+    async def _op(db):
+        if give_up:
+            await db.execute("UPDATE jobs SET status='failed', last_error=?, lease_until=NULL WHERE id=? AND status='running' AND owner=?",
+                             (repr(error), job['id'], WORKER_ID))
+        else:
+            await db.execute("UPDATE jobs SET status='pending', run_at=?, last_error=?, owner=NULL, lease_until=NULL "
+                             "WHERE id=? AND status='running' AND owner=?", (retry_at, repr(error), job['id'], WORKER_ID))
+            on_commit(lambda: _notify(job['id'], retry_at))
+    await run_write(_op)
+    metrics.incr('jobs.failed' if give_up else 'jobs.retried')
+
+
+async def rehydrate(now: int = None) -> int:
+    """Create the missing jobs of scheduled bookings; returns how many were added.
+
+    Run at startup before the runner: bookings made before the jobs table
+    existed (or whose jobs were never written) get their auto-completion and
+    their unsent, still useful reminders: the 24h one only while its time
+    has not passed (its text says "tomorrow"), the 1h one until the visit
+    starts. One query over the (status, end_ts)
+    index reads only bookings not yet past their auto-completion time and
+    LEFT JOINs each job kind on the (booking_id, kind) key, returning just the
+    bookings that miss one. Jobs of any status count, so cancelled ones are
+    not revived. Bookings already past it are left to
+    auto_complete.complete_overdue(), which the bot runs first.
+    """
+    from app.auto_complete import GRACE_PERIOD_MINUTES, JOB_KIND as AUTO_COMPLETE
+    from app.reminders import JOB_KINDS, OFFSETS
+    now = now_ts() if now is None else now
+    grace = GRACE_PERIOD_MINUTES * 60
+    # seconds before the start at which each reminder kind stops being useful:
+    # its own time, except for the nearest reminder, which is still worth sending late
+    nearest = min(OFFSETS.values())
+    useful_until = {kind: 0 if OFFSETS[kind] == nearest else OFFSETS[kind] for kind in JOB_KINDS}
+    async with get_db() as db:
+        cur = await db.execute(
+            "SELECT b.id, b.start_ts, b.end_ts, b.reminded_24, b.reminded_1, "
+            "ac.id IS NOT NULL AS has_auto_complete, r24.id IS NOT NULL AS has_24h, r1.id IS NOT NULL AS has_1h "
+            "FROM bookings b "
+            "LEFT JOIN jobs ac ON ac.booking_id=b.id AND ac.kind=? "
+            "LEFT JOIN jobs r24 ON r24.booking_id=b.id AND r24.kind=? "
+            "LEFT JOIN jobs r1 ON r1.booking_id=b.id AND r1.kind=? "
+            "WHERE b.status='scheduled' AND b.end_ts>? AND (ac.id IS NULL "
+            "OR (r24.id IS NULL AND NOT b.reminded_24 AND b.start_ts>?) "
+            "OR (r1.id IS NULL AND NOT b.reminded_1 AND b.start_ts>?))",
+            (AUTO_COMPLETE, JOB_KINDS['24h'], JOB_KINDS['1h'], now - grace,
+             now + useful_until['24h'], now + useful_until['1h']))
+        bookings = await cur.fetchall()
+    flags = {'24h': 'reminded_24', '1h': 'reminded_1'}
+    missing = []
+    for b in bookings:
+        if not b['has_auto_complete']:
+            missing.append((AUTO_COMPLETE, b['id'], b['end_ts'] + grace))
+        for kind, job_kind in JOB_KINDS.items():
+            if not b[f'has_{kind}'] and not b[flags[kind]] and b['start_ts'] - useful_until[kind] > now:
+                missing.append((job_kind, b['id'], b['start_ts'] - OFFSETS[kind]))
+    for i in range(0, len(missing), REHYDRATE_BATCH):
+        async def _op(db, batch=missing[i:i + REHYDRATE_BATCH]):
+            await db.executemany('INSERT OR IGNORE INTO jobs (kind, booking_id, run_at) VALUES (?,?,?)', batch)
+        await run_write(_op)
+        # let bookings and the runner get at the writer between batches
+        await asyncio.sleep(0)
+    metrics.incr('jobs.rehydrated', len(missing))
+    if missing:
+        logger.info(f"jobs_rehydrated: bookings={len(bookings)} jobs={len(missing)}")
+    return len(missing)
+
+
+class JobRunner:
+    def __init__(self):
+        # (run_at, job_id); may hold stale duplicates, claim() filters them
+        self.heap = []
+        self.queued = set()
+        self.loaded_until = None
+        self.next_poll = None
+        self.next_purge = None
+        self.wakeup = asyncio.Event()
+        self.running = set()
+        self.slots = asyncio.Semaphore(CONCURRENCY)
+        self.task = None
+
+    def push(self, job_id: int, run_at: int):
+        if run_at <= now_ts() + WINDOW:
+            heapq.heappush(self.heap, (run_at, job_id))
+            self.queued.add(job_id)
+            self.wakeup.set()
+
+    async def reclaim(self, at: float = None):
+        """Put running jobs whose lease expired (their worker died or stalled) back to pending.
+
+        ``at`` is Unix time, defaulting to time.time().
+        """
+        at = time.time() if at is None else at
+
+        async def _op(db):
+            cur = await db.execute(
+                "UPDATE jobs SET status='pending', owner=NULL, lease_until=NULL "
+                "WHERE status='running' AND (lease_until IS NULL OR lease_until<?) RETURNING id", (at,))
+            return await cur.fetchall()
+        reclaimed = await run_write(_op)
+        if reclaimed:
+            metrics.incr('jobs.reclaimed', len(reclaimed))
+            logger.info(f"jobs_reclaimed: ids={[r['id'] for r in reclaimed]}")
+        return len(reclaimed)
+
+    async def load(self, now: int):
+        until = now + WINDOW
+        async with get_db() as db:
+            cur = await db.execute(
+                "SELECT id, run_at FROM jobs WHERE status='pending' AND run_at<=? ORDER BY run_at LIMIT ?",
+                (until, LOAD_LIMIT))
+            rows = await cur.fetchall()
+        if len(rows) == LOAD_LIMIT:
+            until = rows[-1]['run_at']
+        for r in rows:
+            if r['id'] not in self.queued:
+                heapq.heappush(self.heap, (r['run_at'], r['id']))
+                self.queued.add(r['id'])
+        self.loaded_until = until
+        metrics.incr('jobs.loads')
+
+    async def purge(self, now: int):
+        async def _op(db):
+            for status in ('done', 'cancelled', 'failed'):
+                await db.execute('DELETE FROM jobs WHERE status=? AND run_at<?', (status, now - KEEP_FINISHED))
+        await run_write(_op)
+
+    async def run_due(self, now: int = None):
+        """Claim every heap entry due at ``now`` and start its handlers; returns the tasks."""
+        now = now_ts() if now is None else now
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            _, job_id = heapq.heappop(self.heap)
+            self.queued.discard(job_id)
+            due.append(job_id)
+        claimed = await claim_many(due, now)
+        metrics.incr('jobs.claimed', len(claimed))
+        groups = []
+        batches = {}
+        for job in claimed:
+            if job['kind'] in _batch_kinds:
+                batches.setdefault(job['kind'], []).append(job)
+            else:
+                groups.append([job])
+        for kind_jobs in batches.values():
+            groups += [kind_jobs[i:i + BATCH_SIZE] for i in range(0, len(kind_jobs), BATCH_SIZE)]
+        started = []
+        for group in groups:
+            task = asyncio.get_running_loop().create_task(self._execute(group))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+            started.append(task)
+        return started
+
+    async def _keep_leases(self, job_ids):
+        while True:
+            await asyncio.sleep(LEASE_SECONDS / 3)
+            try:
+                if await renew(job_ids) < len(job_ids):
+                    logger.warning(f"job_lease_lost: ids={job_ids}")
+            except Exception:
+                # e.g. DatabaseBusy: the lease still has two thirds left, try again next round
+                logger.exception(f"job_lease_renew_failed: ids={job_ids}")
+
+    async def _execute(self, group):
+        kind = group[0]['kind']
+        # leases run from the claim, so they are renewed while the group
+        # waits for a free slot too, not only while its handler runs
+        keeper = asyncio.get_running_loop().create_task(self._keep_leases([job['id'] for job in group]))
+        try:
+            async with self.slots:
+                handler = _handlers.get(kind)
+                try:
+                    if handler is None:
+                        raise LookupError(f"no handler for job kind {kind!r}")
+                    if kind in _batch_kinds:
+                        await handler([job['booking_id'] for job in group])
+                    else:
+                        await handler(group[0]['booking_id'])
+                except Exception as e:
+                    failed = group
+                    if isinstance(e, BatchPartlyFailed):
+                        failed = [job for job in group if job['booking_id'] in e.booking_ids]
+                    failed_ids = {job['id'] for job in failed}
+                    logger.exception(f"job_failed: kind={kind} booking_ids={[job['booking_id'] for job in failed]}")
+                    for job in failed:
+                        await fail(job, e)
+                    done = [job for job in group if job['id'] not in failed_ids]
+                else:
+                    done = group
+                if done:
+                    await complete(*(job['id'] for job in done))
+                    metrics.incr('jobs.done', len(done))
+        finally:
+            keeper.cancel()
+
+    async def run(self):
+        errors = 0
+        while True:
+            self.wakeup.clear()
+            now = now_ts()
+            try:
+                if self.next_poll is None or now >= self.next_poll:
+                    await self.reclaim()
+                    await self.load(now)
+                    self.next_poll = min(now + POLL_INTERVAL, self.loaded_until)
+                if self.next_purge is None or now >= self.next_purge:
+                    await self.purge(now)
+                    self.next_purge = now + WINDOW
+                await self.run_due(now)
+                errors = 0
+            except Exception:
+                # e.g. DatabaseBusy: jobs popped from the heap are still pending
+                # in the table, so back off and reload instead of dying
+                errors += 1
+                logger.exception('job runner iteration failed')
+                metrics.incr('jobs.loop_errors')
+                self.next_poll = None
+                await asyncio.sleep(min(ERROR_BACKOFF * 2 ** (errors - 1), POLL_INTERVAL))
+                continue
+            next_at = self.next_poll
+            if self.heap:
+                next_at = min(next_at, self.heap[0][0])
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), max(0, next_at - now_ts()))
+            except asyncio.TimeoutError:
+                pass
+
+
+_runner = None
+
+
+def _notify(job_id: int, run_at: int):
+    if _runner is not None:
+        _runner.push(job_id, run_at)
+
+
+def start_runner():
+    """Start the job loop on the running event loop (once)."""
+    global _runner
+    if _runner is None:
+        _runner = JobRunner()
+        _runner.task = asyncio.get_running_loop().create_task(_runner.run())
+    return _runner
+
+
+async def stop_runner():
+    global _runner
+    runner, _runner = _runner, None
+    if runner is None:
+        return
+    tasks = [runner.task, *runner.running]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    # hand interrupted jobs to the other workers without waiting for the lease
+    async def _op(db):
+        await db.execute("UPDATE jobs SET status='pending', owner=NULL, lease_until=NULL WHERE status='running' AND owner=?",
+                         (WORKER_ID,))
+    await run_write(_op)
@@ -1,4 +1,9 @@
+import calendar
+from datetime import date
+
 from aiogram.types import (
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
     KeyboardButton,
     ReplyKeyboardMarkup
 )
@@ -34,4 +39,50 @@ def main_menu_kb(is_owner=False):
     ]
     if is_owner:
         keyboard.append([KeyboardButton(text="🏠 Админ-меню")])
-    return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
\ No newline at end of file
+    return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
+
+
+# ---------- КАЛЕНДАРЬ ЗАПИСИ ----------
+MONTHS_RU = ['Январь', 'Февраль', 'Март', 'Апрель', 'Май', 'Июнь',
+             'Июль', 'Август', 'Сентябрь', 'Октябрь', 'Ноябрь', 'Декабрь']
+WEEKDAYS_RU = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
+
+
+def _shift_month(year: int, month: int, delta: int):
+    index = year * 12 + month - 1 + delta
+    return index // 12, index % 12 + 1
+
+
+def booking_calendar_kb(year: int, month: int, counts: dict, today: date = None):
+    """Month grid for the booking flow.
+
+    ``counts`` maps 'YYYY-MM-DD' to the number of free slots. Days with free
+    slots are buttons ``book:date:<date>`` labelled "day (count)"; other days
+    are inert (``book:cal:none``). The header arrows switch months with
+    ``book:cal:<YYYY-MM>`` and never go back past the current month.
+    """
+    today = today or date.today()
+    noop = 'book:cal:none'
+    prev_y, prev_m = _shift_month(year, month, -1)
+    next_y, next_m = _shift_month(year, month, 1)
+    can_go_back = (prev_y, prev_m) >= (today.year, today.month)
+    rows = [[
+        InlineKeyboardButton(text='‹' if can_go_back else ' ', callback_data=f'book:cal:{prev_y:04d}-{prev_m:02d}' if can_go_back else noop),
+        InlineKeyboardButton(text=f'{MONTHS_RU[month - 1]} {year}', callback_data=noop),
+        InlineKeyboardButton(text='›', callback_data=f'book:cal:{next_y:04d}-{next_m:02d}'),
+    ]]
+    rows.append([InlineKeyboardButton(text=d, callback_data=noop) for d in WEEKDAYS_RU])
+    for week in calendar.Calendar().monthdayscalendar(year, month):
+        row = []
+        for day in week:
+            if day == 0:
+                row.append(InlineKeyboardButton(text=' ', callback_data=noop))
+                continue
+            date_s = f'{year:04d}-{month:02d}-{day:02d}'
+            free = counts.get(date_s, 0)
+            if free:
+                row.append(InlineKeyboardButton(text=f'{day} ({free})', callback_data=f'book:date:{date_s}'))
+            else:
+                row.append(InlineKeyboardButton(text=f'·{day}·' if date_s >= today.isoformat() else ' ', callback_data=noop))
+        rows.append(row)
+    return InlineKeyboardMarkup(inline_keyboard=rows)
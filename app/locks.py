@@ -0,0 +1,60 @@
+"""In-process keyed async locks.
+
+Used to queue competing booking attempts for the same master and day in
+memory, so only one of them at a time reaches the SQLite writer, while
+attempts for other masters proceed in parallel.
+"""
+import asyncio
+import time
+import weakref
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+from app import metrics
+
+
+class KeyedLocks:
+    """Registry of asyncio locks created on demand per key.
+
+    Locks are held only through weak references, so a key's lock disappears
+    as soon as nobody holds or waits for it. ``hold`` is re-entrant within a
+    task: a nested ``hold`` of a key the task already holds does not block.
+    Wait times are reported as ``<name>.lock_wait_ms``.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._locks = weakref.WeakValueDictionary()
+        self._held = ContextVar(f'keyed_locks_{name}', default=frozenset())
+
+    def __len__(self):
+        return len(self._locks)
+
+    def _lock(self, key):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        return lock
+
+    @asynccontextmanager
+    async def hold(self, key):
+        held = self._held.get()
+        if key in held:
+            yield
+            return
+        lock = self._lock(key)
+        if lock.locked():
+            metrics.incr(f'{self.name}.lock_contended')
+        started = time.perf_counter()
+        async with lock:
+            metrics.observe(f'{self.name}.lock_wait_ms', (time.perf_counter() - started) * 1000)
+            token = self._held.set(held | {key})
+            try:
+                yield
+            finally:
+                self._held.reset(token)
+
+
+# serializes booking attempts per (master_id, date)
+booking_locks = KeyedLocks('booking')
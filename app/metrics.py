@@ -0,0 +1,61 @@
+"""Process-local counters and timings for the admin /stats command.
+
+Cheap enough to call on hot paths: plain dict updates, no locking (the bot
+runs on a single event loop).
+"""
+
+_counters = {}
+# name -> [count, total, max]
+_timings = {}
+
+
+def incr(name: str, n: int = 1):
+    _counters[name] = _counters.get(name, 0) + n
+
+
+def observe(name: str, value: float):
+    t = _timings.get(name)
+    if t is None:
+        _timings[name] = [1, value, value]
+    else:
+        t[0] += 1
+        t[1] += value
+        if value > t[2]:
+            t[2] = value
+
+
+def snapshot() -> dict:
+    """Return {'counters': {...}, 'timings': {name: {'count', 'avg', 'max'}}}."""
+    return {
+        'counters': dict(_counters),
+        'timings': {
+            name: {'count': c, 'avg': total / c, 'max': mx}
+            for name, (c, total, mx) in _timings.items()
+        },
+    }
+
+
+def ratio(hits: str, misses: str) -> float:
+    """Share of ``hits`` among ``hits + misses`` (0.0 when neither was counted)."""
+    h = _counters.get(hits, 0)
+    total = h + _counters.get(misses, 0)
+    return h / total if total else 0.0
+
+
+def reset():
+    _counters.clear()
+    _timings.clear()
+
+
+def format_snapshot() -> str:
+    snap = snapshot()
+    lines = [f'{k}: {v}' for k, v in sorted(snap['counters'].items())]
+    # every <x>hits counter with a <x>misses twin also gets <x>hit_ratio
+    for name in sorted(snap['counters']):
+        if name.endswith('hits'):
+            prefix = name[:-len('hits')]
+            if prefix + 'misses' in snap['counters']:
+                lines.append(f"{prefix}hit_ratio: {ratio(name, prefix + 'misses'):.2f}")
+    for name, t in sorted(snap['timings'].items()):
+        lines.append(f"{name}: n={t['count']} avg={t['avg']:.1f} max={t['max']:.1f}")
+    return '\n'.join(lines) or 'нет данных'
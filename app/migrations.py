@@ -0,0 +1,122 @@
+"""Versioned SQL migrations.
+
+Files in ``migrations/`` are named ``NNN_description.sql``. Each one is applied
+at most once, inside a single transaction, and recorded in ``schema_migrations``
+together with a checksum of its contents, so startup only costs one lookup no
+matter how many migrations exist.
+"""
+import hashlib
+import re
+from pathlib import Path
+from typing import NamedTuple
+
+MIGRATION_RE = re.compile(r'^(\d+)_([\w\-]+)\.sql$')
+
+# the last migration shipped before schema_migrations existed; only these
+# may have been run (unrecorded) by the old runner
+LEGACY_MAX_VERSION = 5
+
+SCHEMA_MIGRATIONS_SQL = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+  version INTEGER PRIMARY KEY,
+  name TEXT NOT NULL,
+  checksum TEXT NOT NULL,
+  applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+)
+"""
+
+
+class MigrationError(Exception):
+    pass
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    sql: str
+    checksum: str
+
+
+def discover(directory: Path):
+    """Return migrations found in ``directory`` ordered by version."""
+    found = []
+    for p in sorted(Path(directory).glob('*.sql')):
+        m = MIGRATION_RE.match(p.name)
+        if not m:
+            raise MigrationError(f'unexpected migration file name: {p.name}')
+        data = p.read_bytes()
+        found.append(Migration(int(m.group(1)), p.stem, data.decode('utf-8'), hashlib.sha256(data).hexdigest()))
+    versions = [m.version for m in found]
+    if len(versions) != len(set(versions)):
+        raise MigrationError('duplicate migration version in ' + str(directory))
+    return sorted(found, key=lambda m: m.version)
+
+
+async def _applied(db):
+    cur = await db.execute('SELECT version, name, checksum FROM schema_migrations')
+    return {r['version']: r for r in await cur.fetchall()}
+
+
+async def _has_table(db, name: str) -> bool:
+    cur = await db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,))
+    return await cur.fetchone() is not None
+
+
+async def _has_legacy_schema(db) -> bool:
+    # databases migrated before schema_migrations existed already have tables
+    return await _has_table(db, 'bookings')
+
+
+def _is_already_applied_error(exc: Exception) -> bool:
+    msg = str(exc).lower()
+    return 'duplicate column' in msg or 'already exists' in msg
+
+
+async def _apply(db, migration: Migration, record_only: bool = False):
+    record = (
+        f"INSERT INTO schema_migrations (version, name, checksum) "
+        f"VALUES ({migration.version}, '{migration.name}', '{migration.checksum}');"
+    )
+    body = '' if record_only else migration.sql
+    try:
+        await db.executescript(f'BEGIN;\n{body}\n;\n{record}\nCOMMIT;')
+    except Exception:
+        if db.in_transaction:
+            await db.rollback()
+        raise
+
+
+async def migrate(db, directory: Path, dry_run: bool = False):
+    """Apply pending migrations and return the ones applied (or pending on dry run).
+
+    A dry run writes nothing, not even the schema_migrations table.
+    Raises MigrationError if an applied migration's file has been edited.
+    """
+    migrations = discover(directory)
+    if dry_run:
+        applied = await _applied(db) if await _has_table(db, 'schema_migrations') else {}
+    else:
+        await db.execute(SCHEMA_MIGRATIONS_SQL)
+        await db.commit()
+        applied = await _applied(db)
+    for m in migrations:
+        row = applied.get(m.version)
+        if row is not None and row['checksum'] != m.checksum:
+            raise MigrationError(f'migration {m.name} was modified after being applied')
+    pending = [m for m in migrations if m.version not in applied]
+    if dry_run or not pending:
+        return pending
+
+    legacy = not applied and await _has_legacy_schema(db)
+    for m in pending:
+        try:
+            await _apply(db, m)
+        except Exception as e:
+            # the pre-versioning runner re-ran every file on each start; when
+            # adopting such a database, treat "already there" as applied --
+            # but only for files that runner could have seen
+            if legacy and m.version <= LEGACY_MAX_VERSION and _is_already_applied_error(e):
+                await _apply(db, m, record_only=True)
+                continue
+            raise MigrationError(f'migration {m.name} failed: {e}') from e
+    return pending
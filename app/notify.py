@@ -1,9 +1,27 @@
+import asyncio
+import logging
 import os
 from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest, TelegramNotFound,
+    TelegramUnauthorizedError, TelegramMigrateToChat,
+)
 
 # Use os.getenv to read secrets/configs
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_IDS = [int(x) for x in os.getenv('ADMIN_IDS','').split(',') if x]
+# parallel sends of notify_users across the process (Telegram allows ~30 messages/s per bot)
+SEND_CONCURRENCY = 10
+# resends of one message after a flood-control (retry-after) reply
+SEND_RETRIES = 3
+
+logger = logging.getLogger(__name__)
+
+_slots = None  # (loop, Semaphore) shared by all notify_users calls
+_resume_at = 0.0  # loop time before which no message is sent (retry-after)
+# refusals that a resend cannot fix: bot blocked, chat gone, bad request or token
+PERMANENT_ERRORS = (TelegramForbiddenError, TelegramBadRequest, TelegramNotFound,
+                    TelegramUnauthorizedError, TelegramMigrateToChat)
 
 async def notify_admins(text: str):
     if not BOT_TOKEN or not ADMIN_IDS:
@@ -38,3 +56,62 @@ async def notify_user(tg_id: int, text: str):
             pass
     finally:
         await bot.session.close()
+
+
+def _send_slots() -> asyncio.Semaphore:
+    # one limit for every notify_users call in this process (per event loop)
+    global _slots
+    loop = asyncio.get_running_loop()
+    if _slots is None or _slots[0] is not loop:
+        _slots = (loop, asyncio.Semaphore(SEND_CONCURRENCY))
+    return _slots[1]
+
+
+async def notify_users(messages):
+    """Send [(key, tg_id, text), ...] through one Bot session.
+
+    Returns (delivered, rejected): the keys sent, and the keys that can never
+    be sent (PERMANENT_ERRORS, no tg_id, or no BOT_TOKEN configured). Keys in
+    neither set failed transiently and may be retried.
+
+    At most SEND_CONCURRENCY messages are in flight across all callers. A
+    Telegram flood-control reply (retry-after) pauses every sender for the
+    requested time and the message is retried up to SEND_RETRIES times.
+    """
+    messages = list(messages)
+    rejected = {key for key, tg, _ in messages if not tg or not BOT_TOKEN}
+    messages = [m for m in messages if m[0] not in rejected]
+    if not messages:
+        return set(), rejected
+    loop = asyncio.get_running_loop()
+    slots = _send_slots()
+    bot = Bot(BOT_TOKEN)
+    delivered = set()
+
+    async def _send(key, tg_id, text):
+        global _resume_at
+        async with slots:
+            for _ in range(SEND_RETRIES + 1):
+                pause = _resume_at - loop.time()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                try:
+                    await bot.send_message(tg_id, text)
+                except TelegramRetryAfter as e:
+                    _resume_at = max(_resume_at, loop.time() + e.retry_after)
+                    continue
+                except PERMANENT_ERRORS as e:
+                    logger.warning(f"notify_rejected: key={key} tg_id={tg_id} reason={e!r}")
+                    rejected.add(key)
+                    return
+                except Exception:
+                    logger.exception(f"notify_failed: key={key} tg_id={tg_id}")
+                    return
+                delivered.add(key)
+                return
+            logger.warning(f"notify_failed: key={key} tg_id={tg_id} reason=retry_after")
+    try:
+        await asyncio.gather(*[_send(*m) for m in messages])
+    finally:
+        await bot.session.close()
+    return delivered, rejected
@@ -1,12 +1,20 @@
 from datetime import datetime, timedelta
-import asyncio
 import logging
-from app.repo import get_booking, get_user_by_id, set_reminder_sent
-from app.notify import notify_user
+from app import jobs
+from app.repo import list_reminder_targets, set_reminders_sent
+from app.notify import notify_users
+from app.scheduler import to_ts
 
 logger = logging.getLogger(__name__)
 
-_scheduled_reminders = {}
+
+class ReminderNotDelivered(jobs.BatchPartlyFailed):
+    """Some reminders of a batch failed transiently; only their jobs are retried."""
+
+
+# job kind per reminder kind
+JOB_KINDS = {'24h': 'reminder_24h', '1h': 'reminder_1h'}
+OFFSETS = {'24h': 24 * 3600, '1h': 3600}
 
 
 def _dt_from_parts(date_s: str, time_s: str) -> datetime:
@@ -23,62 +31,59 @@ def compute_reminder_times(date_s: str, time_s: str):
     }
 
 
-def schedule_reminders(booking_id: int, date_s: str, time_s: str):
-    """Schedule reminder tasks for a booking (24h and 1h before)."""
-    times = compute_reminder_times(date_s, time_s)
-    now = datetime.now()
-    for kind in ('24h', '1h'):
-        run_at = times[kind]
-        delay = (run_at - now).total_seconds()
-        if delay < 0:
-            delay = 0
-        # NOTE: schedule_reminders uses background tasks created via
-        # `asyncio.create_task`. Ensure bot runs within an asyncio loop.
-        # If scheduling occurs outside a running loop it may raise or
-        # produce 'coroutine was never awaited' warnings during tests.
-        task = asyncio.create_task(_send_reminder(booking_id, kind, delay))
-        _scheduled_reminders.setdefault(booking_id, {})[kind] = task
-
-
-def cancel_reminders(booking_id: int):
-    d = _scheduled_reminders.pop(booking_id, {})
-    for t in d.values():
-        try:
-            t.cancel()
-        except Exception:
-            pass
-
-
-async def _send_reminder(booking_id: int, kind: str, delay: float):
-    await asyncio.sleep(delay)
-    booking = await get_booking(booking_id)
-    if not booking:
-        logger.info(f"reminder_skip: booking {booking_id} not found")
-        return
-    if booking['status'] != 'scheduled':
-        logger.info(f"reminder_skip: booking_id={booking_id} reason=not_scheduled status={booking['status']}")
-        return
-    flag_col = 'reminded_24' if kind == '24h' else 'reminded_1'
-    if booking[flag_col]:
-        logger.info(f"reminder_skip: booking_id={booking_id} reason=already_sent kind={kind}")
-        return
-    # send notification to user
-    user = await get_user_by_id(booking['user_id'])
-    if not user:
-        logger.info(f"reminder_skip: booking_id={booking_id} no user")
-        return
-    tg = user['tg_id']
-    if not tg:
-        logger.info(f"reminder_skip: booking_id={booking_id} user_no_tg")
-        return
+async def schedule_reminders(booking_id: int, date_s: str, time_s: str):
+    """Schedule reminder jobs for a booking (24h and 1h before).
+
+    Reminders whose time has already passed run as soon as the job runner sees them.
+    """
+    start = to_ts(date_s, time_s)
+    for kind, job_kind in JOB_KINDS.items():
+        await jobs.enqueue(job_kind, booking_id, start - OFFSETS[kind])
+
+
+async def cancel_reminders(booking_id: int):
+    await jobs.cancel(booking_id, JOB_KINDS.values())
+
+
+def _reminder_text(kind: str, booking) -> str:
     # Compose friendly message
     if kind == '24h':
-        text = f"Напоминаем: у вас запись завтра {booking['date']} в {booking['time']}. Ждём вас!"
-    else:
-        text = f"Напоминание: сегодня у вас запись в {booking['time']}. До встречи!"
-    try:
-        await notify_user(tg, text)
-        await set_reminder_sent(booking_id, kind)
-        logger.info(f"reminder_sent: booking_id={booking_id} kind={kind}")
-    except Exception:
-        logger.exception(f"reminder_error: booking_id={booking_id} kind={kind}")
+        return f"Напоминаем: у вас запись завтра {booking['date']} в {booking['time']}. Ждём вас!"
+    return f"Напоминание: сегодня у вас запись в {booking['time']}. До встречи!"
+
+
+async def _send_reminders(booking_ids, kind: str):
+    """Send the ``kind`` reminders of a batch: one joined read, bounded parallel sends, one flag update.
+
+    Only delivered reminders are flagged. Reminders Telegram refuses for good
+    (bot blocked, chat gone, no BOT_TOKEN) are logged and dropped; those that
+    failed transiently raise ReminderNotDelivered, so the runner retries just
+    their jobs.
+    """
+    flag_col = 'reminded_24' if kind == '24h' else 'reminded_1'
+    due = []
+    for booking in await list_reminder_targets(booking_ids):
+        if booking['status'] != 'scheduled':
+            reason = f"not_scheduled status={booking['status']}"
+        elif booking[flag_col]:
+            reason = 'already_sent'
+        elif not booking['tg_id']:
+            reason = 'user_no_tg'
+        else:
+            due.append(booking)
+            continue
+        logger.info(f"reminder_skip: booking_id={booking['id']} reason={reason} kind={kind}")
+    if not due:
+        return
+    delivered, rejected = await notify_users([(b['id'], b['tg_id'], _reminder_text(kind, b)) for b in due])
+    await set_reminders_sent([b['id'] for b in due if b['id'] in delivered], kind)
+    logger.info(f"reminder_sent: kind={kind} count={len(delivered)}")
+    for booking_id in sorted(rejected):
+        logger.info(f"reminder_skip: booking_id={booking_id} reason=undeliverable kind={kind}")
+    retry = [b['id'] for b in due if b['id'] not in delivered and b['id'] not in rejected]
+    if retry:
+        raise ReminderNotDelivered(retry)
+
+
+for _kind, _job_kind in JOB_KINDS.items():
+    jobs.register(_job_kind, lambda booking_ids, kind=_kind: _send_reminders(booking_ids, kind), batch=True)
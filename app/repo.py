@@ -1,6 +1,13 @@
-from app.db import get_db
+from app.db import get_db, run_write, on_commit, _get_pool, DatabaseBusy, check_external_writes, external_write_listeners
+from app import metrics
+from app.locks import booking_locks
+from app import availability
+from app.scheduler import hhmm_to_minutes, minutes_to_hhmm, to_ts, now_ts
+from collections.abc import Mapping
 from datetime import date
+import asyncio
 import aiosqlite
+from sqlite3 import IntegrityError, OperationalError
 
 class SlotTaken(Exception):
     pass
@@ -8,114 +15,230 @@ class SlotTaken(Exception):
 class DoubleBooking(Exception):
     pass
 
+
+class Record(Mapping):
+    """Immutable, compact catalog row.
+
+    Behaves like the aiosqlite.Row it replaces (``r['name']``, ``r[0]``,
+    ``dict(r)``, ``r.keys()``) and also supports ``r.get(key, default)``.
+    Records loaded together share one column index.
+    """
+    __slots__ = ('_columns', '_values')
+
+    def __init__(self, columns: dict, values: tuple):
+        self._columns = columns
+        self._values = values
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self._values[key]
+        return self._values[self._columns[key]]
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return f'Record({dict(self)!r})'
+
+
+class _Catalog:
+    __slots__ = ('pool', 'services', 'services_by_id', 'masters', 'masters_by_id')
+
+    def __init__(self, pool, services, masters):
+        self.pool = pool
+        self.services = services
+        self.services_by_id = {r['id']: r for r in services}
+        self.masters = masters
+        self.masters_by_id = {r['id']: r for r in masters}
+
+
+# Services and masters change a few times a week through admin commands but
+# are read on nearly every client interaction, so they are served from memory.
+# A cached catalog belongs to one connection pool (one database and loop).
+_catalog = None
+_catalog_load = None  # (pool, task) of the load in flight
+_catalog_version = 0
+
+
+def _records(cur, rows):
+    columns = {d[0]: i for i, d in enumerate(cur.description)}
+    return tuple(Record(columns, tuple(r)) for r in rows)
+
+
+async def _load_catalog(pool):
+    global _catalog
+    version = _catalog_version
+    async with get_db() as db:
+        cur = await db.execute('SELECT * FROM services')
+        services = _records(cur, await cur.fetchall())
+        cur = await db.execute('SELECT * FROM masters')
+        masters = _records(cur, await cur.fetchall())
+    catalog = _Catalog(pool, services, masters)
+    # a catalog write committed while loading makes this snapshot stale:
+    # hand it to the callers already waiting, but don't keep it
+    if version == _catalog_version:
+        _catalog = catalog
+    metrics.incr('catalog.loads')
+    return catalog
+
+
+async def _get_catalog() -> _Catalog:
+    global _catalog_load
+    # another bot process may have changed services or masters
+    await check_external_writes()
+    pool = await _get_pool()
+    catalog = _catalog
+    if catalog is not None and catalog.pool is pool:
+        metrics.incr('catalog.hits')
+        return catalog
+    metrics.incr('catalog.misses')
+    loading = _catalog_load
+    if loading is None or loading[0] is not pool or loading[1].done():
+        # one load serves every concurrent miss
+        loading = (pool, asyncio.get_running_loop().create_task(_load_catalog(pool)))
+        _catalog_load = loading
+    return await asyncio.shield(loading[1])
+
+
+def invalidate_catalog():
+    """Drop the cached catalog; the next read reloads it."""
+    global _catalog, _catalog_version
+    _catalog = None
+    _catalog_version += 1
+    metrics.incr('catalog.invalidations')
+
+
+external_write_listeners.append(invalidate_catalog)
+
+
+async def _catalog_write(op):
+    async def _op(db):
+        result = await op(db)
+        # dropped right after COMMIT, before any reader can cache the old rows
+        # past it (a load started earlier fails the version check)
+        on_commit(invalidate_catalog)
+        return result
+    return await run_write(_op)
+
+
 async def get_or_create_user(tg_id: int, name: str = None, phone: str = None):
     async with get_db() as db:
         cur = await db.execute('SELECT * FROM users WHERE tg_id=?', (tg_id,))
         row = await cur.fetchone()
         if row:
             return row
-        cur = await db.execute('INSERT INTO users (tg_id, name, phone) VALUES (?,?,?)', (tg_id, name, phone))
-        await db.commit()
-        user_id = cur.lastrowid
-        cur = await db.execute('SELECT * FROM users WHERE id=?', (user_id,))
+
+    async def _op(db):
+        # re-check on the writer: another update may have created the user meanwhile
+        cur = await db.execute('SELECT * FROM users WHERE tg_id=?', (tg_id,))
         row = await cur.fetchone()
-        return row
+        if row:
+            return row
+        cur = await db.execute('INSERT INTO users (tg_id, name, phone) VALUES (?,?,?)', (tg_id, name, phone))
+        cur = await db.execute('SELECT * FROM users WHERE id=?', (cur.lastrowid,))
+        return await cur.fetchone()
+    return await run_write(_op)
 
 async def list_services():
-    async with get_db() as db:
-        cur = await db.execute('SELECT * FROM services')
-        rows = await cur.fetchall()
-        return rows
+    return list((await _get_catalog()).services)
 
 async def create_service(name, description, price, duration_minutes=30):
-    async with get_db() as db:
+    async def _op(db):
         cur = await db.execute('INSERT INTO services (name, description, price, duration_minutes) VALUES (?,?,?,?)', (name, description, price, duration_minutes))
-        await db.commit()
         return cur.lastrowid
+    return await _catalog_write(_op)
 
 async def update_service(service_id: int, name: str = None, description: str = None, price: float = None, duration_minutes: int = None):
-    async with get_db() as db:
-        fields = []
-        params = []
-        if name is not None:
-            fields.append('name=?')
-            params.append(name)
-        if description is not None:
-            fields.append('description=?')
-            params.append(description)
-        if price is not None:
-            fields.append('price=?')
-            params.append(price)
-        if duration_minutes is not None:
-            fields.append('duration_minutes=?')
-            params.append(duration_minutes)
-        if not fields:
-            return
-        params.append(service_id)
-        sql = f"UPDATE services SET {', '.join(fields)} WHERE id=?"
+    fields = []
+    params = []
+    if name is not None:
+        fields.append('name=?')
+        params.append(name)
+    if description is not None:
+        fields.append('description=?')
+        params.append(description)
+    if price is not None:
+        fields.append('price=?')
+        params.append(price)
+    if duration_minutes is not None:
+        fields.append('duration_minutes=?')
+        params.append(duration_minutes)
+    if not fields:
+        return
+    params.append(service_id)
+    sql = f"UPDATE services SET {', '.join(fields)} WHERE id=?"
+
+    async def _op(db):
         await db.execute(sql, tuple(params))
-        await db.commit()
+        if duration_minutes is not None:
+            # bookings of this service that haven't ended yet take the new length
+            await db.execute(
+                "UPDATE bookings SET end_ts=start_ts+?, "
+                "end_time=CASE WHEN start_ts+? >= start_ts-start_ts%86400+86400 THEN '24:00' "
+                "ELSE strftime('%H:%M', start_ts+?, 'unixepoch') END "
+                "WHERE status='scheduled' AND end_ts>? AND service_id=?",
+                (duration_minutes * 60, duration_minutes * 60, duration_minutes * 60, now_ts(), service_id))
+            on_commit(availability.invalidate_bookings)
+    await _catalog_write(_op)
 
 async def delete_service(service_id: int):
-    async with get_db() as db:
+    async def _op(db):
         await db.execute('DELETE FROM services WHERE id=?', (service_id,))
-        await db.commit()
+    await _catalog_write(_op)
 
 async def get_service(service_id: int):
-    async with get_db() as db:
-        cur = await db.execute('SELECT * FROM services WHERE id=?', (service_id,))
-        row = await cur.fetchone()
-        return row
+    return (await _get_catalog()).services_by_id.get(service_id)
 
 async def list_masters():
-    async with get_db() as db:
-        cur = await db.execute('SELECT * FROM masters')
-        rows = await cur.fetchall()
-        return rows
+    return list((await _get_catalog()).masters)
 
 async def get_master(master_id: int):
-    async with get_db() as db:
-        cur = await db.execute('SELECT * FROM masters WHERE id=?', (master_id,))
-        row = await cur.fetchone()
-        return row
+    return (await _get_catalog()).masters_by_id.get(master_id)
 
 async def create_master(name, bio=None, contact=None):
-    async with get_db() as db:
+    async def _op(db):
         cur = await db.execute('INSERT INTO masters (name, bio, contact) VALUES (?,?,?)', (name, bio, contact))
-        await db.commit()
         return cur.lastrowid
+    return await _catalog_write(_op)
 
 async def update_master(master_id: int, name: str = None, bio: str = None, contact: str = None):
-    async with get_db() as db:
-        # build dynamic update
-        fields = []
-        params = []
-        if name is not None:
-            fields.append('name=?')
-            params.append(name)
-        if bio is not None:
-            fields.append('bio=?')
-            params.append(bio)
-        if contact is not None:
-            fields.append('contact=?')
-            params.append(contact)
-        if not fields:
-            return
-        params.append(master_id)
-        sql = f"UPDATE masters SET {', '.join(fields)} WHERE id=?"
+    # build dynamic update
+    fields = []
+    params = []
+    if name is not None:
+        fields.append('name=?')
+        params.append(name)
+    if bio is not None:
+        fields.append('bio=?')
+        params.append(bio)
+    if contact is not None:
+        fields.append('contact=?')
+        params.append(contact)
+    if not fields:
+        return
+    params.append(master_id)
+    sql = f"UPDATE masters SET {', '.join(fields)} WHERE id=?"
+
+    async def _op(db):
         await db.execute(sql, tuple(params))
-        await db.commit()
+    await _catalog_write(_op)
 
 async def delete_master(master_id: int):
-    async with get_db() as db:
+    async def _op(db):
         await db.execute('DELETE FROM masters WHERE id=?', (master_id,))
-        await db.commit()
+        on_commit(lambda: availability.invalidate_schedule(master_id))
+    await _catalog_write(_op)
 
 async def set_master_schedule(master_id: int, weekday: int, start_time: str, end_time: str, slot_interval_minutes: int = None):
-    async with get_db() as db:
+    async def _op(db):
         await db.execute('DELETE FROM master_schedule WHERE master_id=? AND weekday=?', (master_id, weekday))
         await db.execute('INSERT INTO master_schedule (master_id, weekday, start_time, end_time, slot_interval_minutes) VALUES (?,?,?,?,?)', (master_id, weekday, start_time, end_time, slot_interval_minutes))
-        await db.commit()
+        # a weekday row can change every date of the master (work-day fallback)
+        on_commit(lambda: availability.invalidate_schedule(master_id))
+    await run_write(_op)
 
 async def user_has_active_booking(user_id: int):
     today = date.today().isoformat()
@@ -124,45 +247,118 @@ async def user_has_active_booking(user_id: int):
         row = await cur.fetchone()
         return row['c'] > 0
 
+def booking_end_time(time_s: str, duration_minutes: int) -> str:
+    """'HH:MM' end of a booking; capped at '24:00' so it compares after its start."""
+    return minutes_to_hhmm(min(hhmm_to_minutes(time_s) + int(duration_minutes), 24 * 60))
+
 async def create_booking(user_id, service_id, master_id, date_s, time_s, name, phone):
-    async with get_db() as db:
+    """Insert a scheduled booking and return its id.
+
+    Raises DoubleBooking if the user already has an upcoming booking and
+    SlotTaken if the time overlaps another scheduled booking of the master.
+    The check and the insert run in one IMMEDIATE transaction on the writer.
+    """
+    async def _op(db):
+        # check user active booking; the writer serializes this with the insert
+        cur = await db.execute("SELECT COUNT(*) as c FROM bookings WHERE user_id=? AND status='scheduled' AND date>=?", (user_id, date.today().isoformat()))
+        r = await cur.fetchone()
+        if r['c'] > 0:
+            raise DoubleBooking()
+        cur = await db.execute('SELECT duration_minutes FROM services WHERE id=?', (service_id,))
+        svc = await cur.fetchone()
+        duration = svc['duration_minutes'] if svc and svc['duration_minutes'] else 30
+        end_s = booking_end_time(time_s, duration)
+        start_ts = to_ts(date_s, time_s)
+        end_ts = start_ts + duration * 60
+        if master_id is not None:
+            # any scheduled booking of this master that intersects [start_ts, end_ts)
+            cur = await db.execute("SELECT 1 FROM bookings WHERE master_id=? AND status='scheduled' AND start_ts<? AND end_ts>? LIMIT 1", (master_id, end_ts, start_ts))
+            if await cur.fetchone():
+                raise SlotTaken()
+        # unique index on (master_id,date,time) still guards exact duplicates
         try:
-            await db.execute('BEGIN')
-            # check user active booking
-            cur = await db.execute("SELECT COUNT(*) as c FROM bookings WHERE user_id=? AND status='scheduled' AND date>=?", (user_id, date.today().isoformat()))
-            r = await cur.fetchone()
-            if r['c'] > 0:
-                raise DoubleBooking()
-            # try to insert; unique index on (master_id,date,time) prevents duplicates from races
-            import time
-            from sqlite3 import OperationalError
-            max_attempts = 5
-            for attempt in range(max_attempts):
-                try:
-                    await db.execute('INSERT INTO bookings (user_id, service_id, master_id, date, time, status, name, phone) VALUES (?,?,?,?,?,?,?,?)', (user_id, service_id, master_id, date_s, time_s, 'scheduled', name, phone))
-                    await db.commit()
-                    break
-                except OperationalError as e:
-                    # transient DB locked — retry a few times
-                    if 'locked' in str(e).lower():
-                        if attempt < max_attempts - 1:
-                            await db.rollback()
-                            time.sleep(0.05 * (attempt + 1))
-                            continue
-                        else:
-                            await db.rollback()
-                            raise SlotTaken()
-                    raise
-                except Exception as e:
-                    err_msg = str(e).lower()
-                    if 'unique' in err_msg or 'constraint' in err_msg:
-                        await db.rollback()
-                        raise SlotTaken()
-                    await db.rollback()
-                    raise
-        except Exception:
-            await db.rollback()
-            raise
+            cur = await db.execute('INSERT INTO bookings (user_id, service_id, master_id, date, time, end_time, start_ts, end_ts, status, name, phone) VALUES (?,?,?,?,?,?,?,?,?,?,?)', (user_id, service_id, master_id, date_s, time_s, end_s, start_ts, end_ts, 'scheduled', name, phone))
+        except IntegrityError:
+            raise SlotTaken()
+        if master_id is not None:
+            on_commit(lambda: availability.invalidate_span(master_id, start_ts, end_ts))
+        return cur.lastrowid
+    try:
+        if master_id is None:
+            return await run_write(_op)
+        # competing attempts for this master's day wait here, not on SQLite
+        async with booking_locks.hold((master_id, date_s)):
+            return await run_write(_op)
+    except DatabaseBusy:
+        # the write lock stayed held past DB_LOCK_DEADLINE_MS (e.g. another process writing)
+        raise SlotTaken()
+    except OperationalError as e:
+        if 'locked' in str(e).lower():
+            raise SlotTaken()
+        raise
+
+async def list_bookings_ending_between(since_ts, until_ts: int, status: str = 'scheduled'):
+    """Bookings in ``status`` whose end_ts is in (since_ts, until_ts]; since_ts may be None."""
+    async with get_db() as db:
+        if since_ts is None:
+            cur = await db.execute('SELECT * FROM bookings WHERE status=? AND end_ts<=? ORDER BY end_ts', (status, until_ts))
+        else:
+            cur = await db.execute('SELECT * FROM bookings WHERE status=? AND end_ts>? AND end_ts<=? ORDER BY end_ts', (status, since_ts, until_ts))
+        return await cur.fetchall()
+
+async def complete_bookings_ended_by(until_ts: int, review_rating: int = 5, booking_ids=None):
+    """Complete every scheduled booking whose end_ts <= until_ts; returns the completed rows.
+
+    With booking_ids only those bookings are considered. One UPDATE ...
+    RETURNING (per chunk of ids) moves them all, so a booking completed or
+    cancelled concurrently (e.g. by an admin) is never processed twice. In the
+    same transaction each booking whose user exists gets the automatic review
+    (create_review semantics), written in batch by _upsert_reviews.
+    """
+    returning = 'RETURNING id, user_id, service_id, master_id, date, time, end_time, start_ts, end_ts'
+
+    async def _op(db):
+        if booking_ids is None:
+            cur = await db.execute(
+                f"UPDATE bookings SET status='completed' WHERE status='scheduled' AND end_ts<=? {returning}", (until_ts,))
+            rows = await cur.fetchall()
+        else:
+            rows = []
+            ids = list(dict.fromkeys(booking_ids))
+            for start in range(0, len(ids), _IN_CHUNK):
+                chunk = ids[start:start + _IN_CHUNK]
+                cur = await db.execute(
+                    f"UPDATE bookings SET status='completed' WHERE id IN ({','.join('?' * len(chunk))}) "
+                    f"AND status='scheduled' AND end_ts<=? {returning}", (*chunk, until_ts))
+                rows += await cur.fetchall()
+        rows = sorted(rows, key=lambda r: (r['end_ts'], r['id']))
+        if not rows:
+            return rows
+        users = set()
+        user_ids = list({r['user_id'] for r in rows})
+        for start in range(0, len(user_ids), _IN_CHUNK):
+            chunk = user_ids[start:start + _IN_CHUNK]
+            cur = await db.execute(f'SELECT id FROM users WHERE id IN ({",".join("?" * len(chunk))})', chunk)
+            users.update(r['id'] for r in await cur.fetchall())
+        await _upsert_reviews(db, [(r['user_id'], r['service_id'], r['master_id']) for r in rows if r['user_id'] in users],
+                              review_rating, None)
+        for r in rows:
+            if r['master_id'] is None:
+                continue
+            on_commit(lambda r=r: availability.invalidate_span(r['master_id'], r['start_ts'], r['end_ts']))
+        return rows
+    return await run_write(_op)
+
+async def get_bookings(booking_ids):
+    """get_booking for many ids, one query per chunk of ids."""
+    ids = list(dict.fromkeys(booking_ids))
+    rows = []
+    async with get_db() as db:
+        for start in range(0, len(ids), _IN_CHUNK):
+            chunk = ids[start:start + _IN_CHUNK]
+            cur = await db.execute(f'SELECT * FROM bookings WHERE id IN ({",".join("?" * len(chunk))})', chunk)
+            rows += await cur.fetchall()
+    return rows
 
 async def list_bookings():
     async with get_db() as db:
@@ -179,9 +375,16 @@ async def get_booking(booking_id: int):
 
 
 async def set_booking_status(booking_id: int, status: str):
-    async with get_db() as db:
+    async def _op(db):
+        cur = await db.execute('SELECT master_id, start_ts, end_ts FROM bookings WHERE id=?', (booking_id,))
+        row = await cur.fetchone()
         await db.execute('UPDATE bookings SET status=? WHERE id=?', (status, booking_id))
-        await db.commit()
+        if row and row['master_id'] is not None:
+            if row['start_ts'] is None:
+                on_commit(lambda: availability.invalidate_bookings(row['master_id']))
+            else:
+                on_commit(lambda: availability.invalidate_span(row['master_id'], row['start_ts'], row['end_ts']))
+    await run_write(_op)
 
 
 async def set_reminder_sent(booking_id: int, which: str):
@@ -196,9 +399,31 @@ async def set_reminder_sent(booking_id: int, which: str):
         col = 'reminded_1'
     else:
         return
-    async with get_db() as db:
+    async def _op(db):
         await db.execute(f'UPDATE bookings SET {col}=? WHERE id=?', (1, booking_id))
-        await db.commit()
+    await run_write(_op)
+
+async def set_reminders_sent(booking_ids, which: str):
+    """set_reminder_sent for many bookings with one executemany."""
+    col = {'24h': 'reminded_24', '1h': 'reminded_1'}.get(which)
+    if col is None or not booking_ids:
+        return
+    async def _op(db):
+        await db.executemany(f'UPDATE bookings SET {col}=1 WHERE id=?', [(bid,) for bid in booking_ids])
+    await run_write(_op)
+
+async def list_reminder_targets(booking_ids):
+    """Bookings with their user's tg_id (NULL without a user), one query per chunk of ids."""
+    ids = list(dict.fromkeys(booking_ids))
+    rows = []
+    async with get_db() as db:
+        for start in range(0, len(ids), _IN_CHUNK):
+            chunk = ids[start:start + _IN_CHUNK]
+            cur = await db.execute(
+                f'SELECT b.id, b.date, b.time, b.status, b.reminded_24, b.reminded_1, u.tg_id '
+                f'FROM bookings b LEFT JOIN users u ON u.id=b.user_id WHERE b.id IN ({",".join("?" * len(chunk))})', chunk)
+            rows += await cur.fetchall()
+    return rows
 
 async def get_user_by_id(user_id: int):
     async with get_db() as db:
@@ -208,7 +433,7 @@ async def get_user_by_id(user_id: int):
 
 
 async def add_exception(master_id: int, date_s: str, available: int = 1, start_time: str = None, end_time: str = None, note: str = None):
-    async with get_db() as db:
+    async def _op(db):
         # upsert
         cur = await db.execute('SELECT id FROM master_exceptions WHERE master_id=? AND date=?', (master_id, date_s))
         row = await cur.fetchone()
@@ -216,7 +441,8 @@ async def add_exception(master_id: int, date_s: str, available: int = 1, start_t
             await db.execute('UPDATE master_exceptions SET available=?, start_time=?, end_time=?, note=? WHERE id=?', (available, start_time, end_time, note, row['id']))
         else:
             await db.execute('INSERT INTO master_exceptions (master_id, date, start_time, end_time, available, note) VALUES (?,?,?,?,?,?)', (master_id, date_s, start_time, end_time, available, note))
-        await db.commit()
+        on_commit(lambda: availability.invalidate_schedule(master_id, date_s))
+    await run_write(_op)
 
 async def list_exceptions(master_id: int):
     async with get_db() as db:
@@ -229,10 +455,10 @@ async def list_exceptions(master_id: int):
 # Manual request CRUD (for cases when no slots available)
 # TODO: FROZEN for MVP demo — manual request flow is secondary for demo
 async def create_manual_request(user_id: int, text: str):
-    async with get_db() as db:
+    async def _op(db):
         cur = await db.execute('INSERT INTO manual_requests (user_id, text, processed) VALUES (?,?,0)', (user_id, text))
-        await db.commit()
         return cur.lastrowid
+    return await run_write(_op)
 
 async def list_manual_requests(limit: int = 100):
     async with get_db() as db:
@@ -241,25 +467,86 @@ async def list_manual_requests(limit: int = 100):
         return rows
 
 async def set_manual_request_processed(request_id: int, processed: int = 1):
-    async with get_db() as db:
+    async def _op(db):
         await db.execute('UPDATE manual_requests SET processed=? WHERE id=?', (processed, request_id))
-        await db.commit()
+    await run_write(_op)
 
 # Reviews CRUD and aggregation
-async def create_review(user_id: int, service_id: int = None, master_id: int = None, rating: int = 5, text: str = None):
-    async with get_db() as db:
-        # Проверяем, есть ли уже отзыв для этой записи (user_id, service_id, master_id)
-        cur = await db.execute('SELECT id FROM reviews WHERE user_id=? AND service_id IS ? AND master_id IS ?', (user_id, service_id, master_id))
-        row = await cur.fetchone()
+_RATING_STATS_UPSERT = (
+    'INSERT INTO rating_stats (subject_type, subject_id, rating_sum, rating_count, last_updated) '
+    'VALUES (?,?,?,?,CURRENT_TIMESTAMP) '
+    'ON CONFLICT(subject_type, subject_id) DO UPDATE SET '
+    'rating_sum=rating_sum+excluded.rating_sum, rating_count=rating_count+excluded.rating_count, '
+    'last_updated=CURRENT_TIMESTAMP')
+
+async def _bump_rating_stats(db, service_id, master_id, rating_delta, count_delta):
+    # keeps rating_stats in step with reviews; must run inside the review write
+    for subject_type, subject_id in (('master', master_id), ('service', service_id)):
+        if subject_id is None:
+            continue
+        await db.execute(_RATING_STATS_UPSERT, (subject_type, subject_id, rating_delta, count_delta))
+
+async def _upsert_review(db, user_id, service_id, master_id, rating, text):
+    # Проверяем, есть ли уже отзыв для этой записи (user_id, service_id, master_id)
+    cur = await db.execute('SELECT id, rating FROM reviews WHERE user_id=? AND service_id IS ? AND master_id IS ?', (user_id, service_id, master_id))
+    row = await cur.fetchone()
+    if row:
+        # Обновляем существующий отзыв
+        await db.execute('UPDATE reviews SET rating=?, text=? WHERE id=?', (rating, text, row['id']))
+        await _bump_rating_stats(db, service_id, master_id, (rating or 0) - (row['rating'] or 0), 0)
+        return row['id']
+    cur = await db.execute('INSERT INTO reviews (user_id, service_id, master_id, rating, text) VALUES (?,?,?,?,?)', (user_id, service_id, master_id, rating, text))
+    await _bump_rating_stats(db, service_id, master_id, rating or 0, 1)
+    return cur.lastrowid
+
+async def _upsert_reviews(db, keys, rating, text):
+    """_upsert_review for many (user_id, service_id, master_id) keys with the same rating and text.
+
+    One lookup per chunk of users, one executemany each for the updates and
+    the inserts, and one rating_stats upsert per master and service touched.
+    """
+    keys = list(dict.fromkeys(keys))
+    if not keys:
+        return
+    wanted = set(keys)
+    existing = {}
+    user_ids = list({k[0] for k in keys})
+    for start in range(0, len(user_ids), _IN_CHUNK):
+        chunk = user_ids[start:start + _IN_CHUNK]
+        cur = await db.execute(
+            f'SELECT id, user_id, service_id, master_id, rating FROM reviews WHERE user_id IN ({",".join("?" * len(chunk))}) ORDER BY id',
+            chunk)
+        for row in await cur.fetchall():
+            key = (row['user_id'], row['service_id'], row['master_id'])
+            if key in wanted:
+                existing.setdefault(key, row)
+    deltas = {}
+
+    def bump(service_id, master_id, rating_delta, count_delta):
+        for subject in (('master', master_id), ('service', service_id)):
+            if subject[1] is not None:
+                acc = deltas.setdefault(subject, [0, 0])
+                acc[0] += rating_delta
+                acc[1] += count_delta
+    updates, inserts = [], []
+    for key in keys:
+        row = existing.get(key)
         if row:
-            # Обновляем существующий отзыв
-            await db.execute('UPDATE reviews SET rating=?, text=? WHERE id=?', (rating, text, row['id']))
-            await db.commit()
-            return row['id']
+            updates.append((rating, text, row['id']))
+            bump(key[1], key[2], (rating or 0) - (row['rating'] or 0), 0)
         else:
-            cur = await db.execute('INSERT INTO reviews (user_id, service_id, master_id, rating, text) VALUES (?,?,?,?,?)', (user_id, service_id, master_id, rating, text))
-            await db.commit()
-            return cur.lastrowid
+            inserts.append((*key, rating, text))
+            bump(key[1], key[2], rating or 0, 1)
+    if updates:
+        await db.executemany('UPDATE reviews SET rating=?, text=? WHERE id=?', updates)
+    if inserts:
+        await db.executemany('INSERT INTO reviews (user_id, service_id, master_id, rating, text) VALUES (?,?,?,?,?)', inserts)
+    await db.executemany(_RATING_STATS_UPSERT, [(*subject, d[0], d[1]) for subject, d in deltas.items()])
+
+async def create_review(user_id: int, service_id: int = None, master_id: int = None, rating: int = 5, text: str = None):
+    async def _op(db):
+        return await _upsert_review(db, user_id, service_id, master_id, rating, text)
+    return await run_write(_op)
 
 async def get_review(review_id: int):
     async with get_db() as db:
@@ -268,9 +555,28 @@ async def get_review(review_id: int):
         return row
 
 async def delete_review(review_id: int):
-    async with await get_db() as db:
+    async def _op(db):
+        cur = await db.execute('SELECT service_id, master_id, rating FROM reviews WHERE id=?', (review_id,))
+        row = await cur.fetchone()
+        if row is None:
+            return
         await db.execute('DELETE FROM reviews WHERE id=?', (review_id,))
-        await db.commit()
+        await _bump_rating_stats(db, row['service_id'], row['master_id'], -(row['rating'] or 0), -1)
+    await run_write(_op)
+
+async def rebuild_rating_stats():
+    """Recompute rating_stats from the reviews table; returns the number of rows written."""
+    async def _op(db):
+        await db.execute('DELETE FROM rating_stats')
+        total = 0
+        for subject_type, column in (('master', 'master_id'), ('service', 'service_id')):
+            cur = await db.execute(
+                f'INSERT INTO rating_stats (subject_type, subject_id, rating_sum, rating_count) '
+                f'SELECT ?, {column}, SUM(rating), COUNT(*) FROM reviews WHERE {column} IS NOT NULL GROUP BY {column}',
+                (subject_type,))
+            total += cur.rowcount
+        return total
+    return await run_write(_op)
 
 async def list_reviews(service_id: int = None, master_id: int = None, limit: int = None):
     async with get_db() as db:
@@ -292,17 +598,49 @@ async def list_reviews(service_id: int = None, master_id: int = None, limit: int
         rows = await cur.fetchall()
         return rows
 
-async def average_rating_for_master(master_id: int):
+def _rating_pair(row):
+    if row is None or not row['rating_count']:
+        return (0.0, 0)
+    return (row['rating_sum'] / row['rating_count'], row['rating_count'])
+
+async def _rating_stat(subject_type: str, subject_id: int):
     async with get_db() as db:
-        cur = await db.execute('SELECT AVG(rating) as avg, COUNT(*) as cnt FROM reviews WHERE master_id=?', (master_id,))
-        row = await cur.fetchone()
-        return (row['avg'] or 0.0, row['cnt'] or 0)
+        cur = await db.execute('SELECT rating_sum, rating_count FROM rating_stats WHERE subject_type=? AND subject_id=?', (subject_type, subject_id))
+        return _rating_pair(await cur.fetchone())
+
+async def average_rating_for_master(master_id: int):
+    return await _rating_stat('master', master_id)
 
 async def average_rating_for_service(service_id: int):
+    return await _rating_stat('service', service_id)
+
+# stay well below SQLite's bound-parameter limit for IN (...) lists
+_IN_CHUNK = 500
+
+async def _rating_stats(subject_type: str, ids):
+    """Return {id: (avg, cnt)} for every id, one rating_stats query per chunk of ids."""
+    ids = list(dict.fromkeys(i for i in ids if i is not None))
+    result = {i: (0.0, 0) for i in ids}
+    if not ids:
+        return result
     async with get_db() as db:
-        cur = await db.execute('SELECT AVG(rating) as avg, COUNT(*) as cnt FROM reviews WHERE service_id=?', (service_id,))
-        row = await cur.fetchone()
-        return (row['avg'] or 0.0, row['cnt'] or 0)
+        for start in range(0, len(ids), _IN_CHUNK):
+            chunk = ids[start:start + _IN_CHUNK]
+            marks = ','.join('?' * len(chunk))
+            cur = await db.execute(
+                f'SELECT subject_id, rating_sum, rating_count FROM rating_stats '
+                f'WHERE subject_type=? AND subject_id IN ({marks})', (subject_type, *chunk))
+            for row in await cur.fetchall():
+                result[row['subject_id']] = _rating_pair(row)
+    return result
+
+async def average_ratings_for_masters(master_ids):
+    """Batched average_rating_for_master: {master_id: (avg, cnt)}."""
+    return await _rating_stats('master', master_ids)
+
+async def average_ratings_for_services(service_ids):
+    """Batched average_rating_for_service: {service_id: (avg, cnt)}."""
+    return await _rating_stats('service', service_ids)
 
 
 async def get_bookings_for_export():
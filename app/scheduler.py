@@ -1,5 +1,6 @@
+import calendar
 from datetime import datetime, timedelta
-from app.db import get_db
+from app.db import get_db, run_write, on_commit
 
 def hhmm_to_minutes(t: str) -> int:
     h, m = t.split(':')
@@ -10,14 +11,26 @@ def minutes_to_hhmm(m: int) -> str:
     mm = m % 60
     return f"{h:02d}:{mm:02d}"
 
+# Bookings hold wall-clock date/time. Their epoch columns (start_ts/end_ts)
+# encode that wall-clock time as if it were UTC, which matches SQLite's
+# strftime('%s', ...) and keeps day arithmetic free of DST shifts.
+def to_ts(date_s: str, time_s: str = '00:00') -> int:
+    return calendar.timegm(datetime.fromisoformat(f"{date_s}T{time_s}").timetuple())
+
+def now_ts() -> int:
+    """Current local wall-clock time on the same scale as to_ts()."""
+    return calendar.timegm(datetime.now().timetuple())
+
 async def set_schedule(master_id: int, weekday: int, start_time: str, end_time: str, slot_interval_minutes: int = None):
-    async with get_db() as db:
+    async def _op(db):
         await db.execute('DELETE FROM master_schedule WHERE master_id=? AND weekday=?', (master_id, weekday))
         await db.execute('INSERT INTO master_schedule (master_id, weekday, start_time, end_time, slot_interval_minutes) VALUES (?,?,?,?,?)', (master_id, weekday, start_time, end_time, slot_interval_minutes))
-        await db.commit()
+        from app.availability import invalidate_schedule
+        on_commit(lambda: invalidate_schedule(master_id))
+    await run_write(_op)
 
 async def add_exception(master_id: int, date_s: str, available: int = 1, start_time: str = None, end_time: str = None, note: str = None):
-    async with get_db() as db:
+    async def _op(db):
         # upsert
         cur = await db.execute('SELECT id FROM master_exceptions WHERE master_id=? AND date=?', (master_id, date_s))
         row = await cur.fetchone()
@@ -25,7 +38,9 @@ async def add_exception(master_id: int, date_s: str, available: int = 1, start_t
             await db.execute('UPDATE master_exceptions SET available=?, start_time=?, end_time=?, note=? WHERE id=?', (available, start_time, end_time, note, row['id']))
         else:
             await db.execute('INSERT INTO master_exceptions (master_id, date, start_time, end_time, available, note) VALUES (?,?,?,?,?,?)', (master_id, date_s, start_time, end_time, available, note))
-        await db.commit()
+        from app.availability import invalidate_schedule
+        on_commit(lambda: invalidate_schedule(master_id, date_s))
+    await run_write(_op)
 
 async def list_exceptions(master_id: int):
     async with get_db() as db:
@@ -43,101 +58,65 @@ DEFAULT_END_TIME = "18:00"
 async def get_master_work_info(master_id: int):
     """Return (work_days:list[int], start_time:str, end_time:str, slot_interval:int|None)
 
-    Prefer explicit entries in master_schedule. If none, fall back to defaults.
+    Prefer explicit entries in master_schedule (earliest start, latest end). If
+    none, fall back to defaults. Served from the compiled availability
+    templates, which schedule writes and delete_master invalidate.
     """
-    async with get_db() as db:
-        cur = await db.execute('SELECT weekday, start_time, end_time, slot_interval_minutes FROM master_schedule WHERE master_id=?', (master_id,))
-        rows = await cur.fetchall()
-        if rows:
-            days = sorted({r['weekday'] for r in rows})
-            # pick earliest start and latest end for range display
-            starts = [r['start_time'] for r in rows if r['start_time']]
-            ends = [r['end_time'] for r in rows if r['end_time']]
-            start_time = min(starts) if starts else DEFAULT_START_TIME
-            end_time = max(ends) if ends else DEFAULT_END_TIME
-            # prefer to use slot_interval if provided on any row
-            ints = [r['slot_interval_minutes'] for r in rows if r['slot_interval_minutes']]
-            slot_interval = ints[0] if ints else None
-            return days, start_time, end_time, slot_interval
-        # try to read master table columns if they exist
-        try:
-            cur = await db.execute('SELECT work_days, work_start_time, work_end_time FROM masters WHERE id=?', (master_id,))
-            m = await cur.fetchone()
-            if m:
-                wd = m.get('work_days')
-                if wd:
-                    # assume comma-separated stored values like '0,1,2,3,4'
-                    try:
-                        days = [int(x) for x in str(wd).split(',') if x.strip()]
-                    except Exception:
-                        days = DEFAULT_WORK_DAYS
-                else:
-                    days = DEFAULT_WORK_DAYS
-                start_time = m.get('work_start_time') or DEFAULT_START_TIME
-                end_time = m.get('work_end_time') or DEFAULT_END_TIME
-                return days, start_time, end_time, None
-        except Exception:
-            pass
-        return DEFAULT_WORK_DAYS, DEFAULT_START_TIME, DEFAULT_END_TIME, None
-
-async def generate_slots(master_id: int, date_s: str, service_duration: int, buffer_min: int = 0):
-    async with get_db() as db:
-        # check exception
-        cur = await db.execute('SELECT * FROM master_exceptions WHERE master_id=? AND date=?', (master_id, date_s))
-        exc = await cur.fetchone()
-        if exc and exc['available'] == 0:
-            return []
-        if exc and exc['start_time'] and exc['end_time']:
-            start_time, end_time = exc['start_time'], exc['end_time']
-        else:
-                wd = datetime.fromisoformat(date_s).weekday()
-                # try to find explicit schedule for that weekday
-                cur = await db.execute('SELECT start_time, end_time, slot_interval_minutes FROM master_schedule WHERE master_id=? AND weekday=?', (master_id, wd))
-                row = await cur.fetchone()
-                if row and row['start_time'] and row['end_time']:
-                    start_time, end_time = row['start_time'], row['end_time']
-                    slot_interval = row['slot_interval_minutes'] if row['slot_interval_minutes'] else (service_duration + buffer_min)
-                else:
-                    # fall back to master-wide work info (defaults for MVP)
-                    try:
-                        from app.scheduler import get_master_work_info
-                        days, start_time, end_time, slot_interval = await get_master_work_info(master_id)
-                        # if slot_interval is None, set it to service_duration+buffer
-                        if not slot_interval:
-                            slot_interval = service_duration + buffer_min
-                        # if weekday is not in master's work days, return empty
-                        if wd not in days:
-                            return []
-                    except Exception:
-                        return []
-        slot_interval = locals().get('slot_interval', service_duration + buffer_min)
-
-        start_min = hhmm_to_minutes(start_time)
-        end_min = hhmm_to_minutes(end_time)
-        step = slot_interval
-        duration = service_duration
-
-        # get existing bookings for that master/date
-        cur = await db.execute('SELECT b.time as time, s.duration_minutes as duration FROM bookings b LEFT JOIN services s ON s.id=b.service_id WHERE b.master_id=? AND b.date=? AND b.status="scheduled"', (master_id, date_s))
-        bookings = await cur.fetchall()
-        booked_intervals = []
-        for b in bookings:
-            b_start = hhmm_to_minutes(b['time'])
-            b_dur = b['duration'] if b['duration'] else service_duration
-            booked_intervals.append((b_start, b_start + b_dur))
-
-        slots = []
-        cur_start = start_min
-        while cur_start + duration <= end_min:
-            cand_start = cur_start
-            cand_end = cur_start + duration
-            overlap = False
-            for bi_start, bi_end in booked_intervals:
-                if not (cand_end <= bi_start or cand_start >= bi_end):
-                    overlap = True
-                    break
-            if not overlap:
-                slots.append(minutes_to_hhmm(cand_start))
-            cur_start += step
-
-        return slots
+    from app.availability import work_info
+    return await work_info(master_id)
+
+async def generate_slots(master_id: int, date_s: str, service_duration: int, buffer_min: int = None):
+    """Free slot start times for a master's day; see app.availability.
+
+    ``buffer_min`` defaults to the master's buffer from master_settings (0 if unset).
+    """
+    from app.availability import get_slots
+    return await get_slots(master_id, date_s, service_duration, buffer_min)
+
+async def generate_slots_for_masters(master_ids, date_s: str, service_duration: int, buffer_min: int = None):
+    """Batched generate_slots: {master_id: slots} for one date."""
+    from app.availability import get_slots_for_masters
+    return await get_slots_for_masters(master_ids, date_s, service_duration, buffer_min)
+
+# horizon and number of slots offered by find_next_slots
+NEXT_SLOTS_DAYS = 14
+NEXT_SLOTS_LIMIT = 6
+
+async def find_next_slots(service_id: int, master_id: int = None, days: int = NEXT_SLOTS_DAYS,
+                          limit: int = NEXT_SLOTS_LIMIT, date_from: str = None):
+    """Earliest free slots for a service over the next ``days`` days.
+
+    Returns [(date, time, master_id)] ordered by date and time. All masters
+    are considered when ``master_id`` is None or 0. ``date_from`` defaults to
+    today; slots that already started are never returned.
+    """
+    from app.repo import get_service, list_masters
+    from app.availability import next_free_slots
+    svc = await get_service(service_id)
+    if not svc:
+        return []
+    master_ids = [master_id] if master_id else [m['id'] for m in await list_masters()]
+    if date_from is None:
+        date_from = datetime.now().date().isoformat()
+    return await next_free_slots(master_ids, date_from, days, svc['duration_minutes'], limit, not_before=now_ts())
+
+async def month_free_slot_counts(service_id: int, year: int, month: int, master_id: int = None):
+    """{date: free slot count} for every day of a month (0 for past days).
+
+    Counts cover all masters when ``master_id`` is None or 0 and come from one
+    pass over the compiled schedules and one bookings query for the month.
+    """
+    from app.repo import get_service, list_masters
+    from app.availability import free_slot_counts
+    first = datetime(year, month, 1).date()
+    days_in_month = calendar.monthrange(year, month)[1]
+    counts = {(first + timedelta(days=i)).isoformat(): 0 for i in range(days_in_month)}
+    svc = await get_service(service_id)
+    today = datetime.now().date()
+    start = max(first, today)
+    if not svc or start.month != month or start.year != year:
+        return counts
+    master_ids = [master_id] if master_id else [m['id'] for m in await list_masters()]
+    days = days_in_month - start.day + 1
+    counts.update(await free_slot_counts(master_ids, start.isoformat(), days, svc['duration_minutes'], not_before=now_ts()))
+    return counts
@@ -0,0 +1,21 @@
+-- indexes for hot booking/review/request queries
+
+-- user_has_active_booking and the create_booking precheck
+CREATE INDEX IF NOT EXISTS idx_bookings_user_status_date ON bookings(user_id, status, date);
+
+-- generate_slots: bookings of one master on one day (covers time/service_id)
+CREATE INDEX IF NOT EXISTS idx_bookings_master_date_status ON bookings(master_id, date, status, time, service_id);
+
+-- average_rating_for_master/service (covering AVG/COUNT) and filtered list_reviews
+CREATE INDEX IF NOT EXISTS idx_reviews_master_rating ON reviews(master_id, rating);
+CREATE INDEX IF NOT EXISTS idx_reviews_service_rating ON reviews(service_id, rating);
+
+-- create_review upsert lookup
+CREATE INDEX IF NOT EXISTS idx_reviews_user_service_master ON reviews(user_id, service_id, master_id);
+
+-- newest-first listings
+CREATE INDEX IF NOT EXISTS idx_reviews_created_at ON reviews(created_at);
+CREATE INDEX IF NOT EXISTS idx_manual_requests_created_at ON manual_requests(created_at);
+
+-- schedule lookups by master and weekday
+CREATE INDEX IF NOT EXISTS idx_master_schedule_master_weekday ON master_schedule(master_id, weekday);
@@ -0,0 +1,15 @@
+-- running rating aggregates per master and per service, kept in step with
+-- reviews by app.repo (create_review/delete_review) in the same transaction
+CREATE TABLE IF NOT EXISTS rating_stats (
+  subject_type TEXT NOT NULL,
+  subject_id INTEGER NOT NULL,
+  rating_sum INTEGER NOT NULL DEFAULT 0,
+  rating_count INTEGER NOT NULL DEFAULT 0,
+  last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY(subject_type, subject_id)
+);
+
+INSERT INTO rating_stats (subject_type, subject_id, rating_sum, rating_count)
+  SELECT 'master', master_id, SUM(rating), COUNT(*) FROM reviews WHERE master_id IS NOT NULL GROUP BY master_id;
+INSERT INTO rating_stats (subject_type, subject_id, rating_sum, rating_count)
+  SELECT 'service', service_id, SUM(rating), COUNT(*) FROM reviews WHERE service_id IS NOT NULL GROUP BY service_id;
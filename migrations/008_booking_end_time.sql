@@ -0,0 +1,17 @@
+-- store each booking's end so overlap checks are a range query on one table
+ALTER TABLE bookings ADD COLUMN end_time TEXT;
+
+-- backfill from the service duration (30 min when unknown, as in cb_confirm);
+-- bookings running past midnight end at 24:00 so string comparison holds
+UPDATE bookings SET end_time = (
+  SELECT CASE WHEN e < bookings.time THEN '24:00' ELSE e END FROM (
+    SELECT strftime('%H:%M', bookings.time, '+' || COALESCE(
+      (SELECT s.duration_minutes FROM services s WHERE s.id = bookings.service_id), 30) || ' minutes') AS e
+  )
+)
+WHERE end_time IS NULL AND time IS NOT NULL;
+
+-- overlap check and generate_slots: one master's scheduled bookings on a day,
+-- ranged on time, with end_time and service_id covered
+CREATE INDEX IF NOT EXISTS idx_bookings_master_day_span ON bookings(master_id, date, status, time, end_time, service_id);
+DROP INDEX IF EXISTS idx_bookings_master_date_status;
@@ -0,0 +1,25 @@
+-- epoch seconds of each booking's start and end for indexed range queries.
+-- Wall-clock date/time are encoded as if UTC (same as strftime('%s', ...)),
+-- see app.scheduler.to_ts.
+ALTER TABLE bookings ADD COLUMN start_ts INTEGER;
+ALTER TABLE bookings ADD COLUMN end_ts INTEGER;
+
+UPDATE bookings SET start_ts = CAST(strftime('%s', date || ' ' || time) AS INTEGER)
+WHERE date IS NOT NULL AND time IS NOT NULL;
+
+-- end_time is capped at 24:00, so prefer the service duration when known
+UPDATE bookings SET end_ts = start_ts + 60 * COALESCE(
+  (SELECT s.duration_minutes FROM services s WHERE s.id = bookings.service_id),
+  CASE WHEN end_time IS NOT NULL
+    THEN (CAST(substr(end_time, 1, 2) AS INTEGER) * 60 + CAST(substr(end_time, 4, 2) AS INTEGER))
+       - (CAST(substr(time, 1, 2) AS INTEGER) * 60 + CAST(substr(time, 4, 2) AS INTEGER))
+  END,
+  30)
+WHERE start_ts IS NOT NULL;
+
+-- overlap probe and generate_slots: a master's scheduled bookings by start
+CREATE INDEX IF NOT EXISTS idx_bookings_master_status_start ON bookings(master_id, status, start_ts, end_ts);
+-- auto-completion: scheduled bookings that ended before a moment
+CREATE INDEX IF NOT EXISTS idx_bookings_status_end ON bookings(status, end_ts);
+-- superseded by idx_bookings_master_status_start
+DROP INDEX IF EXISTS idx_bookings_master_day_span;
@@ -0,0 +1,16 @@
+-- durable background jobs (reminders, auto-completion) run by app.jobs.
+-- run_at uses the same wall-clock-as-UTC epoch scale as bookings.start_ts.
+CREATE TABLE IF NOT EXISTS jobs (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  kind TEXT NOT NULL,
+  booking_id INTEGER NOT NULL,
+  run_at INTEGER NOT NULL,
+  status TEXT NOT NULL DEFAULT 'pending',
+  attempts INTEGER NOT NULL DEFAULT 0,
+  last_error TEXT,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  UNIQUE (booking_id, kind)
+);
+
+-- the runner's window query and the purge of finished jobs
+CREATE INDEX IF NOT EXISTS idx_jobs_status_run_at ON jobs(status, run_at);
@@ -0,0 +1,5 @@
+-- job leases: a claimed job belongs to one worker (owner) until lease_until
+-- (Unix time from time.time(), fractional seconds; not the to_ts scale of
+-- run_at); expired leases are reclaimed by any worker.
+ALTER TABLE jobs ADD COLUMN owner TEXT;
+ALTER TABLE jobs ADD COLUMN lease_until REAL;
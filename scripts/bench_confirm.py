@@ -0,0 +1,81 @@
+"""Booking confirmation latency with a large booking history.
+
+Usage: python scripts/bench_confirm.py [--history 100000] [--confirmations 50]
+
+"scan" reproduces the old cb_confirm path (create_booking, then list_bookings()
+and a Python loop to find the new row); "returning-id" uses the id that
+create_booking now returns.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app import db as app_db  # noqa: E402
+from app import repo  # noqa: E402
+
+
+async def _seed_history(n, sid, mids):
+    rnd = random.Random(1)
+    start = date.today() - timedelta(days=3 * 365)
+    rows = []
+    for i in range(n):
+        d = (start + timedelta(days=i // 200)).isoformat()
+        rows.append((1_000_000 + i, sid, mids[i % len(mids)], d, f'{8 + (i % 200) // 20:02d}:{(i % 20) * 3:02d}', rnd.choice(('completed', 'cancelled'))))
+    async with app_db.get_db() as db:
+        await db.executemany('INSERT INTO bookings (user_id, service_id, master_id, date, time, status) VALUES (?,?,?,?,?,?)', rows)
+        await db.commit()
+
+
+async def _confirm_scan(user_id, sid, mid, date_s, time_s):
+    await repo.create_booking(user_id, sid, mid, date_s, time_s, 'n', 'p')
+    for b in await repo.list_bookings():
+        if b['user_id'] == user_id and b['service_id'] == sid and b['date'] == date_s and b['time'] == time_s:
+            return b['id']
+
+
+async def _confirm_returning_id(user_id, sid, mid, date_s, time_s):
+    return await repo.create_booking(user_id, sid, mid, date_s, time_s, 'n', 'p')
+
+
+async def _run(label, history, confirmations):
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DATABASE_URL'] = f"sqlite:///{Path(tmp) / 'bench.db'}"
+        await app_db.close_db()
+        await app_db.init_db()
+        sid = await repo.create_service('S', 'd', 10.0, 30)
+        mids = [await repo.create_master(f'M{i}') for i in range(20)]
+        await _seed_history(history, sid, mids)
+        confirm = _confirm_scan if label == 'scan' else _confirm_returning_id
+        date_s = (date.today() + timedelta(days=1)).isoformat()
+        timings = []
+        for i in range(confirmations):
+            started = time.perf_counter()
+            booking_id = await confirm(10_000 + i, sid, mids[i % len(mids)], date_s, f'{8 + i // 20:02d}:{(i % 20) * 3:02d}')
+            timings.append((time.perf_counter() - started) * 1000)
+            assert booking_id is not None
+        await app_db.close_db()
+    timings.sort()
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f'{label:12} history={history} median={statistics.median(timings):8.2f} ms  p95={p95:8.2f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--history', type=int, default=100_000)
+    parser.add_argument('--confirmations', type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(_run('scan', args.history, args.confirmations))
+    asyncio.run(_run('returning-id', args.history, args.confirmations))
+
+
+if __name__ == '__main__':
+    main()
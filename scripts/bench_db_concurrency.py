@@ -0,0 +1,89 @@
+"""Concurrent read/write throughput with default vs tuned SQLite pragmas.
+
+Usage: python scripts/bench_db_concurrency.py [--seconds 3] [--readers 8] [--writers 4]
+
+Runs the same mixed workload twice against a scratch database: once with
+no PRAGMAs at all (the connection's real defaults) and once with the
+runtime defaults from app.db (WAL, synchronous=NORMAL, busy_timeout, ...).
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app import db as app_db  # noqa: E402
+
+# An empty value makes app.db skip that PRAGMA, so the baseline connection
+# keeps exactly what the driver and SQLite give it (rollback journal,
+# synchronous=FULL, the sqlite3 module's own busy timeout, 2 MB cache, ...).
+BASELINE_ENV = {name: '' for name in (
+    'DB_JOURNAL_MODE', 'DB_SYNCHRONOUS', 'DB_BUSY_TIMEOUT_MS', 'DB_CACHE_SIZE',
+    'DB_MMAP_SIZE', 'DB_TEMP_STORE', 'DB_FOREIGN_KEYS',
+)}
+
+
+async def _workload(seconds, readers, writers):
+    stats = {'reads': 0, 'writes': 0, 'errors': 0}
+    deadline = time.perf_counter() + seconds
+
+    async def reader():
+        while time.perf_counter() < deadline:
+            try:
+                async with app_db.get_db() as db:
+                    cur = await db.execute('SELECT COUNT(*) FROM bookings WHERE master_id=?', (1,))
+                    await cur.fetchone()
+                stats['reads'] += 1
+            except Exception:
+                stats['errors'] += 1
+
+    async def writer(n):
+        i = 0
+        while time.perf_counter() < deadline:
+            i += 1
+            try:
+                async with app_db.get_db() as db:
+                    await db.execute(
+                        "INSERT INTO bookings (user_id, service_id, master_id, date, time, status) VALUES (?,?,?,?,?, 'scheduled')",
+                        (n, 1, 1, f'w{n}', f'{i:08d}'),
+                    )
+                    await db.commit()
+                stats['writes'] += 1
+            except Exception:
+                stats['errors'] += 1
+
+    await asyncio.gather(*[reader() for _ in range(readers)], *[writer(n) for n in range(writers)])
+    return stats
+
+
+async def _run(label, env, seconds, readers, writers):
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DATABASE_URL'] = f"sqlite:///{Path(tmp) / 'bench.db'}"
+        for k in BASELINE_ENV:
+            os.environ.pop(k, None)
+        os.environ.update(env)
+        # one connection per concurrent worker so they actually contend
+        os.environ['DB_POOL_SIZE'] = str(readers + writers)
+        await app_db.close_db()
+        await app_db.init_db()
+        stats = await _workload(seconds, readers, writers)
+        await app_db.close_db()
+    print(f"{label:8} reads/s={stats['reads'] / seconds:9.1f} writes/s={stats['writes'] / seconds:8.1f} errors={stats['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=4)
+    args = parser.parse_args()
+    asyncio.run(_run('default', BASELINE_ENV, args.seconds, args.readers, args.writers))
+    asyncio.run(_run('tuned', {}, args.seconds, args.readers, args.writers))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Next-available-slot search over a long horizon.
+
+Usage: python scripts/bench_next_slots.py [--masters 50] [--days 90] [--rounds 20]
+
+"per-day" calls generate_slots for every master and day of the horizon (the
+way the booking flow would have to probe dates one by one); "horizon" is
+scheduler.find_next_slots, which reads all bookings of the horizon with one
+range query. Booking caches are dropped before every round so both paths
+start cold. The slots are mostly booked out so the search has to walk far.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app import availability  # noqa: E402
+from app import db as app_db  # noqa: E402
+from app import repo, scheduler  # noqa: E402
+
+
+async def _seed(masters, days):
+    sid = await repo.create_service('S', 'd', 10.0, 60)
+    mids = [await repo.create_master(f'M{i}') for i in range(masters)]
+    for mid in mids:
+        for wd in range(6):
+            await scheduler.set_schedule(mid, wd, '09:00', '18:00')
+    rnd = random.Random(1)
+    first = date.today() + timedelta(days=1)
+    rows = []
+    for k in range(days):
+        d = first + timedelta(days=k)
+        for mid in mids:
+            # fully booked except for a rare free hour late in the horizon
+            for h in range(9, 18):
+                if k > days * 0.8 and rnd.random() < 0.02:
+                    continue
+                start = scheduler.to_ts(d.isoformat(), f'{h:02d}:00')
+                rows.append((len(rows) + 1, sid, mid, d.isoformat(), f'{h:02d}:00', f'{h + 1:02d}:00', start, start + 3600))
+    async with app_db.get_db() as db:
+        await db.executemany(
+            "INSERT INTO bookings (user_id, service_id, master_id, date, time, end_time, start_ts, end_ts, status) "
+            "VALUES (?,?,?,?,?,?,?,?,'scheduled')", rows)
+        await db.commit()
+    availability.invalidate_bookings()
+    return sid, mids, first.isoformat()
+
+
+async def _per_day(sid, mids, date_from, days, limit):
+    first = date.fromisoformat(date_from)
+    found = []
+    for k in range(days):
+        d = (first + timedelta(days=k)).isoformat()
+        day = []
+        for i, mid in enumerate(mids):
+            day += [(t, i, mid) for t in await scheduler.generate_slots(mid, d, 60)]
+        found += [(d, t, mid) for t, _, mid in sorted(day)]
+        if len(found) >= limit:
+            break
+    return found[:limit]
+
+
+async def _horizon(sid, mids, date_from, days, limit):
+    return await scheduler.find_next_slots(sid, days=days, limit=limit, date_from=date_from)
+
+
+async def _run(masters, days, rounds):
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DATABASE_URL'] = f"sqlite:///{Path(tmp) / 'bench.db'}"
+        await app_db.close_db()
+        await app_db.init_db()
+        sid, mids, date_from = await _seed(masters, days)
+        results = {}
+        for label, search in (('per-day', _per_day), ('horizon', _horizon)):
+            timings = []
+            for _ in range(rounds):
+                availability.invalidate_bookings()
+                started = time.perf_counter()
+                results[label] = await search(sid, mids, date_from, days, 6)
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            p95 = timings[max(0, int(len(timings) * 0.95) - 1)]
+            print(f'{label:8} masters={masters} days={days} median={statistics.median(timings):8.2f} ms  p95={p95:8.2f} ms')
+        assert results['per-day'] == results['horizon'], 'paths disagree'
+        await app_db.close_db()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--masters', type=int, default=50)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(_run(args.masters, args.days, args.rounds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Write throughput for N concurrent bookings: per-call commits vs. the group-commit writer.
+
+Usage: python scripts/bench_writes.py [--bookings 200]
+
+"per-call" reproduces the old pattern (each booking checks out a connection,
+runs its own transaction and commits); "writer" goes through
+app.repo.create_booking, which queues onto the single writer.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app import db as app_db  # noqa: E402
+from app import repo  # noqa: E402
+
+
+async def _per_call_booking(user_id, master_id, service_id, date_s, time_s):
+    async with app_db.get_db() as db:
+        await db.execute('BEGIN IMMEDIATE')
+        cur = await db.execute("SELECT COUNT(*) as c FROM bookings WHERE user_id=? AND status='scheduled' AND date>=?", (user_id, date.today().isoformat()))
+        await cur.fetchone()
+        await db.execute('INSERT INTO bookings (user_id, service_id, master_id, date, time, status, name, phone) VALUES (?,?,?,?,?,?,?,?)', (user_id, service_id, master_id, date_s, time_s, 'scheduled', 'n', 'p'))
+        await db.commit()
+
+
+async def _run(label, n):
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DATABASE_URL'] = f"sqlite:///{Path(tmp) / 'bench.db'}"
+        os.environ['DB_POOL_SIZE'] = '16'
+        await app_db.close_db()
+        await app_db.init_db()
+        sid = await repo.create_service('S', 'd', 10.0, 30)
+        mids = [await repo.create_master(f'M{i}') for i in range(10)]
+
+        def args(i):
+            # 30-minute bookings back to back (08:00-20:00), spread over masters and
+            # days so none of them overlap
+            slot, master = divmod(i, len(mids))
+            day, slot = divmod(slot, 24)
+            date_s = (date.today() + timedelta(days=1 + day)).isoformat()
+            return (10_000 + i, mids[master], sid, date_s, f'{8 + slot // 2:02d}:{30 * (slot % 2):02d}')
+
+        started = time.perf_counter()
+        if label == 'per-call':
+            await asyncio.gather(*[_per_call_booking(*args(i)) for i in range(n)])
+        else:
+            await asyncio.gather(*[repo.create_booking(u, s, m, d, t, 'n', 'p') for u, m, s, d, t in map(args, range(n))])
+        elapsed = time.perf_counter() - started
+        writer = app_db._writer
+        batches = f' batches={writer.batches}' if label == 'writer' and writer else ''
+        await app_db.close_db()
+    print(f'{label:9} {n} bookings in {elapsed * 1000:7.1f} ms  ({n / elapsed:8.1f}/s){batches}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bookings', type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(_run('per-call', args.bookings))
+    asyncio.run(_run('writer', args.bookings))
+
+
+if __name__ == '__main__':
+    main()
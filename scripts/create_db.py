@@ -1,6 +1,13 @@
 from app.db import init_db
+import argparse
 import asyncio
 
 if __name__ == '__main__':
-    asyncio.run(init_db())
-    print('DB initialized')
+    parser = argparse.ArgumentParser(description='Apply pending database migrations')
+    parser.add_argument('--dry-run', action='store_true', help='only list migrations that would be applied')
+    args = parser.parse_args()
+    migrations = asyncio.run(init_db(dry_run=args.dry_run))
+    if args.dry_run:
+        print('Pending migrations:', ', '.join(m.name for m in migrations) or 'none')
+    else:
+        print('DB initialized', f"(applied: {', '.join(m.name for m in migrations)})" if migrations else '(up to date)')
@@ -9,6 +9,9 @@ def temp_db(tmp_path, monkeypatch):
     db_file = tmp_path / 'test.db'
     # set env var for tests
     monkeypatch.setenv('DATABASE_URL', f"sqlite:///{db_file}")
+    # no periodic PRAGMA data_version reads in the middle of query-counting
+    # tests; tests of cross-process invalidation set their own interval
+    monkeypatch.setenv('DB_EXTERNAL_CHECK_MS', str(3600 * 1000))
     # init db
     asyncio.run(init_db())
     return str(db_file)
@@ -6,10 +6,13 @@ import pytest
 import logging
 from datetime import datetime, timedelta
 from unittest.mock import AsyncMock, patch, MagicMock
+from app import jobs
+from app.scheduler import to_ts
 from app.auto_complete import (
     schedule_auto_complete, 
     cancel_auto_complete,
-    _auto_complete,
+    _complete_due,
+    complete_overdue,
     GRACE_PERIOD_MINUTES
 )
 from app.repo import (
@@ -19,7 +22,13 @@ from app.repo import (
     get_or_create_user,
     set_booking_status,
     get_booking,
-    list_bookings
+    list_bookings,
+    list_reviews,
+    update_service,
+    create_review,
+    average_rating_for_master,
+    average_rating_for_service,
+    rebuild_rating_stats
 )
 
 
@@ -34,8 +43,7 @@ def enable_logging():
 class TestGracePeriodCalculation:
     """Test grace period calculation in auto-completion scheduling."""
     
-    @patch('app.auto_complete.asyncio.create_task')
-    async def test_grace_period_added_to_duration(self, mock_create_task, temp_db):
+    async def test_grace_period_added_to_duration(self, temp_db):
         """Test that grace period is correctly added to service duration."""
         # Setup
         service_duration = 30  # minutes
@@ -53,13 +61,12 @@ class TestGracePeriodCalculation:
         bid = await create_booking(user['id'], sid, mid, date_s, time_s, 'TestUser', '+7999999999')
         
         # Schedule
-        schedule_auto_complete(bid, date_s, time_s, service_duration)
+        await schedule_auto_complete(bid, date_s, time_s, service_duration)
         
-        # Verify that a task was created with correct delay
-        mock_create_task.assert_called_once()
-        task_coro = mock_create_task.call_args[0][0]
-        # Extract the delay from the coroutine by inspecting the function
-        # We can't directly access it, but we can verify scheduling happened
+        # Verify that one job was stored with the correct run time
+        [job] = await jobs.get_jobs(bid)
+        assert job['kind'] == 'auto_complete' and job['status'] == 'pending'
+        assert job['run_at'] == to_ts(date_s, time_s) + expected_total * 60
 
 
     def test_grace_period_constant_is_set(self):
@@ -68,170 +75,211 @@ class TestGracePeriodCalculation:
         assert isinstance(GRACE_PERIOD_MINUTES, int)
 
 
+async def _overdue_booking(tg_id, hour='10:00'):
+    """A booking that ended yesterday, well past its grace period."""
+    date_s = (datetime.now() - timedelta(days=1)).date().isoformat()
+    sid = await create_service('S', 'd', 10.0, 30)
+    mid = await create_master('M', 'b', 'c')
+    user = await get_or_create_user(tg_id, name='User', phone=f'+7{tg_id}')
+    return await create_booking(user['id'], sid, mid, date_s, hour, 'User', f'+7{tg_id}')
+
+
 class TestStatusChecks:
-    """Test status checks before auto-completion."""
-    
-    async def test_skip_if_already_completed(self, temp_db, caplog):
-        """Test that auto-completion is skipped if booking is already completed."""
-        # Create completed booking
-        sid = await create_service('S', 'd', 10.0, 30)
-        mid = await create_master('M', 'b', 'c')
-        user = await get_or_create_user(777, name='User', phone='+7777777777')
-        await create_booking(user['id'], sid, mid, '2026-01-15', '09:00', 'User', '+7777777777')
-        
-        # Get booking id
-        bookings = await list_bookings()
-        bid = bookings[0]['id']
-        
-        # Mark as completed before auto-completion
+    """The UPDATE ... RETURNING pass only moves bookings that are still scheduled."""
+
+    async def test_skip_if_already_completed(self, temp_db):
+        """A booking completed by an admin is neither returned nor reviewed again."""
+        bid = await _overdue_booking(777)
         await set_booking_status(bid, 'completed')
-        
-        # Run auto-complete with 0 delay
-        with caplog.at_level(logging.INFO, logger='app.auto_complete'):
-            with patch('app.auto_complete.notify_admins', new_callable=AsyncMock):
-                await _auto_complete(bid, 0)
-        
-        # Check that it was skipped in logs
-        assert 'auto_complete_skip' in caplog.text
-        assert f'booking_id={bid}' in caplog.text
-        assert 'already_completed' in caplog.text
 
+        with patch('app.auto_complete.notify_admins', new_callable=AsyncMock) as notify:
+            assert await _complete_due([bid]) is None
+            assert await complete_overdue() == []
+        notify.assert_not_awaited()
+        assert (await get_booking(bid))['status'] == 'completed'
+        assert await list_reviews() == []
 
-    async def test_skip_if_cancelled(self, temp_db, caplog):
-        """Test that auto-completion is skipped if booking is cancelled."""
-        # Create cancelled booking
-        sid = await create_service('S', 'd', 10.0, 30)
-        mid = await create_master('M', 'b', 'c')
-        user = await get_or_create_user(888, name='User', phone='+7888888888')
-        await create_booking(user['id'], sid, mid, '2026-01-15', '10:00', 'User', '+7888888888')
-        
-        # Get booking id
-        bookings = await list_bookings()
-        bid = bookings[0]['id']
-        
-        # Mark as cancelled before auto-completion
+    async def test_skip_if_cancelled(self, temp_db):
+        """A cancelled booking stays cancelled."""
+        bid = await _overdue_booking(888)
         await set_booking_status(bid, 'cancelled')
-        
-        # Run auto-complete with 0 delay
-        with caplog.at_level(logging.INFO, logger='app.auto_complete'):
-            with patch('app.auto_complete.notify_admins', new_callable=AsyncMock):
-                await _auto_complete(bid, 0)
-        
-        # Check that it was skipped in logs
-        assert 'auto_complete_skip' in caplog.text
-        assert f'booking_id={bid}' in caplog.text
-        assert 'cancelled' in caplog.text
 
+        with patch('app.auto_complete.notify_admins', new_callable=AsyncMock) as notify:
+            await _complete_due([bid])
+        notify.assert_not_awaited()
+        assert (await get_booking(bid))['status'] == 'cancelled'
+        assert await list_reviews() == []
+
+    async def test_complete_if_scheduled(self, temp_db):
+        """A scheduled booking past its end and grace period is completed with an auto-review."""
+        bid = await _overdue_booking(999)
+        assert (await get_booking(bid))['status'] == 'scheduled'
 
-    async def test_complete_if_scheduled(self, temp_db, caplog):
-        """Test that auto-completion proceeds if booking is still scheduled."""
-        # Create scheduled booking
+        with patch('app.auto_complete.notify_admins', new_callable=AsyncMock):
+            await _complete_due([bid])
+        assert (await get_booking(bid))['status'] == 'completed'
+        [review] = await list_reviews()
+        assert (review['rating'], review['text']) == (5, None)
+
+    async def test_not_completed_within_grace_period(self, temp_db):
+        """A booking that ended less than GRACE_PERIOD_MINUTES ago is left scheduled."""
+        start = datetime.now() - timedelta(minutes=35)
         sid = await create_service('S', 'd', 10.0, 30)
         mid = await create_master('M', 'b', 'c')
-        user = await get_or_create_user(999, name='User', phone='+7999999999')
-        await create_booking(user['id'], sid, mid, '2026-01-15', '11:00', 'User', '+7999999999')
-        
-        # Get booking id
-        bookings = await list_bookings()
-        bid = bookings[0]['id']
-        
-        # Verify it's scheduled
-        booking = await get_booking(bid)
-        assert booking['status'] == 'scheduled'
-        
-        # Run auto-complete with 0 delay
-        with caplog.at_level(logging.INFO, logger='app.auto_complete'):
-            with patch('app.auto_complete.notify_admins', new_callable=AsyncMock):
-                with patch('app.auto_complete.create_review', new_callable=AsyncMock):
-                    await _auto_complete(bid, 0)
-        
-        # Verify it's now completed
-        booking = await get_booking(bid)
-        assert booking['status'] == 'completed'
-        
-        # Check that completion was logged
-        assert 'auto_complete:' in caplog.text
-        assert f'booking_id={bid}' in caplog.text
-        assert 'scheduled->completed' in caplog.text
+        bid = await create_booking(1, sid, mid, start.date().isoformat(), start.strftime('%H:%M'), 'U', '+1')
+
+        with patch('app.auto_complete.notify_admins', new_callable=AsyncMock):
+            assert await complete_overdue() == []
+        assert (await get_booking(bid))['status'] == 'scheduled'
 
 
 class TestLogging:
-    """Test logging of auto-completions and skips."""
-    
+    """Test logging of auto-completions."""
+
     async def test_log_successful_completion(self, temp_db, caplog):
-        """Test that successful auto-completion is logged with correct fields."""
-        sid = await create_service('S', 'd', 10.0, 30)
-        mid = await create_master('M', 'b', 'c')
-        user = await get_or_create_user(111, name='User', phone='+7111111111')
-        await create_booking(user['id'], sid, mid, '2026-01-15', '12:00', 'User', '+7111111111')
-        
-        # Get booking id
-        bookings = await list_bookings()
-        bid = bookings[0]['id']
-        
+        """The pass logs the completed ids, a timestamp and the status change."""
+        bid = await _overdue_booking(111)
+
         with caplog.at_level(logging.INFO, logger='app.auto_complete'):
             with patch('app.auto_complete.notify_admins', new_callable=AsyncMock):
-                with patch('app.auto_complete.create_review', new_callable=AsyncMock):
-                    await _auto_complete(bid, 0)
-        
-        # Check log contains all required fields
-        assert 'auto_complete:' in caplog.text
-        assert f'booking_id={bid}' in caplog.text
+                await _complete_due([bid])
+
+        assert f'auto_complete: booking_ids=[{bid}]' in caplog.text
         assert 'timestamp=' in caplog.text
         assert 'status_change=scheduled->completed' in caplog.text
 
-
-    async def test_log_skip_with_reason(self, temp_db, caplog):
-        """Test that skipped auto-completions are logged with reason."""
-        sid = await create_service('S', 'd', 10.0, 30)
-        mid = await create_master('M', 'b', 'c')
-        user = await get_or_create_user(222, name='User', phone='+7222222222')
-        await create_booking(user['id'], sid, mid, '2026-01-15', '13:00', 'User', '+7222222222')
-        
-        # Get booking id
-        bookings = await list_bookings()
-        bid = bookings[0]['id']
-        
-        # Mark as completed
+    async def test_nothing_logged_without_completions(self, temp_db, caplog):
+        """A pass that completes nothing logs nothing and sends no digest."""
+        bid = await _overdue_booking(222)
         await set_booking_status(bid, 'completed')
-        
+
         with caplog.at_level(logging.INFO, logger='app.auto_complete'):
-            with patch('app.auto_complete.notify_admins', new_callable=AsyncMock):
-                await _auto_complete(bid, 0)
-        
-        # Check skip log contains all required fields
-        assert 'auto_complete_skip:' in caplog.text
-        assert f'booking_id={bid}' in caplog.text
-        assert 'reason=already_completed' in caplog.text
-        assert 'timestamp=' in caplog.text
+            with patch('app.auto_complete.notify_admins', new_callable=AsyncMock) as notify:
+                await _complete_due([bid])
+        assert 'auto_complete:' not in caplog.text
+        notify.assert_not_awaited()
 
 
 class TestTaskScheduling:
     """Test task scheduling and cancellation."""
     
-    @patch('app.auto_complete.asyncio.create_task')
-    def test_cancel_scheduled_task(self, mock_create_task):
-        """Test that cancel_auto_complete cancels the task."""
-        # Create a mock task
-        mock_task = MagicMock()
-        mock_create_task.return_value = mock_task
-        
+    async def test_cancel_scheduled_task(self, temp_db):
+        """Test that cancel_auto_complete cancels the job."""
         bid = 123
-        # Schedule a task
-        schedule_auto_complete(bid, '2026-01-20', '14:00', 30)
+        # Schedule a job
+        await schedule_auto_complete(bid, '2026-01-20', '14:00', 30)
         
-        # Verify task was created
-        assert mock_create_task.called
+        # Verify job was created
+        assert [j['status'] for j in await jobs.get_jobs(bid)] == ['pending']
         
-        # Cancel the task
-        cancel_auto_complete(bid)
+        # Cancel the job
+        await cancel_auto_complete(bid)
         
-        # Verify cancel was called
-        mock_task.cancel.assert_called_once()
+        # Verify it is cancelled
+        assert [j['status'] for j in await jobs.get_jobs(bid)] == ['cancelled']
 
 
-    @patch('app.auto_complete.asyncio.create_task')
-    def test_cancel_nonexistent_task(self, mock_create_task):
+    async def test_cancel_nonexistent_task(self, temp_db):
         """Test that cancelling nonexistent task doesn't raise."""
         # Should not raise
-        cancel_auto_complete(999)
+        await cancel_auto_complete(999)
+
+
+class TestOverduePass:
+    """Test the set-based complete_overdue() pass."""
+
+    async def test_pass_completes_all_overdue_with_one_digest(self, temp_db):
+        """All overdue bookings complete in one pass, with reviews and a single admin digest."""
+        base = datetime.now() - timedelta(hours=3)
+        date_s = base.date().isoformat()
+        sid = await create_service('S', 'd', 10.0, 30)
+        bids = []
+        for i in range(5):
+            mid = await create_master(f'M{i}', 'b', 'c')
+            user = await get_or_create_user(6000 + i, name='U', phone=f'+7600000000{i}')
+            bids.append(await create_booking(user['id'], sid, mid, date_s, base.strftime('%H:%M'), 'U', f'+7600000000{i}'))
+        # an admin completed one already: it gets no auto-review
+        await set_booking_status(bids[0], 'completed')
+
+        with patch('app.auto_complete.notify_admins', new_callable=AsyncMock) as notify:
+            assert sorted(await complete_overdue()) == bids[1:]
+            assert await complete_overdue() == []
+        notify.assert_awaited_once()
+        assert '(4)' in notify.await_args.args[0]
+        for bid in bids:
+            assert (await get_booking(bid))['status'] == 'completed'
+        reviews = await list_reviews()
+        assert len(reviews) == 4 and {r['rating'] for r in reviews} == {5}
+
+    async def test_job_rearms_bookings_that_end_later(self, temp_db):
+        """An auto_complete job for a booking whose service got longer is re-armed."""
+        start = datetime.now() - timedelta(minutes=10)
+        date_s, time_s = start.date().isoformat(), start.strftime('%H:%M')
+        sid = await create_service('S', 'd', 10.0, 30)
+        mid = await create_master('M', 'b', 'c')
+        bid = await create_booking(1, sid, mid, date_s, time_s, 'U', '+1')
+        await update_service(sid, duration_minutes=120)
+
+        with patch('app.auto_complete.notify_admins', new_callable=AsyncMock):
+            await _complete_due([bid])
+        assert (await get_booking(bid))['status'] == 'scheduled'
+        [job] = await jobs.get_jobs(bid)
+        assert job['status'] == 'pending'
+        assert job['run_at'] == to_ts(date_s, time_s) + (120 + GRACE_PERIOD_MINUTES) * 60
+
+    async def test_job_completes_only_its_claimed_bookings(self, temp_db):
+        """An auto_complete batch leaves overdue bookings outside the batch alone."""
+        base = datetime.now() - timedelta(days=1)
+        date_s = base.date().isoformat()
+        sid = await create_service('S', 'd', 10.0, 30)
+        bids = []
+        for i in range(3):
+            mid = await create_master(f'M{i}', 'b', 'c')
+            bids.append(await create_booking(i + 1, sid, mid, date_s, base.strftime('%H:%M'), 'U', f'+{i}'))
+
+        with patch('app.auto_complete.notify_admins', new_callable=AsyncMock):
+            await _complete_due(bids[:2])
+        assert [(await get_booking(b))['status'] for b in bids] == ['completed', 'completed', 'scheduled']
+        # nothing re-armed for the completed ones
+        assert [await jobs.get_jobs(b) for b in bids] == [[], [], []]
+
+    async def test_reviews_and_rating_stats_are_written_in_batch(self, temp_db, monkeypatch):
+        """Auto-reviews replace earlier ones per (user, service, master) and rating_stats match a rebuild."""
+        import aiosqlite
+        # yesterday, so the same user may hold two bookings
+        base = (datetime.now() - timedelta(days=1)).replace(hour=10, minute=0)
+        date_s = base.date().isoformat()
+        sid = await create_service('S', 'd', 10.0, 30)
+        m1 = await create_master('M1', 'b', 'c')
+        m2 = await create_master('M2', 'b', 'c')
+        users = [await get_or_create_user(6100 + i, name='U', phone=f'+761000000{i}') for i in range(3)]
+        await create_review(users[0]['id'], sid, m1, 2, 'meh')
+        bids = [
+            await create_booking(users[0]['id'], sid, m1, date_s, base.strftime('%H:%M'), 'U', '+1'),
+            # the same user, service and master twice: one review
+            await create_booking(users[1]['id'], sid, m2, date_s, base.strftime('%H:%M'), 'U', '+2'),
+            await create_booking(users[1]['id'], sid, m2, date_s, (base + timedelta(hours=1)).strftime('%H:%M'), 'U', '+2'),
+            await create_booking(users[2]['id'], sid, m1, date_s, (base + timedelta(hours=1)).strftime('%H:%M'), 'U', '+3'),
+        ]
+
+        statements = []
+        with patch('app.auto_complete.notify_admins', new_callable=AsyncMock), monkeypatch.context() as m:
+            for name in ('execute', 'executemany'):
+                def counting(self, sql, parameters=None, _original=getattr(aiosqlite.Connection, name)):
+                    statements.append(sql)
+                    return _original(self, sql, parameters)
+                m.setattr(aiosqlite.Connection, name, counting)
+            await _complete_due(bids)
+        assert {(await get_booking(b))['status'] for b in bids} == {'completed'}
+        assert len([s for s in statements if s.startswith('INSERT INTO reviews')]) == 1
+        assert len([s for s in statements if s.startswith('UPDATE reviews')]) == 1
+        assert len([s for s in statements if s.startswith('INSERT INTO rating_stats')]) == 1
+
+        reviews = await list_reviews()
+        assert len(reviews) == 3 and {r['rating'] for r in reviews} == {5}
+        stats = (await average_rating_for_master(m1), await average_rating_for_master(m2),
+                 await average_rating_for_service(sid))
+        assert stats == ((5.0, 2), (5.0, 1), (5.0, 3))
+        await rebuild_rating_stats()
+        assert stats == (await average_rating_for_master(m1), await average_rating_for_master(m2),
+                         await average_rating_for_service(sid))
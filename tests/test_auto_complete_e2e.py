@@ -1,243 +1,120 @@
 """
-End-to-end tests for auto-completion flow (with delays, manual completion, etc.).
+End-to-end tests for auto-completion through the job runner (manual completion, cancellation, digest).
 """
 import asyncio
-import pytest
 from datetime import datetime, timedelta
 from unittest.mock import AsyncMock, patch
-from app.auto_complete import schedule_auto_complete, cancel_auto_complete, _scheduled_tasks, _auto_complete
+from app import jobs
+from app.auto_complete import schedule_auto_complete, cancel_auto_complete, GRACE_PERIOD_MINUTES, DIGEST_LIMIT
+from app.scheduler import now_ts, to_ts
 from app.repo import (
-    create_service, 
-    create_master, 
-    create_booking, 
+    create_service,
+    create_master,
+    create_booking,
     get_or_create_user,
     set_booking_status,
     get_booking,
-    list_bookings
+    list_reviews
 )
 
 
+async def _booking(tg_id, start, duration=1):
+    date_s, time_s = start.date().isoformat(), start.strftime('%H:%M')
+    sid = await create_service(f'S{tg_id}', 'desc', 50.0, duration)
+    mid = await create_master(f'M{tg_id}', 'bio', 'contact')
+    user = await get_or_create_user(tg_id, name='U', phone=f'+7{tg_id}')
+    bid = await create_booking(user['id'], sid, mid, date_s, time_s, 'U', f'+7{tg_id}')
+    await schedule_auto_complete(bid, date_s, time_s, duration)
+    return bid, user, sid, mid
+
+
+async def _run_due(now=None):
+    runner = jobs.JobRunner()
+    now = now_ts() if now is None else now
+    await runner.load(now)
+    await asyncio.gather(*await runner.run_due(now))
+
+
 class TestAutoCompleteE2E:
     """End-to-end tests for auto-completion flow."""
-    
-    async def test_auto_complete_with_short_delay(self, temp_db):
-        """Test that auto-completion works with a short delay."""
-        from app.auto_complete import GRACE_PERIOD_MINUTES
-        
-        # Setup: create a booking scheduled for the past (will trigger immediately)
-        base_time = datetime.now() - timedelta(minutes=20)
-        date_s = base_time.date().isoformat()
-        time_s = base_time.time().strftime('%H:%M')
-        
-        sid = await create_service('QuickService', 'desc', 50.0, 1)  # 1 minute duration
-        mid = await create_master('QuickMaster', 'bio', 'contact')
-        user = await get_or_create_user(3000, name='QuickUser', phone='+73000000000')
-        await create_booking(user['id'], sid, mid, date_s, time_s, 'QuickUser', '+73000000000')
-        
-        # Get the booking id
-        bookings = await list_bookings()
-        bid = bookings[0]['id']
-        
-        # Verify initial status
-        booking = await get_booking(bid)
-        assert booking['status'] == 'scheduled'
-        
-        # Instead of waiting, directly call _auto_complete with 0 delay
-        with patch('app.auto_complete.notify_admins', new_callable=AsyncMock):
-            with patch('app.auto_complete.create_review', new_callable=AsyncMock):
-                await _auto_complete(bid, 0)
-        
-        # Verify it's completed
-        booking = await get_booking(bid)
-        assert booking['status'] == 'completed'
-        
-        # Clean up scheduled tasks
-        cancel_auto_complete(bid)
 
+    async def test_due_job_completes_booking(self, temp_db):
+        """A due auto_complete job completes its booking and sends one digest."""
+        bid, *_ = await _booking(3000, datetime.now() - timedelta(days=1))
+
+        with patch('app.auto_complete.notify_admins', new_callable=AsyncMock) as notify:
+            await _run_due()
+
+        assert (await get_booking(bid))['status'] == 'completed'
+        assert [j['status'] for j in await jobs.get_jobs(bid)] == ['done']
+        notify.assert_awaited_once()
+        assert f'booking_id={bid}' in notify.await_args.args[0]
 
     async def test_manual_completion_prevents_auto_completion(self, temp_db):
-        """Test that if user manually completes booking, auto-completion is skipped."""
-        # Setup: create a booking scheduled for ~2 seconds from now
-        base_time = datetime.now() + timedelta(seconds=2)
-        date_s = base_time.date().isoformat()
-        time_s = base_time.time().strftime('%H:%M')
-        
-        sid = await create_service('ManualService', 'desc', 60.0, 1)
-        mid = await create_master('ManualMaster', 'bio', 'contact')
-        user = await get_or_create_user(3001, name='ManualUser', phone='+73001000000')
-        await create_booking(user['id'], sid, mid, date_s, time_s, 'ManualUser', '+73001000000')
-        
-        # Get the booking id
-        bookings = await list_bookings()
-        bid = bookings[0]['id']
-        
-        # Schedule auto-completion
-        with patch('app.auto_complete.notify_admins', new_callable=AsyncMock):
-            with patch('app.auto_complete.create_review', new_callable=AsyncMock):
-                schedule_auto_complete(bid, date_s, time_s, 1)
-                
-                # Manually complete the booking immediately (before auto-completion)
-                await asyncio.sleep(0.5)
-                await set_booking_status(bid, 'completed')
-                
-                # Wait for what would have been auto-completion
-                await asyncio.sleep(2.5)
-        
-        # Verify it's still completed (not double-processed)
-        booking = await get_booking(bid)
-        assert booking['status'] == 'completed'
-        
-        # Clean up
-        cancel_auto_complete(bid)
+        """A booking completed by hand is skipped by the pass: no review, no digest."""
+        bid, *_ = await _booking(3001, datetime.now() - timedelta(days=1))
+        await set_booking_status(bid, 'completed')
+
+        with patch('app.auto_complete.notify_admins', new_callable=AsyncMock) as notify:
+            await _run_due()
 
+        assert (await get_booking(bid))['status'] == 'completed'
+        assert [j['status'] for j in await jobs.get_jobs(bid)] == ['done']
+        notify.assert_not_awaited()
+        assert await list_reviews() == []
 
     async def test_cancel_auto_complete_prevents_completion(self, temp_db):
-        """Test that cancelling scheduled auto-completion prevents completion."""
-        # Setup: create a booking scheduled for ~2 seconds from now
-        base_time = datetime.now() + timedelta(seconds=2)
-        date_s = base_time.date().isoformat()
-        time_s = base_time.time().strftime('%H:%M')
-        
-        sid = await create_service('CancelService', 'desc', 70.0, 1)
-        mid = await create_master('CancelMaster', 'bio', 'contact')
-        user = await get_or_create_user(3002, name='CancelUser', phone='+73002000000')
-        bid = await create_booking(user['id'], sid, mid, date_s, time_s, 'CancelUser', '+73002000000')
-        
-        # Schedule auto-completion
-        schedule_auto_complete(bid, date_s, time_s, 1)
-        
-        # Immediately cancel it
-        cancel_auto_complete(bid)
-        
-        # Wait for what would have been auto-completion
-        await asyncio.sleep(3)
-        
-        # Verify it's NOT completed (because we cancelled the task)
-        booking = await get_booking(bid)
-        # Task is cancelled, so completion may or may not happen depending on timing
-        # The key is that we can cancel the task
-        assert bid not in _scheduled_tasks
-
-
-    async def test_auto_complete_with_user_notification(self, temp_db):
-        """Test that auto-completed booking triggers review creation and admin notification."""
-        # Use past time
-        base_time = datetime.now() - timedelta(minutes=20)
-        date_s = base_time.date().isoformat()
-        time_s = base_time.time().strftime('%H:%M')
-        
-        sid = await create_service('NotifyService', 'desc', 80.0, 1)
-        mid = await create_master('NotifyMaster', 'bio', 'contact')
-        user = await get_or_create_user(3003, name='NotifyUser', phone='+73003000000')
-        await create_booking(user['id'], sid, mid, date_s, time_s, 'NotifyUser', '+73003000000')
-        
-        # Get booking id
-        bookings = await list_bookings()
-        bid = bookings[0]['id']
-        
-        # Mock the async functions
-        notify_calls = []
-        review_calls = []
-        
-        async def mock_notify(text):
-            notify_calls.append(text)
-        
-        async def mock_review(*args, **kwargs):
-            review_calls.append((args, kwargs))
-        
-        with patch('app.auto_complete.notify_admins', side_effect=mock_notify):
-            with patch('app.auto_complete.create_review', side_effect=mock_review):
-                # Directly call with 0 delay instead of scheduling
-                await _auto_complete(bid, 0)
-        
-        # Verify completion
-        booking = await get_booking(bid)
-        assert booking['status'] == 'completed'
-        
-        # Verify review was created
-        assert len(review_calls) > 0
-        
-        # Verify admin was notified
-        assert len(notify_calls) > 0
-        assert 'booking_id=' in notify_calls[0]
-        
-        # Clean up
-        cancel_auto_complete(bid)
+        """A cancelled job never runs, even long after its time."""
+        bid, *_ = await _booking(3002, datetime.now() - timedelta(days=1))
+        await cancel_auto_complete(bid)
 
+        with patch('app.auto_complete.notify_admins', new_callable=AsyncMock) as notify:
+            await _run_due(now_ts() + 86400)
+
+        assert (await get_booking(bid))['status'] == 'scheduled'
+        assert [j['status'] for j in await jobs.get_jobs(bid)] == ['cancelled']
+        notify.assert_not_awaited()
+
+    async def test_due_jobs_share_one_admin_digest(self, temp_db):
+        """All bookings due together are completed by one pass and reported in one digest."""
+        start = datetime.now() - timedelta(days=1)
+        bids = [(await _booking(3100 + i, start))[0] for i in range(DIGEST_LIMIT + 2)]
+
+        with patch('app.auto_complete.notify_admins', new_callable=AsyncMock) as notify:
+            await _run_due()
+
+        assert {(await get_booking(b))['status'] for b in bids} == {'completed'}
+        notify.assert_awaited_once()
+        text = notify.await_args.args[0]
+        assert f'({len(bids)})' in text and 'и ещё 2' in text
 
     async def test_grace_period_respected_in_timing(self, temp_db):
-        """Test that grace period delay is respected when scheduling."""
-        from app.auto_complete import GRACE_PERIOD_MINUTES
-        
-        # Setup: create a booking scheduled for past (with grace period already passed)
-        base_time = datetime.now() - timedelta(minutes=20)
-        date_s = base_time.date().isoformat()
-        time_s = base_time.time().strftime('%H:%M')
-        
-        sid = await create_service('GraceService', 'desc', 10.0, 10)  # 10 min service
-        mid = await create_master('GraceMaster', 'bio', 'contact')
-        user = await get_or_create_user(3004, name='GraceUser', phone='+73004000000')
-        await create_booking(user['id'], sid, mid, date_s, time_s, 'GraceUser', '+73004000000')
-        
-        # Get booking id
-        bookings = await list_bookings()
-        bid = bookings[0]['id']
-        
-        # The auto-complete should be scheduled immediately (delay < 0 becomes 0)
+        """The job is not due before the booking's end plus the grace period."""
+        start = datetime.now().replace(second=0, microsecond=0) + timedelta(days=1)
+        bid, *_ = await _booking(3004, start, duration=10)
+        due_at = to_ts(start.date().isoformat(), start.strftime('%H:%M')) + (10 + GRACE_PERIOD_MINUTES) * 60
+        assert [j['run_at'] for j in await jobs.get_jobs(bid)] == [due_at]
+
         with patch('app.auto_complete.notify_admins', new_callable=AsyncMock):
-            with patch('app.auto_complete.create_review', new_callable=AsyncMock):
-                # Direct call with 0 delay
-                await _auto_complete(bid, 0)
-        
-        # Verify completion
-        booking = await get_booking(bid)
-        assert booking['status'] == 'completed'
-        
-        # Clean up
-        cancel_auto_complete(bid)
+            await _run_due(due_at - 1)
+            assert (await get_booking(bid))['status'] == 'scheduled'
+            await _run_due(due_at)
+        # the booking itself lies in the future: the pass leaves it alone and re-arms the job
+        assert (await get_booking(bid))['status'] == 'scheduled'
+        assert [j['status'] for j in await jobs.get_jobs(bid)] == ['pending']
 
 
 class TestAutoCompleteIntegration:
     """Integration tests for auto-completion with booking flow."""
-    
+
     async def test_auto_complete_creates_review_for_user(self, temp_db):
-        """Test that auto-completion creates a 5-star review."""
-        from app.repo import list_reviews
-        
-        # Use past time
-        base_time = datetime.now() - timedelta(minutes=20)
-        date_s = base_time.date().isoformat()
-        time_s = base_time.time().strftime('%H:%M')
-        
-        sid = await create_service('ReviewService', 'desc', 90.0, 1)
-        mid = await create_master('ReviewMaster', 'bio', 'contact')
-        user = await get_or_create_user(3005, name='ReviewUser', phone='+73005000000')
-        await create_booking(user['id'], sid, mid, date_s, time_s, 'ReviewUser', '+73005000000')
-        
-        # Get booking id
-        bookings = await list_bookings()
-        bid = bookings[0]['id']
-        
+        """Test that auto-completion creates a 5-star review without text."""
+        bid, user, sid, mid = await _booking(3005, datetime.now() - timedelta(days=1))
+
         with patch('app.auto_complete.notify_admins', new_callable=AsyncMock):
-            # Direct call
-            await _auto_complete(bid, 0)
-        
-        # Check reviews
-        reviews = await list_reviews()
-        booking = await get_booking(bid)
-        
-        # Find review for this user/service/master combo
-        review = next(
-            (r for r in reviews 
-             if r['user_id'] == user['id'] 
-             and r['service_id'] == sid 
-             and r['master_id'] == mid),
-            None
-        )
-        
-        assert review is not None
+            await _run_due()
+
+        [review] = await list_reviews()
+        assert (review['user_id'], review['service_id'], review['master_id']) == (user['id'], sid, mid)
         assert review['rating'] == 5
-        assert review['text'] is None  # Auto-review has no text
-        
-        # Clean up
-        cancel_auto_complete(bid)
+        assert review['text'] is None
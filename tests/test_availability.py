@@ -0,0 +1,347 @@
+import random
+from datetime import date, datetime, timedelta
+from app import availability
+from app.availability import blocked_starts, free_slots
+from app.db import get_db
+from app.repo import create_master, create_service, create_booking, set_booking_status, get_or_create_user
+from app.scheduler import (
+    set_schedule, add_exception, generate_slots, hhmm_to_minutes, minutes_to_hhmm, to_ts,
+    DEFAULT_WORK_DAYS, DEFAULT_START_TIME, DEFAULT_END_TIME,
+)
+
+
+async def _reference_slots(master_id, date_s, service_duration, buffer_min=0):
+    """The per-call SQL + nested-loop generate_slots this engine replaced."""
+    async with get_db() as db:
+        cur = await db.execute('SELECT * FROM master_exceptions WHERE master_id=? AND date=?', (master_id, date_s))
+        exc = await cur.fetchone()
+        if exc and exc['available'] == 0:
+            return []
+        slot_interval = service_duration + buffer_min
+        if exc and exc['start_time'] and exc['end_time']:
+            start_time, end_time = exc['start_time'], exc['end_time']
+        else:
+            wd = datetime.fromisoformat(date_s).weekday()
+            cur = await db.execute('SELECT start_time, end_time, slot_interval_minutes FROM master_schedule WHERE master_id=? AND weekday=? ORDER BY id', (master_id, wd))
+            row = await cur.fetchone()
+            if row and row['start_time'] and row['end_time']:
+                start_time, end_time = row['start_time'], row['end_time']
+                slot_interval = row['slot_interval_minutes'] or slot_interval
+            else:
+                cur = await db.execute('SELECT weekday, start_time, end_time, slot_interval_minutes FROM master_schedule WHERE master_id=? ORDER BY weekday, id', (master_id,))
+                rows = await cur.fetchall()
+                if rows:
+                    days = sorted({r['weekday'] for r in rows})
+                    starts = [r['start_time'] for r in rows if r['start_time']]
+                    ends = [r['end_time'] for r in rows if r['end_time']]
+                    start_time = min(starts) if starts else DEFAULT_START_TIME
+                    end_time = max(ends) if ends else DEFAULT_END_TIME
+                    ints = [r['slot_interval_minutes'] for r in rows if r['slot_interval_minutes']]
+                    slot_interval = (ints[0] if ints else None) or slot_interval
+                else:
+                    days, start_time, end_time = DEFAULT_WORK_DAYS, DEFAULT_START_TIME, DEFAULT_END_TIME
+                if wd not in days:
+                    return []
+        day_start = to_ts(date_s)
+        cur = await db.execute("SELECT start_ts, end_ts FROM bookings WHERE master_id=? AND status='scheduled' AND start_ts<? AND end_ts>?", (master_id, day_start + 86400, day_start))
+        booked = [((b['start_ts'] - day_start) // 60, (b['end_ts'] - day_start) // 60) for b in await cur.fetchall()]
+    slots = []
+    cur_start = hhmm_to_minutes(start_time)
+    end_min = hhmm_to_minutes(end_time)
+    while cur_start + service_duration <= end_min:
+        if all(cur_start + service_duration <= bs or cur_start >= be for bs, be in booked):
+            slots.append(minutes_to_hhmm(cur_start))
+        cur_start += slot_interval
+    return slots
+
+
+def test_blocked_starts_matches_naive_scan():
+    rnd = random.Random(3)
+    for _ in range(200):
+        occ = 0
+        for _ in range(rnd.randint(0, 5)):
+            s = rnd.randint(0, 1400)
+            occ |= ((1 << rnd.randint(1, 120)) - 1) << s
+        d = rnd.randint(1, 150)
+        blocked = blocked_starts(occ, d)
+        for m in range(0, 1440, 7):
+            assert bool((blocked >> m) & 1) == bool(occ & (((1 << d) - 1) << m))
+    assert free_slots(0, 540, 600, 0, 30) == []
+
+
+async def test_engine_matches_reference_on_random_data(temp_db):
+    rnd = random.Random(11)
+    sids = {d: await create_service(f'S{d}', '', 10.0, d) for d in (20, 30, 45, 60, 90)}
+    masters = [await create_master(f'M{i}') for i in range(8)]
+    base = date(2026, 3, 2)
+    days = [(base + timedelta(days=k)).isoformat() for k in range(14)]
+    for mid in masters[:6]:
+        for wd in rnd.sample(range(7), rnd.randint(1, 6)):
+            start = rnd.choice(['08:00', '09:00', '10:30'])
+            end = rnd.choice(['13:00', '17:00', '18:00', '20:00'])
+            await set_schedule(mid, wd, start, end, rnd.choice([None, 15, 30, 60]))
+    for mid in masters:
+        for d in rnd.sample(days, 3):
+            if rnd.random() < 0.4:
+                await add_exception(mid, d, available=0)
+            elif rnd.random() < 0.7:
+                await add_exception(mid, d, 1, '11:00', '15:00')
+            else:
+                await add_exception(mid, d, 1)
+    uid = 5000
+    for mid in masters:
+        for d in days:
+            for _ in range(rnd.randint(0, 6)):
+                uid += 1
+                dur = rnd.choice(list(sids))
+                t = minutes_to_hhmm(rnd.randrange(8 * 60, 20 * 60, 15))
+                try:
+                    bid = await create_booking(uid, sids[dur], mid, d, t, 'n', 'p')
+                except Exception:
+                    continue
+                if rnd.random() < 0.2:
+                    await set_booking_status(bid, 'cancelled')
+    for mid in masters:
+        for d in days:
+            for dur in (20, 30, 60):
+                assert await generate_slots(mid, d, dur) == await _reference_slots(mid, d, dur), (mid, d, dur)
+
+
+async def test_writes_invalidate_compiled_state(temp_db):
+    mid = await create_master('M')
+    sid = await create_service('S', '', 10.0, 30)
+    d = '2026-03-03'
+    wd = date.fromisoformat(d).weekday()
+    await set_schedule(mid, wd, '09:00', '10:00', 30)
+    assert await generate_slots(mid, d, 30) == ['09:00', '09:30']
+    await set_schedule(mid, wd, '09:00', '11:00', 30)
+    assert await generate_slots(mid, d, 30) == ['09:00', '09:30', '10:00', '10:30']
+    user = await get_or_create_user(42, 'U', '+37060000042')
+    bid = await create_booking(user['id'], sid, mid, d, '09:30', 'U', '+37060000042')
+    assert await generate_slots(mid, d, 30) == ['09:00', '10:00', '10:30']
+    await set_booking_status(bid, 'cancelled')
+    assert '09:30' in await generate_slots(mid, d, 30)
+    await add_exception(mid, d, 1, '14:00', '15:00')
+    assert await generate_slots(mid, d, 30) == ['14:00', '14:30']
+    await add_exception(mid, d, available=0)
+    assert await generate_slots(mid, d, 30) == []
+
+
+async def test_master_settings_buffer_and_cached_reads(temp_db):
+    from app import metrics
+    mid = await create_master('M')
+    d = '2026-03-03'
+    await set_schedule(mid, date.fromisoformat(d).weekday(), '09:00', '11:00')
+    async with get_db() as db:
+        await db.execute('INSERT INTO master_settings (master_id, buffer_minutes) VALUES (?, 15)', (mid,))
+        await db.commit()
+    availability.invalidate_schedule(mid)
+    assert await generate_slots(mid, d, 30) == ['09:00', '09:45', '10:30']
+    assert await generate_slots(mid, d, 30, buffer_min=0) == ['09:00', '09:30', '10:00', '10:30']
+    metrics.reset()
+    for _ in range(5):
+        await generate_slots(mid, d, 30)
+    counters = metrics.snapshot()['counters']
+    assert counters.get('availability.day_misses', 0) == 0
+    assert counters.get('availability.compiles', 0) == 0
+
+
+async def test_batch_slots_match_per_master_with_fixed_queries(temp_db, monkeypatch):
+    import aiosqlite
+    from app.scheduler import generate_slots_for_masters
+    sid = await create_service('S', '', 10.0, 60)
+    d = '2026-03-03'
+    wd = date.fromisoformat(d).weekday()
+    masters = [await create_master(f'M{i}') for i in range(30)]
+    for i, mid in enumerate(masters):
+        if i % 3:
+            await set_schedule(mid, wd, '09:00', f'{12 + i % 5}:00', 30)
+        if i % 4 == 0:
+            await create_booking(9000 + i, sid, mid, d, '10:00', 'n', 'p')
+    await add_exception(masters[1], d, available=0)
+
+    executed = []
+    original = aiosqlite.Connection.execute
+
+    def counting_execute(self, sql, parameters=None):
+        if not sql.startswith('PRAGMA'):
+            executed.append(sql)
+        return original(self, sql, parameters)
+
+    availability.invalidate_schedule()
+    availability.invalidate_bookings()
+    with monkeypatch.context() as m:
+        m.setattr(aiosqlite.Connection, 'execute', counting_execute)
+        batch = await generate_slots_for_masters(masters, d, 30)
+    # templates (schedule, exceptions, settings) + one bookings query
+    assert len(executed) == 4
+    assert batch[masters[1]] == []
+    for mid in masters:
+        assert batch[mid] == await generate_slots(mid, d, 30)
+    executed.clear()
+    with monkeypatch.context() as m:
+        m.setattr(aiosqlite.Connection, 'execute', counting_execute)
+        assert await generate_slots_for_masters(masters, d, 30) == batch
+    assert executed == []
+
+
+async def test_find_next_slots_matches_per_day_scan_with_one_bookings_query(temp_db, monkeypatch):
+    import aiosqlite
+    from app.scheduler import find_next_slots
+    rnd = random.Random(5)
+    sid = await create_service('S', '', 10.0, 45)
+    masters = [await create_master(f'M{i}') for i in range(10)]
+    first = date.today() + timedelta(days=1)
+    days = [(first + timedelta(days=k)).isoformat() for k in range(21)]
+    for mid in masters[:8]:
+        for wd in rnd.sample(range(7), rnd.randint(1, 3)):
+            await set_schedule(mid, wd, rnd.choice(['09:00', '12:00']), rnd.choice(['13:00', '18:00']), rnd.choice([None, 30]))
+    for mid in masters:
+        for d in rnd.sample(days, 4):
+            await add_exception(mid, d, available=0)
+        for d in days:
+            for _ in range(rnd.randint(0, 8)):
+                try:
+                    await create_booking(rnd.randrange(10**6), sid, mid, d, minutes_to_hhmm(rnd.randrange(9 * 60, 18 * 60, 15)), 'n', 'p')
+                except Exception:
+                    pass
+    expected = []
+    for d in days:
+        day = []
+        for i, mid in enumerate(masters):
+            day += [(t, i, mid) for t in await generate_slots(mid, d, 45)]
+        expected += [(d, t, mid) for t, _, mid in sorted(day)]
+
+    queries = []
+    original = aiosqlite.Connection.execute
+
+    def counting_execute(self, sql, parameters=None):
+        queries.append(sql)
+        return original(self, sql, parameters)
+
+    availability.invalidate_bookings()
+    with monkeypatch.context() as m:
+        m.setattr(aiosqlite.Connection, 'execute', counting_execute)
+        found = await find_next_slots(sid, days=21, limit=60, date_from=days[0])
+    assert found == expected[:60]
+    assert len([q for q in queries if 'FROM bookings' in q]) == 1
+    assert await find_next_slots(sid, masters[2], days=21, limit=5, date_from=days[0]) == [s for s in expected if s[2] == masters[2]][:5]
+    assert await find_next_slots(sid, masters[9], days=21, limit=1000, date_from=days[0]) == [s for s in expected if s[2] == masters[9]]
+
+
+async def test_find_next_slots_skips_started_slots(temp_db):
+    from app.scheduler import find_next_slots
+    sid = await create_service('S', '', 10.0, 30)
+    mid = await create_master('M')
+    for wd in range(7):
+        await set_schedule(mid, wd, '00:00', '24:00', 30)
+    now = datetime.now()
+    found = await find_next_slots(sid, mid, days=2, limit=100)
+    assert found and all(f'{d}T{t}' >= now.strftime('%Y-%m-%dT%H:%M') for d, t, _ in found)
+    assert await find_next_slots(999, mid) == []
+
+
+async def test_slot_lists_are_cached_and_invalidated_per_master_day(temp_db, monkeypatch):
+    import aiosqlite
+    from app import metrics
+    sid = await create_service('S', '', 10.0, 30)
+    a, b = await create_master('A'), await create_master('B')
+    d1, d2 = '2026-03-03', '2026-03-04'
+    for mid in (a, b):
+        for d in (d1, d2):
+            await set_schedule(mid, date.fromisoformat(d).weekday(), '09:00', '11:00', 30)
+    for mid in (a, b):
+        for d in (d1, d2):
+            await generate_slots(mid, d, 30)
+    metrics.reset()
+    executed = []
+    original = aiosqlite.Connection.execute
+
+    def counting_execute(self, sql, parameters=None):
+        if not sql.startswith('PRAGMA'):
+            executed.append(sql)
+        return original(self, sql, parameters)
+
+    with monkeypatch.context() as m:
+        m.setattr(aiosqlite.Connection, 'execute', counting_execute)
+        assert await generate_slots(a, d1, 30) == ['09:00', '09:30', '10:00', '10:30']
+    assert executed == []
+    await create_booking(77, sid, a, d1, '09:30', 'n', 'p')
+    assert await generate_slots(a, d1, 30) == ['09:00', '10:00', '10:30']
+    # other masters and days of the same master were not dropped
+    hits = metrics.snapshot()['counters']['availability.slot_hits']
+    await generate_slots(a, d2, 30)
+    await generate_slots(b, d1, 30)
+    assert metrics.snapshot()['counters']['availability.slot_hits'] == hits + 2
+    await add_exception(b, d1, available=0)
+    assert await generate_slots(b, d1, 30) == []
+    assert await generate_slots(b, d2, 30) == ['09:00', '09:30', '10:00', '10:30']
+    assert 'availability.slot_hit_ratio' in metrics.format_snapshot()
+
+
+async def test_slots_computed_across_a_commit_are_not_cached(temp_db, monkeypatch):
+    import asyncio
+    sid = await create_service('S', '', 10.0, 30)
+    mid = await create_master('M')
+    d = '2026-03-03'
+    await set_schedule(mid, date.fromisoformat(d).weekday(), '09:00', '11:00', 30)
+    loaded, release = asyncio.Event(), asyncio.Event()
+    original = availability._Engine.occupancy_days
+
+    async def slow_occupancy_days(self, keys):
+        result = await original(self, keys)
+        loaded.set()
+        await release.wait()
+        return result
+
+    with monkeypatch.context() as m:
+        m.setattr(availability._Engine, 'occupancy_days', slow_occupancy_days)
+        reader = asyncio.create_task(generate_slots(mid, d, 30))
+        await loaded.wait()
+        # commits after the reader loaded the day, before it finishes
+        await create_booking(78, sid, mid, d, '10:00', 'n', 'p')
+        release.set()
+        assert '10:00' in await reader
+    assert '10:00' not in await generate_slots(mid, d, 30)
+
+
+async def test_month_counts_match_generate_slots_with_one_bookings_query(temp_db, monkeypatch):
+    import aiosqlite
+    import calendar as cal
+    from app.scheduler import month_free_slot_counts
+    rnd = random.Random(9)
+    sid = await create_service('S', '', 10.0, 30)
+    masters = [await create_master(f'M{i}') for i in range(6)]
+    target = date.today().replace(day=1) + timedelta(days=40)
+    year, month = target.year, target.month
+    days = [date(year, month, k).isoformat() for k in range(1, cal.monthrange(year, month)[1] + 1)]
+    for mid in masters[:5]:
+        for wd in rnd.sample(range(7), 4):
+            await set_schedule(mid, wd, '10:00', rnd.choice(['12:00', '16:00']), 30)
+        await add_exception(mid, rnd.choice(days), available=0)
+        for d in rnd.sample(days, 10):
+            await create_booking(rnd.randrange(10**6), sid, mid, d, rnd.choice(['10:00', '11:00', '12:30']), 'n', 'p')
+
+    queries = []
+    original = aiosqlite.Connection.execute
+
+    def counting_execute(self, sql, parameters=None):
+        queries.append(sql)
+        return original(self, sql, parameters)
+
+    availability.invalidate_bookings()
+    with monkeypatch.context() as m:
+        m.setattr(aiosqlite.Connection, 'execute', counting_execute)
+        counts = await month_free_slot_counts(sid, year, month)
+    assert len([q for q in queries if 'FROM bookings' in q]) == 1
+    assert list(counts) == days
+    for d in days:
+        expected = 0
+        for mid in masters:
+            expected += len(await generate_slots(mid, d, 30))
+        assert counts[d] == expected, d
+    one = await month_free_slot_counts(sid, year, month, masters[0])
+    assert one == {d: len(await generate_slots(masters[0], d, 30)) for d in days}
+    last_year = await month_free_slot_counts(sid, date.today().year - 1, 1)
+    assert set(last_year.values()) == {0}
+
@@ -0,0 +1,116 @@
+import asyncio
+import sqlite3
+import time
+from datetime import date, timedelta
+import pytest
+from app import metrics
+from app.db import get_db
+from app.repo import create_master, create_service, get_or_create_user, create_booking, SlotTaken, DoubleBooking
+
+
+async def _measure_loop_lag(stop: asyncio.Event, lags: list, tick=0.005):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(tick)
+        lags.append(time.perf_counter() - started - tick)
+
+
+async def _book_all(users, sid, mid, d, t):
+    async def attempt(user):
+        try:
+            await create_booking(user['id'], sid, mid, d, t, user['name'], user['phone'])
+            return 'ok'
+        except (SlotTaken, DoubleBooking):
+            return 'lost'
+    return await asyncio.gather(*(attempt(u) for u in users))
+
+
+async def _fixture():
+    mid = await create_master('Stress Master')
+    sid = await create_service('Stress Service', 'd', 10.0, 30)
+    users = [await get_or_create_user(700000 + i, f'U{i}', f'+3706000{i:04d}') for i in range(100)]
+    return mid, sid, users, (date.today() + timedelta(days=1)).isoformat()
+
+
+async def test_many_concurrent_bookings_one_winner(temp_db):
+    mid, sid, users, d = await _fixture()
+    stop, lags = asyncio.Event(), []
+    ticker = asyncio.create_task(_measure_loop_lag(stop, lags))
+    results = await _book_all(users, sid, mid, d, '10:00')
+    stop.set()
+    await ticker
+    assert results.count('ok') == 1
+    assert results.count('lost') == len(users) - 1
+    assert max(lags) < 0.25
+
+
+async def test_external_write_lock_is_waited_out_without_blocking_loop(temp_db, monkeypatch):
+    monkeypatch.setenv('DB_LOCK_DEADLINE_MS', '3000')
+    mid, sid, users, d = await _fixture()
+    metrics.reset()
+    # another process holds the write lock for a while
+    other = sqlite3.connect(temp_db, isolation_level=None, check_same_thread=False)
+    other.execute('BEGIN IMMEDIATE')
+    asyncio.get_running_loop().call_later(0.4, other.execute, 'COMMIT')
+    stop, lags = asyncio.Event(), []
+    ticker = asyncio.create_task(_measure_loop_lag(stop, lags))
+    started = time.perf_counter()
+    results = await _book_all(users[:20], sid, mid, d, '11:00')
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await ticker
+    other.close()
+    assert results.count('ok') == 1
+    assert elapsed >= 0.35
+    assert max(lags) < 0.25
+    snap = metrics.snapshot()
+    assert snap['counters']['db.write.lock_retries'] > 0
+    assert snap['timings']['db.write.lock_wait_ms']['max'] >= 300
+
+
+async def test_lock_deadline_surfaces_as_slot_taken(temp_db, monkeypatch):
+    monkeypatch.setenv('DB_LOCK_DEADLINE_MS', '200')
+    mid, sid, users, d = await _fixture()
+    other = sqlite3.connect(temp_db, isolation_level=None)
+    other.execute('BEGIN IMMEDIATE')
+    try:
+        started = time.perf_counter()
+        with pytest.raises(SlotTaken):
+            await create_booking(users[0]['id'], sid, mid, d, '12:00', 'U', '+37060000000')
+        assert 0.15 <= time.perf_counter() - started < 2
+    finally:
+        other.execute('ROLLBACK')
+        other.close()
+    assert await create_booking(users[0]['id'], sid, mid, d, '12:00', 'U', '+37060000000')
+
+
+async def test_parallel_overlapping_bookings_one_winner(temp_db):
+    mid = await create_master('Overlap Master')
+    long_sid = await create_service('Long', 'd', 10.0, 60)
+    short_sid = await create_service('Short', 'd', 10.0, 30)
+    users = [await get_or_create_user(710000 + i, f'O{i}', f'+3706100{i:04d}') for i in range(6)]
+    d = (date.today() + timedelta(days=1)).isoformat()
+    # pairwise overlapping: 10:00-11:00, 10:20-10:50, 09:30-10:30, 10:15-10:45
+    requests = [
+        (users[0], long_sid, '10:00'),
+        (users[1], short_sid, '10:20'),
+        (users[2], long_sid, '09:30'),
+        (users[3], short_sid, '10:15'),
+    ]
+
+    async def attempt(user, sid, t):
+        try:
+            await create_booking(user['id'], sid, mid, d, t, user['name'], user['phone'])
+            return 'ok'
+        except SlotTaken:
+            return 'taken'
+
+    for _ in range(5):
+        results = await asyncio.gather(*(attempt(*r) for r in requests))
+        assert results.count('ok') == 1
+        async with get_db() as db:
+            await db.execute('DELETE FROM bookings')
+            await db.commit()
+    # back-to-back bookings don't overlap
+    assert await create_booking(users[4]['id'], long_sid, mid, d, '10:00', 'A', '+1')
+    assert await create_booking(users[5]['id'], short_sid, mid, d, '11:00', 'B', '+2')
@@ -48,7 +48,7 @@ class FakeCallback:
         self.from_user = SimpleNamespace(id=user_id)
         self.message = message
         self.answered = None
-    async def answer(self, text, show_alert=False):
+    async def answer(self, text="", show_alert=False):
         self.answered = {'text': text, 'show_alert': show_alert}
 
 class FakeMessage:
@@ -106,3 +106,94 @@ def test_booking_date_flow(temp_db):
         assert any(':' in t or t.count(':')==0 for t in texts) or texts, f'unexpected buttons: {texts}'
 
     asyncio.run(_run())
+
+
+def test_master_choice_offers_next_free_slots(temp_db):
+    async def _run():
+        from app.repo import create_service, create_master
+        from app.scheduler import set_schedule
+        from datetime import date, timedelta
+        sid = await create_service('S Next', 'desc', 25.0, 30)
+        mid = await create_master('M Next', 'bio', 'contact')
+        tomorrow = date.today() + timedelta(days=1)
+        await set_schedule(mid, tomorrow.weekday(), '09:00', '10:00')
+        state = FakeState({'service_id': sid})
+        cb_msg = FakeCallbackMessage(1)
+        await booking_handlers.cb_select_master(FakeCallback(f'book:master:{mid}', 1, cb_msg), state)
+        offer = next(r for r in cb_msg.replies if 'reply_markup' in r)
+        data = [btn.callback_data for row in offer['reply_markup'].inline_keyboard for btn in row]
+        assert data[0] == f'book:slot:{mid}:{tomorrow.isoformat()}:09:00'
+        assert any('Введите дату' in r['text'] for r in cb_msg.replies)
+
+        slot_msg = FakeCallbackMessage(1)
+        await booking_handlers.cb_select_slot(FakeCallback(data[0], 1, slot_msg), state)
+        st = await state.get_data()
+        assert (st['master_id'], st['date'], st['time']) == (mid, tomorrow.isoformat(), '09:00')
+        assert st['_state'] == booking_handlers.BookingStates.NAME.state
+    asyncio.run(_run())
+
+
+def test_calendar_offers_days_with_counts_and_picks_a_date(temp_db):
+    async def _run():
+        from app.repo import create_service, create_master
+        from app.scheduler import set_schedule
+        from app.keyboards import booking_calendar_kb
+        from datetime import date, timedelta
+        sid = await create_service('S Cal', 'desc', 25.0, 30)
+        mid = await create_master('M Cal', 'bio', 'contact')
+        day = date.today() + timedelta(days=1)
+        await set_schedule(mid, day.weekday(), '09:00', '10:30')
+        state = FakeState({'service_id': sid, 'booking_user_id': 1})
+        cb_msg = FakeCallbackMessage(1)
+        await booking_handlers.cb_select_master(FakeCallback(f'book:master:{mid}', 1, cb_msg), state)
+        prompt = next(r for r in cb_msg.replies if 'Введите дату' in r['text'])
+        if day.month == date.today().month:
+            buttons = {btn.callback_data: btn.text for row in prompt['reply_markup'].inline_keyboard for btn in row}
+            assert buttons[f'book:date:{day.isoformat()}'] == f'{day.day} (3)'
+            # only the scheduled weekday has free slots
+            assert {date.fromisoformat(k.split(':')[-1]).weekday() for k in buttons if k.startswith('book:date:')} == {day.weekday()}
+
+        pick_msg = FakeCallbackMessage(1)
+        await booking_handlers.cb_pick_date(FakeCallback(f'book:date:{day.isoformat()}', 1, pick_msg), state)
+        times = [btn.text for row in pick_msg.replies[-1]['reply_markup'].inline_keyboard for btn in row]
+        assert times == ['09:00', '09:30', '10:00']
+        assert (await state.get_data())['date'] == day.isoformat()
+
+        nxt = date.today().replace(day=1) + timedelta(days=32)
+        page_msg = FakeCallbackMessage(1)
+        cb = FakeCallback(f'book:cal:{nxt.year:04d}-{nxt.month:02d}', 1, page_msg)
+        await booking_handlers.cb_calendar_page(cb, state)
+        header = page_msg.replies[-1]['reply_markup'].inline_keyboard[0]
+        assert header[0].callback_data.startswith('book:cal:') and header[0].callback_data != 'book:cal:none'
+
+        kb = booking_calendar_kb(2026, 2, {'2026-02-10': 4}, today=date(2026, 2, 5))
+        assert kb.inline_keyboard[0][0].callback_data == 'book:cal:none'
+        assert kb.inline_keyboard[0][2].callback_data == 'book:cal:2026-03'
+        assert kb.inline_keyboard[1][0].text == 'Пн'
+        labels = [btn.text for row in kb.inline_keyboard[2:] for btn in row]
+        assert '10 (4)' in labels and ' ' in labels and '·11·' in labels
+    asyncio.run(_run())
+
+
+def test_confirm_survives_auto_complete_scheduling_failure(temp_db, monkeypatch):
+    async def _run():
+        from app import jobs
+        from app.repo import create_service, create_master, list_bookings
+        from datetime import date, timedelta
+        sid = await create_service('S Confirm', 'desc', 25.0, 30)
+        mid = await create_master('M Confirm', 'bio', 'contact')
+        day = (date.today() + timedelta(days=3)).isoformat()
+
+        async def broken(*args):
+            raise RuntimeError('jobs table unavailable')
+        monkeypatch.setattr(booking_handlers, 'schedule_auto_complete', broken)
+        state = FakeState({'service_id': sid, 'master_id': mid, 'date': day, 'time': '10:00',
+                           'name': 'N', 'phone': '+37060000000',
+                           '_state': booking_handlers.BookingStates.CONFIRM.state})
+        msg = FakeCallbackMessage(1)
+        await booking_handlers.cb_confirm(FakeCallback('book:confirm', 1, msg), state)
+        assert any('Запись подтверждена' in r['text'] for r in msg.replies)
+        [booking] = await list_bookings()
+        # reminders are still scheduled; rehydrate recreates the auto-completion
+        assert {j['kind'] for j in await jobs.get_jobs(booking['id'])} == {'reminder_24h', 'reminder_1h'}
+    asyncio.run(_run())
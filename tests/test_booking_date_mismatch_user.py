@@ -53,3 +53,24 @@ def test_process_date_mismatched_user(temp_db):
         assert msg.replies, 'expected a reply explaining account mismatch'
         assert any('другой аккаунт' in r['text'].lower() for r in msg.replies), f'unexpected replies: {msg.replies}'
     asyncio.run(_run())
+
+
+class FakeCallback:
+    def __init__(self, data, user_id, message):
+        self.data = data
+        self.from_user = SimpleNamespace(id=user_id)
+        self.message = message
+    async def answer(self, text="", show_alert=False):
+        pass
+
+
+def test_select_slot_mismatched_user(temp_db):
+    async def _run():
+        # the slot offer was shown to user 1; user 2 presses it
+        state = FakeState({'service_id': 1, 'booking_user_id': 1, '_state': booking_handlers.BookingStates.DATE.state})
+        msg = FakeMessage(2, 2)
+        await booking_handlers.cb_select_slot(FakeCallback('book:slot:3:2030-01-07:10:00', 2, msg), state)
+        assert any('другой аккаунт' in r['text'].lower() for r in msg.replies), f'unexpected replies: {msg.replies}'
+        data = await state.get_data()
+        assert 'time' not in data and data['_state'] == booking_handlers.BookingStates.DATE.state
+    asyncio.run(_run())
@@ -0,0 +1,81 @@
+import shutil
+from datetime import date, datetime, timedelta
+from app.db import get_db, MIGRATIONS_DIR
+from app.migrations import migrate
+from app.repo import create_master, create_service, get_or_create_user, create_booking, get_booking, update_service, list_bookings_ending_between, set_booking_status
+from app.scheduler import to_ts, generate_slots
+from app.auto_complete import complete_overdue
+
+
+async def _booking(tg_id, sid, mid, d, t):
+    user = await get_or_create_user(tg_id, f'U{tg_id}', f'+3706{tg_id:07d}')
+    return await create_booking(user['id'], sid, mid, d, t, user['name'], user['phone'])
+
+
+async def test_epoch_columns_written_on_insert(temp_db):
+    mid = await create_master('M')
+    sid = await create_service('S', 'd', 10.0, 90)
+    d = (date.today() + timedelta(days=3)).isoformat()
+    b = await get_booking(await _booking(1, sid, mid, d, '23:00'))
+    assert b['start_ts'] == to_ts(d, '23:00')
+    assert b['end_ts'] - b['start_ts'] == 90 * 60
+    assert b['end_time'] == '24:00'
+
+
+async def test_service_duration_change_moves_upcoming_bookings(temp_db):
+    mid = await create_master('M')
+    sid = await create_service('S', 'd', 10.0, 30)
+    future = (date.today() + timedelta(days=3)).isoformat()
+    past = (date.today() - timedelta(days=3)).isoformat()
+    upcoming = await _booking(1, sid, mid, future, '10:00')
+    old = await _booking(2, sid, mid, past, '10:00')
+    await update_service(sid, duration_minutes=45)
+    b = await get_booking(upcoming)
+    assert (b['end_ts'] - b['start_ts'], b['end_time']) == (45 * 60, '10:45')
+    b = await get_booking(old)
+    assert b['end_ts'] - b['start_ts'] == 30 * 60
+    # the longer booking now blocks 10:30 in generate_slots
+    assert '10:30' not in await generate_slots(mid, future, 30)
+    assert '11:00' in await generate_slots(mid, future, 30)
+
+
+async def test_bookings_ending_in_window_and_overdue_completion(temp_db):
+    mid = await create_master('M')
+    sid = await create_service('S', 'd', 10.0, 60)
+    d = (date.today() - timedelta(days=1)).isoformat()
+    early = await _booking(1, sid, mid, d, '09:00')
+    late = await _booking(2, sid, mid, d, '12:00')
+    cancelled = await _booking(3, sid, mid, d, '14:00')
+    await set_booking_status(cancelled, 'cancelled')
+    # ending in the 15 minutes up to 13:05
+    rows = await list_bookings_ending_between(to_ts(d, '12:50'), to_ts(d, '13:05'))
+    assert [r['id'] for r in rows] == [late]
+    # end + 15 min grace passed only for the 09:00-10:00 booking
+    assert await complete_overdue(now=to_ts(d, '12:00')) == [early]
+    assert (await get_booking(early))['status'] == 'completed'
+    assert (await get_booking(late))['status'] == 'scheduled'
+    assert (await get_booking(cancelled))['status'] == 'cancelled'
+
+
+async def test_backfill_of_existing_bookings(tmp_path, monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'backfill.db'}")
+    mig = tmp_path / 'mig'
+    mig.mkdir()
+    files = sorted(MIGRATIONS_DIR.glob('*.sql'))
+    for f in files:
+        if int(f.name[:3]) < 9:
+            shutil.copy(f, mig / f.name)
+    async with get_db() as db:
+        await migrate(db, mig)
+        await db.execute("INSERT INTO services (id, name, duration_minutes) VALUES (1, 'S', 50)")
+        await db.execute("INSERT INTO bookings (service_id, master_id, date, time, status) VALUES (1, 1, '2026-03-01', '10:00', 'scheduled')")
+        await db.execute("INSERT INTO bookings (service_id, master_id, date, time, status) VALUES (7, 1, '2026-03-01', '12:00', 'scheduled')")
+        await db.commit()
+        for f in files:
+            shutil.copy(f, mig / f.name)
+        await migrate(db, mig)
+        cur = await db.execute('SELECT start_ts, end_ts FROM bookings ORDER BY id')
+        rows = [tuple(r) for r in await cur.fetchall()]
+    start = to_ts('2026-03-01', '10:00')
+    assert rows[0] == (start, start + 50 * 60)
+    assert rows[1] == (start + 7200, start + 7200 + 30 * 60)
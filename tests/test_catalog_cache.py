@@ -0,0 +1,114 @@
+import asyncio
+from app import metrics, repo
+from app.db import get_db
+
+
+async def test_catalog_served_from_memory_after_first_load(temp_db):
+    sid = await repo.create_service('S1', 'd', 10.0, 30)
+    mid = await repo.create_master('M1', 'b', 'c')
+    metrics.reset()
+    assert [s['name'] for s in await repo.list_services()] == ['S1']
+    assert (await repo.get_service(sid))['duration_minutes'] == 30
+    assert (await repo.get_master(mid))['name'] == 'M1'
+    assert await repo.get_master(mid + 100) is None
+    snap = metrics.snapshot()['counters']
+    assert snap['catalog.loads'] == 1
+    assert snap['catalog.hits'] == 3
+
+
+async def test_catalog_writes_invalidate(temp_db):
+    sid = await repo.create_service('S1', 'd', 10.0, 30)
+    mid = await repo.create_master('M1', 'b', 'c')
+    assert len(await repo.list_masters()) == 1
+    await repo.update_service(sid, price=20.0)
+    assert (await repo.get_service(sid))['price'] == 20.0
+    await repo.update_master(mid, name='M2')
+    assert (await repo.get_master(mid))['name'] == 'M2'
+    mid2 = await repo.create_master('M3')
+    assert {m['id'] for m in await repo.list_masters()} == {mid, mid2}
+    await repo.delete_master(mid)
+    await repo.delete_service(sid)
+    assert await repo.get_master(mid) is None
+    assert await repo.list_services() == []
+
+
+async def test_concurrent_misses_share_one_load(temp_db):
+    await repo.create_service('S1', 'd', 10.0, 30)
+    metrics.reset()
+    results = await asyncio.gather(*(repo.list_services() for _ in range(20)))
+    assert all(len(r) == 1 for r in results)
+    assert metrics.snapshot()['counters']['catalog.loads'] == 1
+
+
+async def test_records_are_immutable_rows(temp_db):
+    sid = await repo.create_service('S1', None, 10.0, 45)
+    s = await repo.get_service(sid)
+    assert s['id'] == sid and s[0] == sid
+    assert 'duration_minutes' in s
+    assert s.get('description', '') is None
+    assert s.get('missing', 'x') == 'x'
+    assert dict(s)['name'] == 'S1'
+    async with get_db() as db:
+        cur = await db.execute('SELECT * FROM services WHERE id=?', (sid,))
+        row = await cur.fetchone()
+    assert list(s.keys()) == list(row.keys())
+    assert tuple(s[k] for k in s) == tuple(row)
+    try:
+        s['name'] = 'x'
+    except TypeError:
+        pass
+    else:
+        raise AssertionError('record should be read-only')
+
+
+async def test_catalog_is_dropped_on_commit_only(temp_db):
+    await repo.create_service('S1', 'd', 10.0, 30)
+    await repo.list_services()
+    version = repo._catalog_version
+
+    async def failing(db):
+        await db.execute("UPDATE services SET name='X'")
+        raise RuntimeError('boom')
+    try:
+        await repo._catalog_write(failing)
+    except RuntimeError:
+        pass
+    # rolled back: the cached catalog is still valid
+    assert repo._catalog_version == version and repo._catalog is not None
+
+    seen = []
+
+    async def renaming(db):
+        await db.execute("UPDATE services SET name='S2'")
+        seen.append(repo._catalog_version)
+    await repo._catalog_write(renaming)
+    # not dropped while the write was uncommitted, dropped once it committed
+    assert seen == [version] and repo._catalog_version == version + 1
+    assert [s['name'] for s in await repo.list_services()] == ['S2']
+
+
+async def test_commits_of_other_processes_drop_the_caches(temp_db, monkeypatch):
+    import sqlite3
+    from app.scheduler import generate_slots
+    sid = await repo.create_service('S1', 'd', 10.0, 30)
+    mid = await repo.create_master('M1')
+    monday = '2030-01-07'
+    assert (await repo.get_service(sid))['price'] == 10.0
+    assert len(await generate_slots(mid, monday, 30)) == 18
+    metrics.reset()
+    await repo.update_service(sid, price=15.0)
+    assert (await repo.get_service(sid))['price'] == 15.0
+
+    # another bot process commits through its own connection
+    other = sqlite3.connect(temp_db)
+    other.execute('UPDATE services SET price=20 WHERE id=?', (sid,))
+    other.execute("INSERT INTO master_exceptions (master_id, date, available) VALUES (?, ?, 0)", (mid, monday))
+    other.commit()
+    other.close()
+    # seen at the next check, at most DB_EXTERNAL_CHECK_MS later
+    assert (await repo.get_service(sid))['price'] == 15.0
+    monkeypatch.setenv('DB_EXTERNAL_CHECK_MS', '0')
+    assert (await repo.get_service(sid))['price'] == 20.0
+    assert await generate_slots(mid, monday, 30) == []
+    # this process's own writes never counted as external
+    assert metrics.snapshot()['counters']['db.external_writes'] == 1
@@ -0,0 +1,66 @@
+import asyncio
+import pytest
+from app.db import get_db, close_db, _get_pool
+
+
+async def test_connection_is_reused(temp_db):
+    async with get_db() as db:
+        first = db
+    async with get_db() as db:
+        assert db is first
+    pool = await _get_pool()
+    assert pool.size == 1
+    assert pool.idle == 1
+
+
+async def test_nested_get_db_shares_connection(temp_db):
+    async with get_db() as outer:
+        async with get_db() as inner:
+            assert inner is outer
+    pool = await _get_pool()
+    assert pool.size == 1
+
+
+async def test_pool_respects_max_size(temp_db, monkeypatch):
+    monkeypatch.setenv('DB_POOL_SIZE', '2')
+    await close_db()
+    release = asyncio.Event()
+    entered = []
+
+    async def hold():
+        async with get_db() as db:
+            entered.append(db)
+            await release.wait()
+
+    holders = [asyncio.create_task(hold()) for _ in range(3)]
+    await asyncio.sleep(0.1)
+    # third checkout waits for a free slot
+    assert len(entered) == 2
+    release.set()
+    await asyncio.gather(*holders)
+    assert len(entered) == 3
+    pool = await _get_pool()
+    assert pool.size == 2
+
+
+async def test_uncommitted_transaction_rolled_back_on_return(temp_db):
+    async with get_db() as db:
+        await db.execute("INSERT INTO masters (name) VALUES ('ghost')")
+        assert db.in_transaction
+    async with get_db() as db:
+        assert not db.in_transaction
+        cur = await db.execute("SELECT COUNT(*) AS c FROM masters WHERE name='ghost'")
+        row = await cur.fetchone()
+        assert row['c'] == 0
+
+
+async def test_close_db_closes_idle_connections(temp_db):
+    async with get_db() as db:
+        conn = db
+    await close_db()
+    with pytest.raises(ValueError):
+        await conn.execute('SELECT 1')
+    # pool is recreated transparently on next use
+    async with get_db() as db:
+        cur = await db.execute('SELECT 1 AS one')
+        assert (await cur.fetchone())['one'] == 1
@@ -0,0 +1,33 @@
+from app.db import get_db, close_db, _pragma_settings
+
+
+async def _pragma(db, name):
+    cur = await db.execute(f'PRAGMA {name}')
+    row = await cur.fetchone()
+    return row[0]
+
+
+async def test_runtime_connections_use_wal_and_busy_timeout(temp_db):
+    async with get_db() as db:
+        assert (await _pragma(db, 'journal_mode')).lower() == 'wal'
+        assert await _pragma(db, 'synchronous') == 1  # NORMAL
+        assert await _pragma(db, 'busy_timeout') == 5000
+        assert await _pragma(db, 'temp_store') == 2  # MEMORY
+
+
+async def test_pragmas_configurable_from_env(temp_db, monkeypatch):
+    monkeypatch.setenv('DB_BUSY_TIMEOUT_MS', '1234')
+    monkeypatch.setenv('DB_FOREIGN_KEYS', 'on')
+    await close_db()
+    async with get_db() as db:
+        assert await _pragma(db, 'busy_timeout') == 1234
+        assert await _pragma(db, 'foreign_keys') == 1
+
+
+def test_invalid_pragma_values_are_ignored(monkeypatch):
+    monkeypatch.setenv('DB_JOURNAL_MODE', 'wal; DROP TABLE users')
+    monkeypatch.setenv('DB_CACHE_SIZE', 'lots')
+    names = dict(_pragma_settings())
+    assert 'journal_mode' not in names
+    assert 'cache_size' not in names
+    assert names['busy_timeout'] == '5000'
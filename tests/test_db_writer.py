@@ -0,0 +1,80 @@
+import asyncio
+import pytest
+from app.db import run_write, get_db, _get_writer
+from app.repo import create_master, list_masters
+
+
+async def test_concurrent_writes_are_group_committed(temp_db):
+    writer = await _get_writer()
+    ids = await asyncio.gather(*[create_master(f'M{i}') for i in range(50)])
+    assert len(set(ids)) == 50
+    assert writer.operations == 50
+    assert writer.batches < 50
+    assert len(await list_masters()) == 50
+
+
+async def test_failing_operation_does_not_affect_batch(temp_db):
+    async def bad(db):
+        await db.execute("INSERT INTO masters (name) VALUES ('rolled back')")
+        raise ValueError('boom')
+
+    results = await asyncio.gather(create_master('kept 1'), run_write(bad), create_master('kept 2'), return_exceptions=True)
+    assert isinstance(results[1], ValueError)
+    assert isinstance(results[0], int) and isinstance(results[2], int)
+    names = sorted(m['name'] for m in await list_masters())
+    assert names == ['kept 1', 'kept 2']
+
+
+async def test_result_visible_to_readers_after_return(temp_db):
+    async def op(db):
+        cur = await db.execute("INSERT INTO masters (name) VALUES ('visible')")
+        return cur.lastrowid
+
+    mid = await run_write(op)
+    async with get_db() as db:
+        cur = await db.execute('SELECT name FROM masters WHERE id=?', (mid,))
+        assert (await cur.fetchone())['name'] == 'visible'
+
+
+async def test_sql_errors_propagate_to_caller(temp_db):
+    async def op(db):
+        await db.execute('INSERT INTO no_such_table VALUES (1)')
+
+    with pytest.raises(Exception, match='no such table'):
+        await run_write(op)
+    # writer keeps serving afterwards
+    assert await create_master('after error')
+
+
+async def test_on_commit_runs_only_for_committed_operations(temp_db):
+    from app.db import on_commit
+    calls = []
+
+    def op(name, fail=False):
+        async def _op(db):
+            await db.execute('INSERT INTO masters (name) VALUES (?)', (name,))
+            on_commit(lambda: calls.append(name))
+            if fail:
+                raise ValueError(name)
+        return _op
+
+    results = await asyncio.gather(run_write(op('a')), run_write(op('b', fail=True)), run_write(op('c')), return_exceptions=True)
+    assert isinstance(results[1], ValueError)
+    assert sorted(calls) == ['a', 'c']
+    on_commit(lambda: calls.append('outside'))
+    assert calls[-1] == 'outside'
+
+
+async def test_cancelled_operation_leaves_no_open_transaction(temp_db):
+    async def cancelled(db):
+        await db.execute("INSERT INTO masters (name) VALUES ('rolled back')")
+        # e.g. the writer task cancelled at shutdown while the op awaits
+        raise asyncio.CancelledError()
+
+    with pytest.raises(asyncio.CancelledError):
+        await run_write(cancelled)
+    writer = await _get_writer()
+    assert writer._conn is None or not writer._conn.in_transaction
+    # the next BEGIN IMMEDIATE succeeds and the cancelled insert is gone
+    await create_master('after')
+    assert [m['name'] for m in await list_masters()] == ['after']
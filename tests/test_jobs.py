@@ -0,0 +1,308 @@
+import asyncio
+import time
+import aiosqlite
+from unittest.mock import AsyncMock, patch
+from app import jobs
+from app.reminders import schedule_reminders
+from app.repo import create_service, create_master, create_booking, get_or_create_user, get_booking, set_booking_status, set_reminder_sent
+from app.scheduler import now_ts, to_ts
+
+
+async def _deliver_all(messages):
+    return {key for key, _, _ in messages}, set()
+
+
+async def test_enqueue_is_idempotent_per_kind_and_booking(temp_db):
+    first = await jobs.enqueue('test', 1, 100)
+    assert await jobs.enqueue('test', 1, 200) == first
+    [job] = await jobs.get_jobs(1)
+    assert job['run_at'] == 200 and job['status'] == 'pending'
+    await schedule_reminders(2, '2030-01-10', '12:00')
+    assert [(j['kind'], j['run_at']) for j in await jobs.get_jobs(2)] == [
+        ('reminder_24h', to_ts('2030-01-09', '12:00')), ('reminder_1h', to_ts('2030-01-10', '11:00'))]
+
+
+async def test_due_job_is_claimed_once(temp_db):
+    job_id = await jobs.enqueue('test', 1, 100)
+    assert await jobs.claim(job_id, 99) is None
+    results = await asyncio.gather(*[jobs.claim(job_id, 100) for _ in range(5)])
+    claimed = [r for r in results if r]
+    assert len(claimed) == 1 and claimed[0]['attempts'] == 1
+    await jobs.complete(job_id)
+    assert (await jobs.get_jobs(1))[0]['status'] == 'done'
+
+
+async def test_failing_handler_is_retried_then_failed(temp_db, monkeypatch):
+    handler = AsyncMock(side_effect=RuntimeError('boom'))
+    monkeypatch.setitem(jobs._handlers, 'test', handler)
+    job_id = await jobs.enqueue('test', 1, 100)
+    runner = jobs.JobRunner()
+    for attempt in range(1, jobs.MAX_ATTEMPTS + 1):
+        await runner.load(now_ts())
+        await asyncio.gather(*await runner.run_due(now_ts() + 10 ** 6))
+        [job] = await jobs.get_jobs(1)
+        assert job['attempts'] == attempt and 'boom' in job['last_error']
+    assert job['status'] == 'failed'
+    assert handler.await_count == jobs.MAX_ATTEMPTS
+    assert await jobs.claim(job_id, now_ts() + 10 ** 6) is None
+
+
+async def test_runner_keeps_only_near_term_jobs(temp_db):
+    now = now_ts()
+    for bid in range(1, 6):
+        await jobs.enqueue('test', bid, now - 60)
+    for bid in range(6, 106):
+        await jobs.enqueue('test', bid, now + jobs.WINDOW + 86400 + bid)
+    runner = jobs.JobRunner()
+    await runner.load(now)
+    assert len(runner.heap) == 5
+    # pushes beyond the window stay in the table only
+    runner.push(999, now + 2 * jobs.WINDOW)
+    assert len(runner.heap) == 5
+
+
+async def test_runner_executes_booking_jobs(temp_db):
+    sid = await create_service('S', 'd', 10.0, 30)
+    mid = await create_master('M', 'b', 'c')
+    user = await get_or_create_user(4000, name='U', phone='+74000000000')
+    bid = await create_booking(user['id'], sid, mid, '2020-01-10', '10:00', 'U', '+74000000000')
+    with patch('app.reminders.notify_users', new_callable=AsyncMock, side_effect=_deliver_all) as notify:
+        jobs.start_runner()
+        try:
+            # enqueued while running: the commit hook wakes the runner
+            await schedule_reminders(bid, '2020-01-10', '10:00')
+            for _ in range(200):
+                if all(j['status'] == 'done' for j in await jobs.get_jobs(bid)):
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await jobs.stop_runner()
+    assert [j['status'] for j in await jobs.get_jobs(bid)] == ['done', 'done']
+    # one batch per reminder kind
+    assert notify.await_count == 2
+    assert [len(call.args[0]) for call in notify.await_args_list] == [1, 1]
+    b = await get_booking(bid)
+    assert b['reminded_24'] == 1 and b['reminded_1'] == 1
+
+
+async def test_rehydrate_arms_missing_jobs_once(temp_db, monkeypatch):
+    monkeypatch.setattr(jobs, 'REHYDRATE_BATCH', 2)
+    sid = await create_service('S', 'd', 10.0, 30)
+    mid = await create_master('M', 'b', 'c')
+    past = await create_booking(1, sid, mid, '2020-01-10', '10:00', 'U', '+1')
+    future = await create_booking(2, sid, mid, '2030-01-10', '10:00', 'U', '+2')
+    reminded = await create_booking(3, sid, mid, '2030-01-10', '12:00', 'U', '+3')
+    cancelled = await create_booking(4, sid, mid, '2030-01-10', '14:00', 'U', '+4')
+    await set_reminder_sent(reminded, '24h')
+    await set_booking_status(cancelled, 'cancelled')
+    # an already scheduled job is kept as is
+    await jobs.enqueue('auto_complete', future, 1)
+
+    # ending right now: still inside the grace period
+    ending = await create_booking(5, sid, mid, '2020-01-11', '10:00', 'U', '+5')
+    now = to_ts('2020-01-11', '10:30')
+
+    assert await jobs.rehydrate(now) == 5
+    kinds = lambda rows: sorted(j['kind'] for j in rows)
+    # long over: left to complete_overdue()
+    assert await jobs.get_jobs(past) == []
+    assert kinds(await jobs.get_jobs(ending)) == ['auto_complete']
+    assert (await jobs.get_jobs(ending))[0]['run_at'] == now + 15 * 60
+    assert kinds(await jobs.get_jobs(future)) == ['auto_complete', 'reminder_1h', 'reminder_24h']
+    assert (await jobs.get_jobs(future))[0]['run_at'] == 1
+    assert kinds(await jobs.get_jobs(reminded)) == ['auto_complete', 'reminder_1h']
+    assert await jobs.get_jobs(cancelled) == []
+    assert await jobs.rehydrate(now) == 0
+
+
+async def test_rehydrate_skips_reminders_whose_time_passed(temp_db):
+    sid = await create_service('S', 'd', 10.0, 30)
+    mid = await create_master('M', 'b', 'c')
+    now = to_ts('2020-01-12', '12:00')
+    soon = await create_booking(1, sid, mid, '2020-01-12', '12:30', 'U', '+1')
+    today = await create_booking(2, sid, mid, '2020-01-12', '17:00', 'U', '+2')
+    tomorrow = await create_booking(3, sid, mid, '2020-01-13', '17:00', 'U', '+3')
+
+    assert await jobs.rehydrate(now) == 7
+    kinds = lambda rows: [(j['kind'], j['run_at']) for j in rows]
+    # 30 minutes away: a late 1h reminder, no "tomorrow" message
+    assert kinds(await jobs.get_jobs(soon)) == [
+        ('reminder_1h', to_ts('2020-01-12', '11:30')), ('auto_complete', to_ts('2020-01-12', '13:15'))]
+    assert kinds(await jobs.get_jobs(today)) == [
+        ('reminder_1h', to_ts('2020-01-12', '16:00')), ('auto_complete', to_ts('2020-01-12', '17:45'))]
+    assert [k for k, _ in kinds(await jobs.get_jobs(tomorrow))] == ['reminder_24h', 'reminder_1h', 'auto_complete']
+    assert await jobs.rehydrate(now) == 0
+
+
+async def test_due_reminders_are_sent_as_one_batch(temp_db, monkeypatch):
+    sid = await create_service('S', 'd', 10.0, 30)
+    bids = []
+    for i in range(30):
+        mid = await create_master(f'M{i}', 'b', 'c')
+        user = await get_or_create_user(5000 + i, name='U', phone=f'+7500000{i:04d}')
+        bids.append(await create_booking(user['id'], sid, mid, '2020-01-10', '10:00', 'U', f'+7500000{i:04d}'))
+        await schedule_reminders(bids[-1], '2020-01-10', '10:00')
+    await set_booking_status(bids[0], 'cancelled')
+    runner = jobs.JobRunner()
+    await runner.load(now_ts())
+
+    statements = []
+    original = aiosqlite.Connection.execute
+
+    def counting_execute(self, sql, parameters=None):
+        statements.append(sql)
+        return original(self, sql, parameters)
+
+    with patch('app.reminders.notify_users', new_callable=AsyncMock, side_effect=_deliver_all) as notify, monkeypatch.context() as m:
+        m.setattr(aiosqlite.Connection, 'execute', counting_execute)
+        await asyncio.gather(*await runner.run_due())
+    # one claim for all 60 jobs, one joined read per reminder kind
+    assert len([s for s in statements if s.startswith('UPDATE jobs SET status=\'running\'')]) == 1
+    assert len([s for s in statements if 'FROM bookings' in s]) == 2
+    assert notify.await_count == 2
+    assert sorted(len(call.args[0]) for call in notify.await_args_list) == [29, 29]
+    for bid in bids:
+        b = await get_booking(bid)
+        assert (b['reminded_24'], b['reminded_1']) == ((0, 0) if bid == bids[0] else (1, 1))
+    assert {j['status'] for bid in bids for j in await jobs.get_jobs(bid)} == {'done'}
+
+
+async def test_leases_keep_jobs_to_one_worker_until_they_expire(temp_db, monkeypatch):
+    job_id = await jobs.enqueue('test', 1, 100)
+    now = now_ts()
+    monkeypatch.setattr(jobs, 'WORKER_ID', 'a')
+    before = time.time()
+    job = await jobs.claim(job_id, now)
+    [row] = await jobs.get_jobs(1)
+    # leases are Unix time, not the wall-clock to_ts() scale of run_at
+    assert row['owner'] == 'a'
+    assert before + jobs.LEASE_SECONDS <= row['lease_until'] <= time.time() + jobs.LEASE_SECONDS
+
+    monkeypatch.setattr(jobs, 'WORKER_ID', 'b')
+    runner = jobs.JobRunner()
+    # a live lease is neither claimable nor reclaimable, and b cannot finish a's job
+    assert await jobs.claim(job_id, now) is None
+    assert await runner.reclaim() == 0
+    await jobs.complete(job_id)
+    assert await jobs.renew([job_id]) == 0
+    assert (await jobs.get_jobs(1))[0]['status'] == 'running'
+
+    # a stalls past its lease: b reclaims and runs the job
+    assert await runner.reclaim(time.time() + jobs.LEASE_SECONDS + 1) == 1
+    assert (await jobs.claim(job_id, now))['attempts'] == 2
+    assert await jobs.renew([job_id]) == 1
+    monkeypatch.setattr(jobs, 'WORKER_ID', 'a')
+    await jobs.fail(job, RuntimeError('late'))
+    monkeypatch.setattr(jobs, 'WORKER_ID', 'b')
+    await jobs.complete(job_id)
+    [row] = await jobs.get_jobs(1)
+    assert (row['status'], row['owner'], row['last_error']) == ('done', 'b', None)
+
+
+async def test_leases_are_renewed_while_waiting_for_a_slot(temp_db, monkeypatch):
+    monkeypatch.setattr(jobs, 'CONCURRENCY', 1)
+    monkeypatch.setattr(jobs, 'LEASE_SECONDS', 0.3)
+    release = asyncio.Event()
+
+    async def slow(booking_id):
+        await release.wait()
+    monkeypatch.setitem(jobs._handlers, 'test', slow)
+    for bid in (1, 2):
+        await jobs.enqueue('test', bid, 100)
+    runner = jobs.JobRunner()
+    await runner.load(now_ts())
+    tasks = await runner.run_due()
+    await asyncio.sleep(0.5)
+    # the second job is still queued behind the first, yet its lease is kept
+    assert await runner.reclaim() == 0
+    release.set()
+    await asyncio.gather(*tasks)
+    assert [(await jobs.get_jobs(bid))[0]['status'] for bid in (1, 2)] == ['done', 'done']
+
+
+async def test_stopping_the_runner_hands_back_interrupted_jobs(temp_db, monkeypatch):
+    started = asyncio.Event()
+
+    async def slow(booking_id):
+        started.set()
+        await asyncio.sleep(60)
+    monkeypatch.setitem(jobs._handlers, 'test', slow)
+    await jobs.enqueue('test', 1, 100)
+    jobs.start_runner()
+    try:
+        await asyncio.wait_for(started.wait(), 5)
+        assert (await jobs.get_jobs(1))[0]['owner'] == jobs.WORKER_ID
+    finally:
+        await jobs.stop_runner()
+    [row] = await jobs.get_jobs(1)
+    assert (row['status'], row['owner']) == ('pending', None)
+
+
+async def test_runner_survives_database_errors(temp_db, monkeypatch):
+    from app.db import DatabaseBusy
+    monkeypatch.setattr(jobs, 'ERROR_BACKOFF', 0.01)
+    handler = AsyncMock()
+    monkeypatch.setitem(jobs._handlers, 'test', handler)
+    original = jobs.JobRunner.load
+    failures = []
+
+    async def flaky_load(self, now):
+        if len(failures) < 2:
+            failures.append(now)
+            raise DatabaseBusy('locked')
+        return await original(self, now)
+    monkeypatch.setattr(jobs.JobRunner, 'load', flaky_load)
+    await jobs.enqueue('test', 1, 100)
+    runner = jobs.start_runner()
+    try:
+        for _ in range(200):
+            if (await jobs.get_jobs(1))[0]['status'] == 'done':
+                break
+            await asyncio.sleep(0.01)
+        assert not runner.task.done()
+    finally:
+        await jobs.stop_runner()
+    assert len(failures) == 2
+    assert (await jobs.get_jobs(1))[0]['status'] == 'done'
+    handler.assert_awaited_once_with(1)
+
+
+async def test_undelivered_reminders_stay_unflagged_and_are_retried(temp_db):
+    sid = await create_service('S', 'd', 10.0, 30)
+    bids = []
+    for i in range(3):
+        mid = await create_master(f'M{i}', 'b', 'c')
+        user = await get_or_create_user(7000 + i, name='U', phone=f'+770000000{i}')
+        bids.append(await create_booking(user['id'], sid, mid, '2020-01-10', '10:00', 'U', f'+770000000{i}'))
+        await jobs.enqueue('reminder_1h', bids[-1], 100)
+    runner = jobs.JobRunner()
+    await runner.load(now_ts())
+    # the first is sent, the second hits a network error, the third blocked the bot
+    first_pass = AsyncMock(return_value=({bids[0]}, {bids[2]}))
+    with patch('app.reminders.notify_users', first_pass):
+        await asyncio.gather(*await runner.run_due())
+    assert [(await get_booking(b))['reminded_1'] for b in bids] == [1, 0, 0]
+    statuses = [(await jobs.get_jobs(b))[0] for b in bids]
+    assert [j['status'] for j in statuses] == ['done', 'pending', 'done']
+    assert 'ReminderNotDelivered' in statuses[1]['last_error']
+
+    # the retry only sends the one that failed transiently
+    await runner.load(now_ts() + 10 ** 6)
+    with patch('app.reminders.notify_users', new_callable=AsyncMock, side_effect=_deliver_all) as notify:
+        await asyncio.gather(*await runner.run_due(now_ts() + 10 ** 6))
+    assert [key for key, _, _ in notify.await_args.args[0]] == [bids[1]]
+    assert (await get_booking(bids[1]))['reminded_1'] == 1
+
+
+async def test_reminders_without_bot_token_are_not_retried(temp_db, monkeypatch):
+    from app import notify
+    monkeypatch.setattr(notify, 'BOT_TOKEN', None)
+    sid = await create_service('S', 'd', 10.0, 30)
+    mid = await create_master('M', 'b', 'c')
+    user = await get_or_create_user(7100, name='U', phone='+77100000000')
+    bid = await create_booking(user['id'], sid, mid, '2020-01-10', '10:00', 'U', '+77100000000')
+    await schedule_reminders(bid, '2020-01-10', '10:00')
+    runner = jobs.JobRunner()
+    await runner.load(now_ts())
+    await asyncio.gather(*await runner.run_due())
+    assert [(j['status'], j['attempts'], j['last_error']) for j in await jobs.get_jobs(bid)] == [('done', 1, None)] * 2
@@ -0,0 +1,95 @@
+import pytest
+from app.db import init_db, get_db, MIGRATIONS_DIR
+from app.migrations import migrate, discover, MigrationError, LEGACY_MAX_VERSION
+
+
+async def _versions(db):
+    cur = await db.execute('SELECT version FROM schema_migrations ORDER BY version')
+    return [r['version'] for r in await cur.fetchall()]
+
+
+async def test_init_db_records_versions_and_is_idempotent(temp_db):
+    expected = [m.version for m in discover(MIGRATIONS_DIR)]
+    async with get_db() as db:
+        assert await _versions(db) == expected
+    assert await init_db() == []
+    assert await init_db(dry_run=True) == []
+
+
+async def test_dry_run_lists_pending_without_applying(tmp_path, monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'dry.db'}")
+    pending = await init_db(dry_run=True)
+    assert [m.version for m in pending] == [m.version for m in discover(MIGRATIONS_DIR)]
+    # not even the database file is created
+    assert list(tmp_path.iterdir()) == []
+
+
+async def test_dry_run_leaves_an_existing_database_untouched(tmp_path, monkeypatch):
+    import sqlite3
+    db_file = tmp_path / 'old.db'
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{db_file}")
+    conn = sqlite3.connect(db_file)
+    conn.execute('CREATE TABLE bookings (id INTEGER)')
+    conn.commit()
+    conn.close()
+    before = db_file.read_bytes()
+    assert len(await init_db(dry_run=True)) == len(discover(MIGRATIONS_DIR))
+    # same bytes (journal mode unchanged, no schema_migrations) and no -wal/-shm files
+    assert db_file.read_bytes() == before
+    assert list(tmp_path.iterdir()) == [db_file]
+
+
+async def test_failed_migration_is_rolled_back(tmp_path, monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'fail.db'}")
+    mig = tmp_path / 'mig'
+    mig.mkdir()
+    (mig / '001_ok.sql').write_text('CREATE TABLE a (id INTEGER);')
+    (mig / '002_broken.sql').write_text('CREATE TABLE b (id INTEGER);\nINSERT INTO missing VALUES (1);')
+    async with get_db() as db:
+        with pytest.raises(MigrationError):
+            await migrate(db, mig)
+        assert await _versions(db) == [1]
+        cur = await db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='b'")
+        assert await cur.fetchone() is None
+
+
+async def test_modified_migration_is_rejected(tmp_path, monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'sum.db'}")
+    mig = tmp_path / 'mig'
+    mig.mkdir()
+    f = mig / '001_init.sql'
+    f.write_text('CREATE TABLE a (id INTEGER);')
+    async with get_db() as db:
+        await migrate(db, mig)
+        f.write_text('CREATE TABLE a (id INTEGER, x TEXT);')
+        with pytest.raises(MigrationError):
+            await migrate(db, mig)
+
+
+async def test_legacy_database_is_adopted(tmp_path, monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'legacy.db'}")
+    # simulate the old runner: every file it knew executed, nothing recorded
+    async with get_db() as db:
+        for m in discover(MIGRATIONS_DIR):
+            if m.version <= LEGACY_MAX_VERSION:
+                await db.executescript(m.sql)
+        await db.commit()
+    applied = await init_db()
+    assert [m.version for m in applied] == [m.version for m in discover(MIGRATIONS_DIR)]
+    assert await init_db() == []
+
+
+async def test_legacy_adoption_does_not_swallow_later_migration_errors(tmp_path, monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'legacy.db'}")
+    # a post-runner migration that cannot be re-run (ADD COLUMN) was already executed
+    later = next(m for m in discover(MIGRATIONS_DIR) if m.version > LEGACY_MAX_VERSION and 'ADD COLUMN' in m.sql)
+    async with get_db() as db:
+        for m in discover(MIGRATIONS_DIR):
+            if m.version <= later.version:
+                await db.executescript(m.sql)
+        await db.commit()
+    with pytest.raises(MigrationError, match=later.name):
+        await init_db()
+    async with get_db() as db:
+        cur = await db.execute('SELECT max(version) FROM schema_migrations')
+        assert (await cur.fetchone())[0] == later.version - 1
@@ -0,0 +1,156 @@
+"""EXPLAIN QUERY PLAN regression suite.
+
+Every statement the repo and scheduler execute is recorded while exercising
+their public functions against a database seeded to a realistic size, then
+re-planned with EXPLAIN QUERY PLAN. A filtered or limited statement that
+falls back to a full table SCAN (or sorts a whole table for a LIMIT) fails.
+Unfiltered listings (no WHERE, no LIMIT) read everything by design.
+"""
+import asyncio
+import re
+import random
+from datetime import date, timedelta
+import aiosqlite
+import pytest
+from app.db import get_db
+from app import repo, scheduler, jobs, reminders, auto_complete
+
+_SKIP = re.compile(r'^\s*(PRAGMA|BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE|CREATE|ALTER|DROP|INSERT INTO schema_migrations)', re.I)
+_PLAIN_INSERT = re.compile(r'^\s*INSERT\b(?!.*\bSELECT\b)', re.I | re.S)
+
+
+async def _seed(db):
+    rnd = random.Random(7)
+    today = date.today()
+    await db.executemany('INSERT INTO masters (id, name) VALUES (?,?)', [(i, f'M{i}') for i in range(1, 51)])
+    await db.executemany('INSERT INTO services (id, name, price, duration_minutes) VALUES (?,?,?,?)', [(i, f'S{i}', 10.0, 30 + (i % 4) * 15) for i in range(1, 21)])
+    await db.executemany('INSERT INTO users (id, tg_id, name) VALUES (?,?,?)', [(i, 100000 + i, f'U{i}') for i in range(1, 3001)])
+    await db.executemany('INSERT INTO master_schedule (master_id, weekday, start_time, end_time) VALUES (?,?,?,?)', [(m, wd, '09:00', '18:00') for m in range(1, 51) for wd in range(5)])
+    bookings = []
+    for i in range(20000):
+        d = (today + timedelta(days=rnd.randint(-300, 60))).isoformat()
+        bookings.append((rnd.randint(1, 3000), rnd.randint(1, 20), rnd.randint(1, 50), d, f'{rnd.randint(9, 17):02d}:{rnd.choice((0, 30)):02d}', rnd.choice(('scheduled', 'completed', 'cancelled'))))
+    await db.executemany('INSERT OR IGNORE INTO bookings (user_id, service_id, master_id, date, time, status) VALUES (?,?,?,?,?,?)', bookings)
+    await db.executemany('INSERT INTO reviews (user_id, service_id, master_id, rating, text) VALUES (?,?,?,?,?)', [(rnd.randint(1, 3000), rnd.randint(1, 20), rnd.randint(1, 50), rnd.randint(1, 5), 't') for _ in range(6000)])
+    await db.executemany('INSERT INTO manual_requests (user_id, text) VALUES (?,?)', [(rnd.randint(1, 3000), 'r') for _ in range(1000)])
+    await db.executemany('INSERT INTO master_exceptions (master_id, date, available) VALUES (?,?,?)', [(m, (today + timedelta(days=k)).isoformat(), 0) for m in range(1, 51) for k in range(0, 60, 7)])
+    await db.commit()
+    await db.execute('ANALYZE')
+    await db.commit()
+
+
+async def _exercise():
+    today = date.today().isoformat()
+    future = (date.today() + timedelta(days=120)).isoformat()
+    user = await repo.get_or_create_user(100001)
+    await repo.get_or_create_user(999999999, 'New', '+37060000000')
+    await repo.get_user_by_id(user['id'])
+    await repo.list_services()
+    await repo.get_service(1)
+    await repo.list_masters()
+    await repo.get_master(1)
+    await repo.user_has_active_booking(user['id'])
+    await repo.create_booking(999999, 1, 1, future, '10:00', 'n', '+37060000001')
+    await repo.list_bookings()
+    await repo.get_booking(1)
+    await repo.list_bookings_ending_between(None, 1)
+    await repo.list_bookings_ending_between(0, 1)
+    await repo.update_service(2, duration_minutes=40)
+    await repo.set_booking_status(1, 'completed')
+    await repo.set_reminder_sent(1, '24h')
+    await repo.add_exception(1, future, 0)
+    await repo.list_exceptions(1)
+    rid = await repo.create_manual_request(user['id'], 'text')
+    await repo.list_manual_requests(50)
+    await repo.set_manual_request_processed(rid)
+    review_id = await repo.create_review(user['id'], 1, 1, 5, 'ok')
+    await repo.get_review(review_id)
+    await repo.list_reviews(limit=5)
+    await repo.list_reviews(master_id=1, limit=20)
+    await repo.list_reviews(service_id=1, limit=20)
+    await repo.average_rating_for_master(1)
+    await repo.average_rating_for_service(1)
+    await repo.average_ratings_for_masters(range(1, 51))
+    await repo.average_ratings_for_services(range(1, 21))
+    await repo.delete_review(review_id)
+    await repo.update_service(1, price=11.0)
+    await repo.update_master(1, bio='b')
+    await repo.set_master_schedule(1, 0, '09:00', '17:00')
+    await repo.get_bookings_for_export()
+    await repo.get_reviews_for_export()
+    await scheduler.set_schedule(2, 1, '09:00', '17:00', 30)
+    await scheduler.add_exception(2, today, 1, '10:00', '12:00')
+    await scheduler.list_exceptions(2)
+    await scheduler.get_master_work_info(2)
+    await scheduler.get_master_work_info(49)
+    await scheduler.generate_slots(2, today, 30)
+    await scheduler.generate_slots(3, future, 30)
+    await scheduler.generate_slots_for_masters(range(1, 51), future, 30)
+    await scheduler.find_next_slots(1, days=30)
+    await scheduler.find_next_slots(1, 3, days=30)
+    await scheduler.month_free_slot_counts(1, date.today().year, date.today().month)
+    tomorrow = (date.today() + timedelta(days=1)).isoformat()
+    bid = await repo.create_booking(999998, 3, 4, tomorrow, '09:15', 'n', '+37060000002')
+    await repo.set_booking_status(bid, 'cancelled')
+    await repo.update_service(3, duration_minutes=50)
+    await repo.delete_master(50)
+    await repo.delete_service(20)
+    # durable jobs
+    await reminders.schedule_reminders(bid, tomorrow, '09:15')
+    await auto_complete.schedule_auto_complete(bid, tomorrow, '09:15', 30)
+    await auto_complete.cancel_auto_complete(bid)
+    await jobs.get_jobs(bid)
+    await jobs.rehydrate()
+    runner = jobs.JobRunner()
+    await runner.reclaim()
+    await jobs.renew([1, 2])
+    await runner.load(scheduler.now_ts())
+    await runner.purge(scheduler.now_ts())
+    await runner.run_due(scheduler.now_ts() + 2 * 86400)
+    await asyncio.gather(*runner.running)
+    await repo.list_reminder_targets([bid, 1, 2])
+    await repo.set_reminders_sent([bid, 1], '1h')
+    await repo.get_bookings([bid, 1, 2])
+    await auto_complete.complete_overdue()
+
+
+def _problems(sql, plan):
+    details = [row[3] for row in plan]
+    filtered = re.search(r'\bWHERE\b', sql, re.I) is not None
+    limited = re.search(r'\bLIMIT\b', sql, re.I) is not None
+    bad = []
+    for d in details:
+        # skip-scans (ANY(col)) and automatic indexes walk the whole table too
+        full = d.startswith('SCAN ') or 'ANY(' in d or 'AUTOMATIC' in d
+        if full and (filtered or (limited and 'INDEX' not in d)):
+            bad.append(d)
+        if limited and 'TEMP B-TREE FOR ORDER BY' in d and not filtered:
+            bad.append(d)
+    return bad
+
+
+async def test_repo_queries_use_indexes(temp_db, monkeypatch):
+    async with get_db() as db:
+        await _seed(db)
+
+    recorded = {}
+    original = aiosqlite.Connection.execute
+
+    def recording_execute(self, sql, parameters=None):
+        if not _SKIP.match(sql) and not _PLAIN_INSERT.match(sql):
+            recorded.setdefault(' '.join(sql.split()), parameters)
+        return original(self, sql, parameters)
+
+    with monkeypatch.context() as m:
+        m.setattr(aiosqlite.Connection, 'execute', recording_execute)
+        await _exercise()
+
+    assert len(recorded) > 20
+    failures = {}
+    async with get_db() as db:
+        for sql, params in recorded.items():
+            cur = await db.execute('EXPLAIN QUERY PLAN ' + sql, params or ())
+            bad = _problems(sql, await cur.fetchall())
+            if bad:
+                failures[sql] = bad
+    assert not failures, 'full scans in hot queries:\n' + '\n'.join(f'{s}\n    -> {b}' for s, b in failures.items())
@@ -1,55 +1,65 @@
+import asyncio
 import pytest
 from unittest.mock import AsyncMock, patch
 from datetime import datetime, timedelta
-from app.repo import create_service, create_master, create_booking, get_or_create_user, list_bookings, get_booking
+from app import jobs
+from app.reminders import schedule_reminders
+from app.repo import create_service, create_master, create_booking, get_or_create_user, get_booking, set_booking_status
+from app.scheduler import now_ts
 
 
-@pytest.mark.asyncio
-async def test_reminder_sent_for_scheduled_booking(temp_db):
-    # create booking in past so reminder runs immediately
-    base = datetime.now() - timedelta(hours=2)
+async def _deliver_all(messages):
+    return {key for key, _, _ in messages}, set()
+
+
+async def _booking_with_reminders(tg_id, name):
+    # booking in 26 hours: the 24h reminder is due in two hours, the 1h one a day later
+    base = datetime.now() + timedelta(hours=26)
     date_s = base.date().isoformat()
     time_s = base.time().strftime('%H:%M')
-    sid = await create_service('R1', 'd', 10.0, 30)
-    mid = await create_master('M1', 'bio', 'c')
-    user = await get_or_create_user(9000, name='U', phone='+79000000000')
-    await create_booking(user['id'], sid, mid, date_s, time_s, 'U', '+79000000000')
-    bookings = await list_bookings()
-    bid = bookings[0]['id']
-
-    # Patch notify_user to capture calls
-    import app.reminders as reminders
-    with patch('app.reminders.notify_user', new_callable=AsyncMock) as mock_notify:
-        # call send directly for 24h and 1h
-        await reminders._send_reminder(bid, '24h', 0)
-        await reminders._send_reminder(bid, '1h', 0)
+    sid = await create_service(name, 'd', 10.0, 30)
+    mid = await create_master(name, 'bio', 'c')
+    user = await get_or_create_user(tg_id, name='U', phone=f'+7{tg_id}')
+    bid = await create_booking(user['id'], sid, mid, date_s, time_s, 'U', f'+7{tg_id}')
+    await schedule_reminders(bid, date_s, time_s)
+    return bid
 
+
+async def _run_due(now):
+    runner = jobs.JobRunner()
+    await runner.load(now)
+    await asyncio.gather(*await runner.run_due(now))
+
+
+@pytest.mark.asyncio
+async def test_reminder_sent_for_scheduled_booking(temp_db):
+    bid = await _booking_with_reminders(9000, 'R1')
+
+    with patch('app.reminders.notify_users', new_callable=AsyncMock, side_effect=_deliver_all) as mock_notify:
+        await _run_due(now_ts() + 26 * 3600)
+
+    sent = [msg for call in mock_notify.await_args_list for msg in call.args[0]]
+    assert [key for key, _, _ in sent] == [bid, bid]
+    assert all(tg == 9000 for _, tg, _ in sent)
     # Check flags updated in DB
     b = await get_booking(bid)
     assert b['reminded_24'] == 1
     assert b['reminded_1'] == 1
+    assert {j['status'] for j in await jobs.get_jobs(bid)} == {'done'}
 
 
 @pytest.mark.asyncio
 async def test_no_reminder_for_cancelled_or_completed(temp_db):
-    base = datetime.now() - timedelta(hours=2)
-    date_s = base.date().isoformat()
-    time_s = base.time().strftime('%H:%M')
-    sid = await create_service('R2', 'd', 10.0, 30)
-    mid = await create_master('M2', 'bio', 'c')
-    user = await get_or_create_user(9001, name='U2', phone='+79000000001')
-    await create_booking(user['id'], sid, mid, date_s, time_s, 'U2', '+79000000001')
-    bookings = await list_bookings()
-    bid = bookings[0]['id']
-
-    from app.repo import set_booking_status
-    await set_booking_status(bid, 'cancelled')
-
-    import app.reminders as reminders
-    with patch('app.reminders.notify_user', new_callable=AsyncMock) as mock_notify:
-        await reminders._send_reminder(bid, '24h', 0)
-        await reminders._send_reminder(bid, '1h', 0)
+    cancelled = await _booking_with_reminders(9001, 'R2')
+    completed = await _booking_with_reminders(9002, 'R3')
+    await set_booking_status(cancelled, 'cancelled')
+    await set_booking_status(completed, 'completed')
+
+    with patch('app.reminders.notify_users', new_callable=AsyncMock, side_effect=_deliver_all) as mock_notify:
+        await _run_due(now_ts() + 26 * 3600)
+    mock_notify.assert_not_awaited()
     # flags should remain 0
-    b = await get_booking(bid)
-    assert b['reminded_24'] == 0
-    assert b['reminded_1'] == 0
+    for bid in (cancelled, completed):
+        b = await get_booking(bid)
+        assert b['reminded_24'] == 0
+        assert b['reminded_1'] == 0
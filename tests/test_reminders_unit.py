@@ -1,3 +1,4 @@
+import asyncio
 from datetime import datetime, timedelta
 from app.reminders import compute_reminder_times
 
@@ -10,3 +11,35 @@ def test_compute_reminder_times():
     assert booking.hour == 12 and booking.minute == 30
     assert times['24h'] == booking - timedelta(hours=24)
     assert times['1h'] == booking - timedelta(hours=1)
+
+
+async def test_notify_users_honours_retry_after_and_reports_delivered(monkeypatch):
+    from unittest.mock import AsyncMock, MagicMock
+    from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError
+    from app import notify
+    calls = []
+
+    async def send_message(tg_id, text):
+        calls.append((tg_id, asyncio.get_running_loop().time()))
+        if tg_id == 1 and len(calls) == 1:
+            raise TelegramRetryAfter(method=MagicMock(), message='flood', retry_after=0.2)
+        if tg_id == 3:
+            raise RuntimeError('connection reset')
+        if tg_id == 4:
+            raise TelegramForbiddenError(method=MagicMock(), message='bot was blocked by the user')
+    bot = MagicMock(send_message=send_message, session=MagicMock(close=AsyncMock()))
+    monkeypatch.setattr(notify, 'BOT_TOKEN', 'token')
+    monkeypatch.setattr(notify, 'SEND_CONCURRENCY', 1)
+    monkeypatch.setattr(notify, 'Bot', lambda token: bot)
+    monkeypatch.setattr(notify, '_slots', None)
+    monkeypatch.setattr(notify, '_resume_at', 0.0)
+    delivered, rejected = await notify.notify_users([('a', 1, 'x'), ('b', 2, 'y'), ('c', 3, 'z'), ('d', None, 'w'), ('e', 4, 'v')])
+    # 'c' failed transiently: in neither set, so the caller may retry it
+    assert (delivered, rejected) == ({'a', 'b'}, {'d', 'e'})
+    # the flood reply paused every later send
+    first = calls[0][1]
+    assert [tg for tg, _ in calls] == [1, 1, 2, 3, 4]
+    assert all(at - first >= 0.2 for _, at in calls[1:])
+    bot.session.close.assert_awaited_once()
+    monkeypatch.setattr(notify, 'BOT_TOKEN', None)
+    assert await notify.notify_users([('a', 1, 'x')]) == (set(), {'a'})
@@ -54,3 +54,19 @@ def test_concurrent_slot_booking(temp_db):
         assert r.count('ok') == 1
         assert r.count('taken') + r.count('double') == 1
     __import__('asyncio').run(_run())
+
+
+def test_create_booking_returns_new_id(temp_db):
+    async def _run():
+        from app.repo import get_booking
+        mid = await create_master('Id Master')
+        sid = await create_service('Id Service', 'desc', 10.0, 30)
+        u1 = await get_or_create_user(300000001, 'A', '+37060000011')
+        u2 = await get_or_create_user(300000002, 'B', '+37060000012')
+        d = (date.today() + timedelta(days=2)).isoformat()
+        b1 = await create_booking(u1['id'], sid, mid, d, '10:00', 'A', '+37060000011')
+        b2 = await create_booking(u2['id'], sid, mid, d, '11:00', 'B', '+37060000012')
+        assert isinstance(b1, int) and b1 != b2
+        row = await get_booking(b2)
+        assert (row['user_id'], row['time'], row['status']) == (u2['id'], '11:00', 'scheduled')
+    __import__('asyncio').run(_run())
@@ -1,5 +1,6 @@
 import asyncio
 from app.repo import create_master, create_service, create_review, list_reviews, average_rating_for_master, average_rating_for_service
+from app.repo import average_ratings_for_masters, average_ratings_for_services
 
 
 def test_create_and_list_reviews(temp_db):
@@ -17,4 +18,48 @@ def test_create_and_list_reviews(temp_db):
         assert avg >= 4.0
         avgm, cntm = await average_rating_for_master(mid)
         assert cntm >= 1
-    asyncio.run(_run())
\ No newline at end of file
+    asyncio.run(_run())
+
+
+def test_batched_ratings_match_single_lookups(temp_db):
+    async def _run():
+        m1 = await create_master('M1','b','c')
+        m2 = await create_master('M2','b','c')
+        s1 = await create_service('S1','d',10.0,30)
+        s2 = await create_service('S2','d',10.0,30)
+        await create_review(1, s1, m1, 5, 'a')
+        await create_review(2, s1, m1, 3, 'b')
+        await create_review(3, s2, None, 4, 'c')
+        masters = await average_ratings_for_masters([m1, m2, m1])
+        assert masters == {m1: await average_rating_for_master(m1), m2: (0.0, 0)}
+        assert masters[m1] == (4.0, 2)
+        services = await average_ratings_for_services([s1, s2])
+        assert services[s1] == (4.0, 2)
+        assert services[s2] == await average_rating_for_service(s2)
+        assert await average_ratings_for_services([]) == {}
+    asyncio.run(_run())
+
+
+def test_rating_stats_follow_review_writes(temp_db):
+    async def _run():
+        from app.db import get_db
+        from app.repo import delete_review, rebuild_rating_stats
+        mid = await create_master('M1','b','c')
+        sid = await create_service('S1','d',10.0,30)
+        r1 = await create_review(1, sid, mid, 5, 'a')
+        await create_review(2, sid, mid, 3, 'b')
+        assert await average_rating_for_master(mid) == (4.0, 2)
+        # re-review by the same user replaces the rating
+        await create_review(2, sid, mid, 1, 'c')
+        assert await average_rating_for_service(sid) == (3.0, 2)
+        await delete_review(r1)
+        assert await average_rating_for_master(mid) == (1.0, 1)
+        assert (await average_ratings_for_services([sid]))[sid] == (1.0, 1)
+        # drift is repaired by a rebuild
+        async with get_db() as db:
+            await db.execute("UPDATE rating_stats SET rating_sum=100")
+            await db.commit()
+        assert await rebuild_rating_stats() == 2
+        assert await average_rating_for_master(mid) == (1.0, 1)
+        assert await average_rating_for_service(sid) == (1.0, 1)
+    asyncio.run(_run())
@@ -18,3 +18,35 @@ def test_generate_slots_and_exception(temp_db):
         slots2 = await generate_slots(mid, d, 30)
         assert slots2 == []
     __import__('asyncio').run(_run())
+
+
+def test_master_work_info_is_cached_and_follows_schedule_writes(temp_db, monkeypatch):
+    async def _run():
+        import aiosqlite
+        from app.repo import set_master_schedule, delete_master
+        from app.scheduler import get_master_work_info, DEFAULT_WORK_DAYS, DEFAULT_START_TIME, DEFAULT_END_TIME
+        mid = await create_master('Info Master')
+        assert await get_master_work_info(mid) == (DEFAULT_WORK_DAYS, DEFAULT_START_TIME, DEFAULT_END_TIME, None)
+        await set_schedule(mid, 2, '10:00', '16:00', 20)
+        await set_master_schedule(mid, 0, '09:00', '14:00')
+        assert await get_master_work_info(mid) == ([0, 2], '09:00', '16:00', 20)
+
+        executed = []
+        original = aiosqlite.Connection.execute
+
+        def counting_execute(self, sql, parameters=None):
+            executed.append(sql)
+            return original(self, sql, parameters)
+
+        with monkeypatch.context() as m:
+            m.setattr(aiosqlite.Connection, 'execute', counting_execute)
+            info = await get_master_work_info(mid)
+            info[0].append(6)
+            assert await get_master_work_info(mid) == ([0, 2], '09:00', '16:00', 20)
+        assert executed == []
+        await set_schedule(mid, 4, '08:00', '12:00')
+        assert (await get_master_work_info(mid))[:3] == ([0, 2, 4], '08:00', '16:00')
+        await delete_master(mid)
+        from app import availability
+        assert availability._engine.templates is None
+    __import__('asyncio').run(_run())